@@ -0,0 +1,13 @@
+set role rg_staff;
+
+-- The model grid records the state of each task (issue area, model group, time split) in experiment_runs,
+-- keyed by the model hash, so that a crashed grid can resume. The run rows keep a null model_hash.
+
+alter table issue_classifier_metadata.experiment_runs 
+	add column if not exists model_hash varchar,
+	add column if not exists issue_area varchar,
+	add column if not exists model_group_id int,
+	add column if not exists time_split_index int,
+	add column if not exists end_time timestamp;
+
+alter table issue_classifier_metadata.experiment_runs add unique (experiment_hash, model_hash);
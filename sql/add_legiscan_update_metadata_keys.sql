@@ -0,0 +1,38 @@
+set role rg_staff;
+
+-- The weekly update upserts the hashes (insert ... on conflict), which needs a unique key on each table.
+-- For existing tables: copy all the rows to the history tables, keep the latest hash of each bill/session and add the keys
+-- Rows without an update_date are considered older than the dated ones
+-- Everything runs in one transaction, so a failure leaves the tables as they were
+
+begin;
+
+--bill hashes
+create table if not exists legiscan_update_metadata.bill_hashes_history (like legiscan_update_metadata.bill_hashes);
+
+insert into legiscan_update_metadata.bill_hashes_history (bill_id, session_id, bill_hash, update_date)
+select bill_id, session_id, bill_hash, update_date from legiscan_update_metadata.bill_hashes;
+
+delete from legiscan_update_metadata.bill_hashes a
+using legiscan_update_metadata.bill_hashes b
+where a.bill_id = b.bill_id 
+and a.session_id = b.session_id
+and (coalesce(a.update_date, '-infinity'::date), a.ctid) < (coalesce(b.update_date, '-infinity'::date), b.ctid);
+
+alter table legiscan_update_metadata.bill_hashes add unique (bill_id, session_id);
+
+--session hashes
+create table if not exists legiscan_update_metadata.session_hashes_history (like legiscan_update_metadata.session_hashes);
+
+insert into legiscan_update_metadata.session_hashes_history (session_id, state_id, session_hash, update_date)
+select session_id, state_id, session_hash, update_date from legiscan_update_metadata.session_hashes;
+
+delete from legiscan_update_metadata.session_hashes a
+using legiscan_update_metadata.session_hashes b
+where a.session_id = b.session_id 
+and a.state_id = b.state_id
+and (coalesce(a.update_date, '-infinity'::date), a.ctid) < (coalesce(b.update_date, '-infinity'::date), b.ctid);
+
+alter table legiscan_update_metadata.session_hashes add unique (session_id, state_id);
+
+commit;
@@ -0,0 +1,105 @@
+-- This script creates the active_bills table in the pre_triage_features schema, and the functions that fill and read it
+-- An active bill as of a date is a bill of a regular session that is in progress (the session convened and not adjourned),
+-- that has not passed, failed or been vetoed, and that had an event in the 60 days before the date
+-- The table is used by the cohort and label queries of the bill passage models in triage, the active bills filter of the web search,
+-- and the status updates of the ES index. It is keyed by as_of_date
+-- pre_triage_features.active_bills_as_of(as_of_dates) computes the active bills of a set of dates, without storing them
+-- pre_triage_features.get_active_bills(as_of_date) returns the active bills of a date. It is read only: 
+-- a date that is not in the table is computed on the fly, and not stored
+-- pre_triage_features.refresh_active_bills(as_of_dates) (re)computes and stores a set of dates. Only the refresh after the data sync writes to the table
+-- A stored date is kept until it is refreshed again, so the dates the refresh does not cover stay as they were first computed
+SET ROLE rg_staff;
+
+CREATE SCHEMA IF NOT EXISTS pre_triage_features;
+
+-- The clean tables are recreated by the data sync. The event lookups of the active bills need this index
+-- The primary key of bill_progress (bill_id, progress_date, event) covers the progress lookups
+CREATE INDEX IF NOT EXISTS bill_events_bill_id_event_date_idx ON clean.bill_events (bill_id, event_date);
+
+CREATE TABLE IF NOT EXISTS pre_triage_features.active_bills (
+    as_of_date date,
+    bill_id int,
+    primary key (as_of_date, bill_id)
+);
+
+CREATE INDEX IF NOT EXISTS active_bills_bill_id_idx ON pre_triage_features.active_bills (bill_id);
+
+-- The dates in active_bills. A date can have no active bills
+CREATE TABLE IF NOT EXISTS pre_triage_features.active_bills_dates (
+    as_of_date date primary key,
+    refreshed_at timestamp
+);
+
+
+CREATE OR REPLACE FUNCTION pre_triage_features.active_bills_as_of(as_of_dates date[]) RETURNS TABLE (as_of_date date, bill_id int) AS $$
+#variable_conflict use_column
+BEGIN
+    RETURN QUERY
+    SELECT 
+        DISTINCT aod.as_of_date, a.bill_id
+    FROM unnest(as_of_dates) AS aod(as_of_date)
+        JOIN clean.sessions b 
+            ON extract(year from aod.as_of_date)::int in (b.year_start, b.year_end) AND NOT b.special
+                JOIN pre_triage_features.ajusted_session_dates c USING (session_id)
+                    JOIN clean.bills a USING (session_id)
+    WHERE 
+        extract(year from a.introduced_date)::int in (b.year_start, b.year_end)
+        AND 
+        a.introduced_date < aod.as_of_date
+        AND 
+        (c.adjourn_date > aod.as_of_date or c.adjourn_date is null)
+        AND 
+        c.convene_date < aod.as_of_date
+        AND 
+        EXISTS (
+            SELECT 1 FROM clean.bill_progress d 
+            WHERE d.bill_id = a.bill_id AND d.progress_date < aod.as_of_date
+        )
+        AND 
+        NOT EXISTS (
+            SELECT 1 FROM clean.bill_progress d 
+            WHERE d.bill_id = a.bill_id AND d.progress_date < aod.as_of_date AND d.event in (4, 5, 6)
+        )
+        AND 
+        EXISTS (
+            SELECT 1 FROM clean.bill_events e 
+            WHERE e.bill_id = a.bill_id AND e.event_date < aod.as_of_date AND e.event_date > aod.as_of_date - 60
+        );
+END;
+$$ LANGUAGE plpgsql STABLE;
+
+
+CREATE OR REPLACE FUNCTION pre_triage_features.refresh_active_bills(as_of_dates date[]) RETURNS integer AS $$
+DECLARE
+    num_rows integer;
+BEGIN
+    -- Concurrent refreshes would delete and insert the same dates. They run one at a time
+    PERFORM pg_advisory_xact_lock(hashtext('pre_triage_features.refresh_active_bills'));
+
+    DELETE FROM pre_triage_features.active_bills WHERE as_of_date = any(as_of_dates);
+
+    INSERT INTO pre_triage_features.active_bills (as_of_date, bill_id)
+    SELECT a.as_of_date, a.bill_id 
+    FROM pre_triage_features.active_bills_as_of(as_of_dates) a;
+
+    GET DIAGNOSTICS num_rows = ROW_COUNT;
+
+    INSERT INTO pre_triage_features.active_bills_dates (as_of_date, refreshed_at)
+    SELECT DISTINCT x, now() FROM unnest(as_of_dates) AS x
+    ON CONFLICT (as_of_date) DO UPDATE SET refreshed_at = excluded.refreshed_at;
+
+    RETURN num_rows;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Read only, so that it can be used by read only roles and concurrent readers (e.g. the web app and the triage workers)
+CREATE OR REPLACE FUNCTION pre_triage_features.get_active_bills(as_of date) RETURNS TABLE (bill_id int) AS $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pre_triage_features.active_bills_dates d WHERE d.as_of_date = as_of) THEN
+        RETURN QUERY SELECT a.bill_id FROM pre_triage_features.active_bills a WHERE a.as_of_date = as_of;
+    ELSE
+        RETURN QUERY SELECT a.bill_id FROM pre_triage_features.active_bills_as_of(array[as_of]) a;
+    END IF;
+END;
+$$ LANGUAGE plpgsql STABLE;
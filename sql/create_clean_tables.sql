@@ -72,6 +72,8 @@ CREATE TABLE clean.bill_events(
     primary key (bill_id, event_hash)
 );
 
+CREATE INDEX bill_events_bill_id_event_date_idx ON clean.bill_events (bill_id, event_date);
+
 --bill_progress table
 DROP TABLE IF EXISTS clean.bill_progress;
 
@@ -14,13 +14,20 @@ create table issue_classifier_metadata.experiments (
 
 drop table if exists issue_classifier_metadata.experiment_runs;
 
+-- One row per experiment run, and one row per model grid task (model_hash is not null) to resume a crashed grid
 create table issue_classifier_metadata.experiment_runs (
 	id serial,	
 	experiment_hash varchar,
 	start_time timestamp,
 	run_status varchar,
 	project_folder text,
-	log_location text
+	log_location text,
+	model_hash varchar,
+	issue_area varchar,
+	model_group_id int,
+	time_split_index int,
+	end_time timestamp,
+	unique (experiment_hash, model_hash)
 );
 
 drop table if exists issue_classifier_metadata.model_groups;
@@ -8,6 +8,17 @@ CREATE SCHEMA legiscan_update_metadata;
 DROP TABLE IF EXISTS legiscan_update_metadata.bill_hashes;
 
 CREATE TABLE legiscan_update_metadata.bill_hashes(
+    bill_id varchar,
+    session_id varchar,
+    bill_hash varchar,
+    update_date date,
+    unique (bill_id, session_id)
+);
+
+-- All the bill hashes we stored. bill_hashes only keeps the latest hash of each bill
+DROP TABLE IF EXISTS legiscan_update_metadata.bill_hashes_history;
+
+CREATE TABLE legiscan_update_metadata.bill_hashes_history(
     bill_id varchar,
     session_id varchar,
     bill_hash varchar,
@@ -18,6 +29,17 @@ CREATE TABLE legiscan_update_metadata.bill_hashes(
 DROP TABLE IF EXISTS legiscan_update_metadata.session_hashes;
 
 CREATE TABLE legiscan_update_metadata.session_hashes(
+    session_id varchar,
+    state_id varchar,
+    session_hash varchar,
+    update_date date,
+    unique (session_id, state_id)
+);
+
+-- All the session hashes we stored. session_hashes only keeps the latest hash of each session
+DROP TABLE IF EXISTS legiscan_update_metadata.session_hashes_history;
+
+CREATE TABLE legiscan_update_metadata.session_hashes_history(
     session_id varchar,
     state_id varchar,
     session_hash varchar,
@@ -1,9 +1,12 @@
+import pandas as pd
+
 from typing import Dict, List
 from gensim.models import Doc2Vec
 from gensim.summarization.textcleaner import tokenize_by_word
 from gensim.models.doc2vec import TaggedDocument
 
 from src.pipeline.text_preprocessing import run_preprocessing_steps
+from src.pipeline.preprocessed_text_store import PreprocessedTextStore
 
 
 def _tag_training_corpus(train_corpus: List[List[str]]):
@@ -20,18 +23,24 @@ def _tag_training_corpus(train_corpus: List[List[str]]):
     return tagged_list 
 
 
-def prepare_documents(bills: List, preprocessing_steps: List, train=False):
+def prepare_documents(bills: List, preprocessing_steps: List, train=False, doc_ids: List=None, text_field='doc'):
     """ Given a list of bills, preprocess and prepare them for training doc vectors
         Args:
             bills: The list of bills to be prepared
             preprocessing_steps: preprocessing steps to be applied to the bills
             train: Whether the bills are the training corpus or not
+            doc_ids: The doc_ids of the bills. If given, the preprocessed texts are read from (and added to) the preprocessed text store
+            text_field: The field of the bill_text index the bills come from. Used with the doc_ids
         Return:
             If train, a list of TaggedDocuments
             If not train, a list of tokens per documents 
     """
 
-    bills_preproc = run_preprocessing_steps(bills, preprocessing_steps)
+    if doc_ids is not None:
+        store = PreprocessedTextStore(preprocessing_steps=preprocessing_steps, text_field=text_field)
+        bills_preproc = store.preprocess(pd.Series(bills, index=[int(x) for x in doc_ids]))
+    else:
+        bills_preproc = run_preprocessing_steps(pd.Series(bills), preprocessing_steps)
 
     tokenized_bills = [list(tokenize_by_word(x)) for x in bills_preproc]
 
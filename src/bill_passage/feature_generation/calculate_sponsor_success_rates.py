@@ -3,7 +3,7 @@ import pandas as pd
 import logging
 import psycopg2
 
-from src.utils.general import get_db_conn, copy_df_to_pg
+from src.utils.general import get_db_conn
 
 # logging.basicConfig(level=logging.DEBUG, filename="../../logs/calculating_sponsor_success.DEBUG", filemode='w')
 # logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
@@ -40,68 +40,40 @@ def create_temp_table(db_conn):
         logging.error(error)
 
 
-def _fetch_knowledge_dates(db_conn):
-    # The knowledge dates -- We calculate the metric at each bill introduction date 
-    # Using a '2000-01-01' cut off as some bills with intro dates of 1969
-
-    # Fetching the knowledges not present in the sponsor success table to avoid repeated calculations
-    # There are bills in the data with intro dates in the future, adding a where clause to filter only the dates upto today
+def _fetch_last_knowledge_date(db_conn):
+    # The success rates are calculated for the knowledge dates after the last one in the table, to avoid repeated calculations
+    # There are bills in the data with intro dates in the future. Those knowledge dates are recalculated in every run
+    # With an empty table, we start at '2000-01-01' as some bills have intro dates of 1969
     q = """
-        with last_knowledge_date as (
-            select 
-                max(knowledge_date) as last_date 
-            from pre_triage_features.temp_sponsor_success
-            where knowledge_date < current_date
-        ) 
         select 
-            distinct introduced_date from clean.bills, last_knowledge_date
-        where introduced_date > last_date
-        order by introduced_date
-    """
-
-    logging.info('Fetching the distinct knowledge dates')
-    knowledge_dates = pd.read_sql(q, db_conn)['introduced_date'].to_list()
-
-    return knowledge_dates
-
-
-def _data_already_exists(db_conn, knowledge_date):
-    check_date_exist_q = """
-        select count(*) from pre_triage_features.temp_sponsor_success where knowledge_date='{}' 
+            coalesce(max(knowledge_date), '2000-01-01'::timestamp) as last_date 
+        from pre_triage_features.temp_sponsor_success
+        where knowledge_date < current_date
     """
 
-    q = check_date_exist_q.format(knowledge_date)
-    num_rows = pd.read_sql(q, db_conn).at[0, 'count']
+    last_date = pd.read_sql(q, db_conn).at[0, 'last_date']
+    logging.info('The success rates are calculated up to {}'.format(last_date))
 
-    if num_rows > 0:
-        return True
-    else:
-        return False
+    return last_date
 
 
 def create_joined_table(db_conn):
     """
-    Creates a table where there's a row for each bill_id, sponsor_id, knowledge_date
+    Creates a table where there's a row for each bill_id, sponsor_id, knowledge_date. If the table already exists, this is ignored
     """
 
-    logging.info('creating a joined table between the bill_sponsors and the success rates table to avoid an expensive join during triage experiment')
-
     q = """
-        DROP TABLE IF EXISTS pre_triage_features.bill_sponsor_success;
+        CREATE TABLE IF NOT EXISTS pre_triage_features.bill_sponsor_success (
+            bill_id int,
+            sponsor_id int,
+            knowledge_date timestamp,
+            num_bills_sponsored int,
+            num_bills_passed int,
+            success_rate numeric(6,5),
+            PRIMARY KEY (bill_id, sponsor_id)
+        );
 
-        create table pre_triage_features.bill_sponsor_success as (
-        with bill_spnsr_info as (
-            select bill_id, introduced_date, sponsor_id from clean.bills a join clean.bill_sponsors b using(bill_id)
-        )
-        select 
-            bill_id,
-            a.sponsor_id,
-            knowledge_date,
-            num_bills_sponsored,
-            num_bills_passed,
-            success_rate
-        from bill_spnsr_info a join pre_triage_features.temp_sponsor_success b on (a.sponsor_id=b.sponsor_id and a.introduced_date=b.knowledge_date)
-    )
+        CREATE INDEX IF NOT EXISTS knwldge_date_index ON pre_triage_features.bill_sponsor_success(knowledge_date);
     """
 
     cursor = db_conn.cursor()
@@ -112,92 +84,122 @@ def create_joined_table(db_conn):
         logging.error(error)
         raise error
 
-    logging.info('Created the joined table!')
-
-    q1 = "alter table pre_triage_features.bill_sponsor_success add primary key (bill_id, sponsor_id)"
-    q2 = "CREATE INDEX knwldge_date_index ON pre_triage_features.bill_sponsor_success(knowledge_date)"
-
-    cursor = db_conn.cursor()
-    try: 
-        cursor.execute(q1)
-        cursor.execute(q2)
-        db_conn.commit()  
-    except (Exception, psycopg2.DatabaseError) as error:
-        logging.error(error)
-
-    logging.info('Added the primary key and the index for the date')
-
 
 def calculate_bill_sponsor_success_rates(db_conn):
     """
         Main function for calculating the sponsor success rates. 
         Calculates the success rate of a sponsor at each time they introduced a bill.
-        Creates two tables:
+        Maintains two tables:
             1) temp_sponsor_success (sponsor_id, knoledge_date, success_rate)
             2) bill_sponsor_success (bill_id, sponsor_id, knowledge_date, success_rate)
         bill_sponsor_success table is used in triage
+
+        Only the knowledge dates after the last calculated date are processed, in one pass over the history of their sponsors,
+        and the results are upserted to both tables
     """
 
     create_temp_table(db_conn)
-    knowledge_dates = _fetch_knowledge_dates(db_conn)
+    create_joined_table(db_conn)
+    last_date = _fetch_last_knowledge_date(db_conn)
 
+    # A bill counts as sponsored at a knowledge date if it was introduced and had a progress event before that date,
+    # and as passed if it was introduced and passed (event 4) before that date.
+    # So each bill adds one to the counts of its sponsors after the sponsored_date and the passed_date.
+    # The events and the knowledge dates of a sponsor are sorted by date, and the running sums give the counts at each knowledge date.
+    # A knowledge date comes before the events of the same day, as only the events before the knowledge date are counted
     calculation_q = """
         with sponsors_scored as (
             select 
-                sponsor_id
-            from clean.bills left join clean.bill_sponsors using(bill_id)
-            where introduced_date='{knowledge_date}'
-            group by 1
+                distinct sponsor_id, introduced_date::timestamp as knowledge_date
+            from clean.bills join clean.bill_sponsors using(bill_id)
+            where introduced_date > %(last_date)s
+        ),
+        bill_history as (
+            select 
+                bill_id,
+                greatest(introduced_date, min(progress_date))::timestamp as sponsored_date,
+                case 
+                    when max(case when event=4 then 1 else 0 end) = 1 
+                    then greatest(introduced_date, min(case when event=4 then progress_date end))::timestamp 
+                end as passed_date
+            from clean.bills join clean.bill_progress using(bill_id)
+            where introduced_date is not null and progress_date is not null
+            group by bill_id, introduced_date
         ),
-        sponsor_history as (
+        sponsor_bills as (
             select 
-                bill_id, sponsor_id, max(case when event=4 then 1 else 0 end) as passed
-            from clean.bills left join clean.bill_progress using(bill_id) 
-                left join clean.bill_sponsors using(bill_id) 
-                    join sponsors_scored using(sponsor_id)
-            where introduced_date < '{knowledge_date}' and progress_date < '{knowledge_date}'
-            group by 1, 2
-            order by 1
+                sponsor_id, sponsored_date, passed_date
+            from bill_history join clean.bill_sponsors using(bill_id)
+            where sponsor_id in (select sponsor_id from sponsors_scored)
+        ),
+        sponsor_timeline as (
+            select sponsor_id, knowledge_date as event_date, 0 as event_order, 0 as sponsored, 0 as passed from sponsors_scored
+            union all
+            select sponsor_id, sponsored_date, 1, 1, 0 from sponsor_bills
+            union all
+            select sponsor_id, passed_date, 1, 0, 1 from sponsor_bills where passed_date is not null
+        ),
+        running_counts as (
+            select
+                sponsor_id,
+                event_date,
+                event_order,
+                sum(sponsored) over w as num_bills_sponsored,
+                sum(passed) over w as num_bills_passed
+            from sponsor_timeline
+            window w as (partition by sponsor_id order by event_date, event_order rows between unbounded preceding and current row)
         )
+        insert into pre_triage_features.temp_sponsor_success 
+            (sponsor_id, knowledge_date, num_bills_sponsored, num_bills_passed, success_rate)
         select
             sponsor_id, 
-            '{knowledge_date}'::date as knowledge_date,
-            count(distinct bill_id) as num_bills_sponsored,
-            sum(passed) as num_bills_passed,
-            sum(passed)::float / count(distinct bill_id) as success_rate
-        from sponsor_history
-        group by sponsor_id
+            event_date as knowledge_date,
+            num_bills_sponsored,
+            num_bills_passed,
+            num_bills_passed::float / num_bills_sponsored as success_rate
+        from running_counts
+        where event_order = 0 and num_bills_sponsored > 0
+        on conflict (sponsor_id, knowledge_date) do update set
+            num_bills_sponsored=excluded.num_bills_sponsored,
+            num_bills_passed=excluded.num_bills_passed,
+            success_rate=excluded.success_rate
     """
 
-    for i, knowledge_date in enumerate(knowledge_dates):
-        logging.info('Calculating the success rates at {}. ({} out of {})'.format(knowledge_date, i+1, len(knowledge_dates)))
-
-        if _data_already_exists(db_conn, knowledge_date):
-            # NOTE: The assumption here is that the if the knowledge data exist, success rate for all the sponsors at that time exist. 
-            # Could be handled better
-            logging.warning('The calculations for knowledge date {} already exists in the DB. Skipping'.format(knowledge_date))
-            continue
-    
-        q = calculation_q.format(knowledge_date=knowledge_date)
-        df = pd.read_sql(q, db_conn)
-
-        df['knowledge_date'] = knowledge_date
-
-        logging.info('Copying results to the DB')
+    # The joined table between the bill_sponsors and the success rates avoids an expensive join during triage experiment
+    joined_q = """
+        insert into pre_triage_features.bill_sponsor_success
+            (bill_id, sponsor_id, knowledge_date, num_bills_sponsored, num_bills_passed, success_rate)
+        select 
+            bill_id,
+            a.sponsor_id,
+            knowledge_date,
+            num_bills_sponsored,
+            num_bills_passed,
+            success_rate
+        from clean.bills join clean.bill_sponsors a using(bill_id) 
+            join pre_triage_features.temp_sponsor_success b on (a.sponsor_id=b.sponsor_id and introduced_date=b.knowledge_date)
+        where introduced_date > %(last_date)s
+        on conflict (bill_id, sponsor_id) do update set
+            knowledge_date=excluded.knowledge_date,
+            num_bills_sponsored=excluded.num_bills_sponsored,
+            num_bills_passed=excluded.num_bills_passed,
+            success_rate=excluded.success_rate
+    """
 
-        try:
-            copy_df_to_pg(
-                engine=db_conn,
-                table_name='pre_triage_features.temp_sponsor_success',
-                df=df,   
-            )
-        except (Exception, psycopg2.DatabaseError) as error:
-            logging.error(error)
-            logging.warning('Skipping as the sponsor_id, knowledge_pair already exist')
+    cursor = db_conn.cursor()
+    try:
+        logging.info('Calculating the success rates at the knowledge dates after {}'.format(last_date))
+        cursor.execute(calculation_q, {'last_date': last_date})
+        logging.info('Upserted the success rates of {} sponsor, knowledge date pairs'.format(cursor.rowcount))
 
-    logging.info('Calculated the success rates of sponsors as of {} different knowledge days'.format(len(knowledge_dates)))
+        cursor.execute(joined_q, {'last_date': last_date})
+        logging.info('Upserted {} bill, sponsor pairs to the joined table'.format(cursor.rowcount))
 
-    create_joined_table(db_conn)
+        db_conn.commit()
+    except (Exception, psycopg2.DatabaseError) as error:
+        logging.error(error)
+        db_conn.rollback()
+        raise error
 
 
 if __name__ == '__main__':
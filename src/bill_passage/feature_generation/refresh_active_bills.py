@@ -0,0 +1,90 @@
+import os
+import pandas as pd
+import logging
+import psycopg2
+
+from datetime import date, timedelta
+
+from src.utils.general import get_db_conn
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+"""
+This script refreshes the active_bills table (pre_triage_features.active_bills) after the data sync.
+The table holds the active bills as of each date, and is read by the triage cohort and label queries, the web search and the ES status updates
+through pre_triage_features.get_active_bills(as_of_date), which is read only and computes the dates that are not stored on the fly.
+The sync can change the recent dates, and the data only changes at the sync. So after a sync we recompute 
+the dates in the table from the last ACTIVE_BILLS_LOOKBACK_DAYS, and compute the dates until the next sync.
+The older dates stay as they were computed, unless a full refresh is requested (e.g. after a backfill of old sessions)
+"""
+
+ACTIVE_BILLS_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../../sql/create_active_bills_table.sql')
+
+# The stored dates in this window before today are recomputed. Matches the 60 days of activity of an active bill
+ACTIVE_BILLS_LOOKBACK_DAYS = 60
+
+# The dates from today computed ahead. The data is synced weekly
+ACTIVE_BILLS_DAYS_AHEAD = 7
+
+
+def create_active_bills_table(db_conn, script=ACTIVE_BILLS_SCRIPT):
+    """Creates the active_bills table, its functions, and the index they need on clean.bill_events. Existing tables are kept"""
+    cursor = db_conn.cursor()
+    try: 
+        with open(script, 'r') as f:
+            cursor.execute(f.read())
+        db_conn.commit()  
+    except (Exception, psycopg2.DatabaseError) as error:
+        logging.error(error)
+        db_conn.rollback()
+        raise error
+
+
+def _fetch_stored_dates(db_conn, start_date=None):
+    q = """
+        select 
+            as_of_date 
+        from pre_triage_features.active_bills_dates
+        where %(start_date)s is null or as_of_date >= %(start_date)s
+    """
+
+    return pd.read_sql(q, db_conn, params={'start_date': start_date})['as_of_date'].to_list()
+
+
+def refresh_active_bills(db_conn, today=None, lookback_days=ACTIVE_BILLS_LOOKBACK_DAYS, days_ahead=ACTIVE_BILLS_DAYS_AHEAD, full_refresh=False, as_of_dates=None):
+    """
+        Main function for refreshing the active bills after a data sync.
+        Recomputes the stored dates from the last lookback_days, and computes every date from today until days_ahead.
+        The older stored dates are kept as they are, unless full_refresh is set, which recomputes every stored date.
+        as_of_dates can add other dates to store (e.g. the as_of_dates of a triage experiment). 
+        The dates that are not stored are computed by get_active_bills when they are read, without being stored
+    """
+    create_active_bills_table(db_conn)
+
+    today = today or date.today()
+    start_date = None if full_refresh else today - timedelta(days=lookback_days)
+    stored_dates = _fetch_stored_dates(db_conn, start_date)
+    new_dates = [today + timedelta(days=i) for i in range(days_ahead + 1)] + list(as_of_dates or [])
+
+    as_of_dates = sorted(set([pd.Timestamp(x).date() for x in stored_dates + new_dates]))
+
+    logging.info('Refreshing the active bills of {} dates ({} to {})'.format(len(as_of_dates), as_of_dates[0], as_of_dates[-1]))
+
+    cursor = db_conn.cursor()
+    try: 
+        cursor.execute('select pre_triage_features.refresh_active_bills(%s::date[])', (as_of_dates,))
+        num_rows = cursor.fetchone()[0]
+        db_conn.commit()  
+    except (Exception, psycopg2.DatabaseError) as error:
+        logging.error(error)
+        db_conn.rollback()
+        raise error
+
+    logging.info('Stored {} active bill, date pairs'.format(num_rows))
+
+
+if __name__ == '__main__':
+    cred_file = '../../../conf/local/credentials.yaml'
+    db_conn=get_db_conn(cred_file)
+    refresh_active_bills(db_conn)
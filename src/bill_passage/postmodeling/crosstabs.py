@@ -5,7 +5,8 @@ import logging
 import json
 import psycopg2
 import itertools
-from scipy import stats
+import multiprocessing as mp
+from scipy import stats, sparse
 
 from triage.component.postmodeling.crosstabs import CrosstabsConfigLoader, hr_lr_ttest
 from triage.component.catwalk.storage import ProjectStorage
@@ -14,25 +15,87 @@ from psycopg2.extras import Json
 from src.utils.general import read_yaml_file, copy_df_to_pg, get_db_conn
 
 
+class BandStats:
+    def __init__(self, features, bands, n_bands):
+        """
+            Per band reductions of a feature matrix, computed with one pass of grouped sums over the rows.
+            Missing values are skipped per feature, as pandas mean/std and the t-test with nan_policy='omit' do
+
+            Args:
+                features: The feature values (np.ndarray, records x features)
+                bands: The band index of each record. -1 for the records outside the score bands
+                n_bands: Number of score bands
+        """
+        in_band = bands >= 0
+        x = features[in_band].astype(float)
+        b = bands[in_band]
+
+        # bands x records indicator. Multiplying it with the records gives the sums per band
+        indicator = sparse.csr_matrix(
+            (np.ones(b.shape[0]), (b, np.arange(b.shape[0]))),
+            shape=(n_bands, b.shape[0])
+        )
+
+        valid = ~np.isnan(x)
+        x = np.where(valid, x, 0)
+
+        self.rows = np.bincount(b, minlength=n_bands)
+        self.n = indicator @ valid.astype(float)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.means = (indicator @ x) / self.n
+
+            centered = np.where(valid, x - self.means[b], 0)
+            self.vars = (indicator @ centered ** 2) / (self.n - 1)
+
+        self.stds = np.sqrt(self.vars)
+
+
 ## The Functions that calculate the metrics for crosstabs
-bin_mean = lambda df : df.mean(axis=0) 
-bin_std = lambda df : df.std(axis=0)
-bin_n = lambda df: pd.Series(index=df.columns, data=df.shape[0])
+# A single bin metric gives the values of all the bands (bands x features) from the BandStats
+def bin_mean(s):
+    return s.means
 
-# given two likelihood bins, calculate the mean ratio
-ratio_bins = lambda l_df, r_df : l_df.mean(axis=0) / r_df.mean(axis=0)
 
+def bin_std(s):
+    return s.stds
 
-def bins_ttest(l_df, r_df):
-    """Returns the t-test (T statistic and p value), comparing the features for the records in the two bins"""
-    res = stats.ttest_ind(l_df.to_numpy(), r_df.to_numpy(), axis=0, nan_policy="omit", equal_var=False)
 
-    r0 = pd.DataFrame(res[0], index=l_df.columns)
-    r1 = pd.DataFrame(res[1], index=l_df.columns)
-    r0['metric'] = 'ttest_T'
-    r1['metric'] = 'ttest_p'
-    
-    return r0.append(r1)
+def bin_n(s):
+    return np.repeat(s.rows[:, None], s.means.shape[1], axis=1).astype(float)
+
+
+# A multi bin metric gives {metric: values (pairs x features)} for the pairs of bands (left[i], right[i])
+def ratio_bins(s, left, right):
+    """The mean ratio of the features between the two bins (left / right)"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return {'mean_ratio': s.means[left] / s.means[right]}
+
+
+def bins_ttest(s, left, right):
+    """Returns Welch's t-test (T statistic and p value), comparing the features for the records in the two bins.
+        Each unordered pair of bins is tested once. The reversed pair has the negative T and the same p value
+    """
+    n_bands = s.means.shape[0]
+    low, high = np.minimum(left, right), np.maximum(left, right)
+    pairs, pair_idx = np.unique(low * n_bands + high, return_inverse=True)
+    l, r = pairs // n_bands, pairs % n_bands
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        l_se = s.vars[l] / s.n[l]
+        r_se = s.vars[r] / s.n[r]
+        se = l_se + r_se
+
+        t = (s.means[l] - s.means[r]) / np.sqrt(se)
+        dof = se ** 2 / (l_se ** 2 / (s.n[l] - 1) + r_se ** 2 / (s.n[r] - 1))
+        p = 2 * stats.t.sf(np.abs(t), dof)
+
+    sign = np.where(left <= right, 1, -1)[:, None]
+
+    return {
+        'ttest_T': t[pair_idx] * sign,
+        'ttest_p': p[pair_idx]
+    }
 
 
 single_bin_metrics = {
@@ -46,8 +109,114 @@ multi_bin_metrics = {
     'ttest':  bins_ttest
 }
 
+# How the bins of a pair are written in related_likelihood_bins. The mean ratio indicates the numerator and the denominator
+multi_bin_separators = {
+    'mean_ratio': '/',
+    'ttest': ', '
+}
+
 index_columns = ['entity_id', 'as_of_date']
 
+result_columns = ['model_id', 'train_end_time', 'metric', 'related_likelihood_bins', 'feature_name', 'value']
+
+
+def score_band_edges(score_bands):
+    """ The sorted edges of the score bands, and the band of each interval between consecutive edges (-1 for the gaps)
+        The bands are [lower_limit, upper_limit), and can not overlap
+    """
+    limits = np.array([limits for limits in score_bands.values()], dtype=float)
+    edges = np.unique(limits.ravel())
+
+    interval_bands = np.full(edges.shape[0] - 1, -1)
+    for i, (lower_lim, upper_lim) in enumerate(limits):
+        covered = (edges[:-1] >= lower_lim) & (edges[1:] <= upper_lim)
+
+        if (interval_bands[covered] >= 0).any():
+            raise ValueError('The score bands overlap: {}'.format(score_bands))
+
+        interval_bands[covered] = i
+
+    return edges, interval_bands
+
+
+def assign_score_bands(scores, edges, interval_bands):
+    """ The band index of each score (-1 if the score is not in a band, or missing)"""
+    # digitize gives i for edges[i-1] <= score < edges[i]
+    intervals = np.digitize(scores, edges) - 1
+    inside = (intervals >= 0) & (intervals < interval_bands.shape[0])
+
+    bands = np.full(scores.shape[0], -1)
+    bands[inside] = interval_bands[intervals[inside]]
+
+    return bands
+
+
+def _long_frame(values, bins_labels, metric, feature_names):
+    """ values (bins x features) as rows of feature_name, value, metric, related_likelihood_bins"""
+    return pd.DataFrame({
+        'feature_name': np.tile(feature_names, len(bins_labels)),
+        'value': values.ravel(),
+        'metric': metric,
+        'related_likelihood_bins': np.repeat(bins_labels, len(feature_names))
+    })
+
+
+def crosstabs_scores(features, feature_names, scores, score_bands, single_bin_metrics=None, multi_bin_metrics=None):
+    """ crosstabs of one model, from the feature values of the test matrix and the scores of the model
+        Args:
+            features (np.ndarray): The feature values (records x features)
+            feature_names (List[str]): The names of the feature columns
+            scores (np.ndarray): The score of each record. nan for the records without a prediction
+            score_bands (dict): {label: [lower_limit, upper_limit]}
+            single_bin_metrics (Dict['metric_name': function]): Metrics to be calculated on a single bin.
+                The function gives the values of all the bins from the BandStats
+            multi_bin_metrics (Dict['metric_name': function]): Metrics to be calculated between two bins.
+                The function gives {metric: values} for the pairs of bins. The metric name sets the separator of the bin labels (multi_bin_separators)
+
+        Return:
+            A DataFrame with the columns feature_name, value, metric, related_likelihood_bins
+    """
+    band_labels = list(score_bands.keys())
+    edges, interval_bands = score_band_edges(score_bands)
+    bands = assign_score_bands(scores, edges, interval_bands)
+
+    logging.info('Records per likelihood bin -- {}'.format(
+        dict(zip(band_labels, np.bincount(bands[bands >= 0], minlength=len(band_labels))))
+    ))
+
+    feature_stats = BandStats(features, bands, len(band_labels))
+
+    results = list()
+
+    if single_bin_metrics:
+        # The single bin metrics are reported for the scores too
+        score_stats = BandStats(scores[:, None], bands, len(band_labels))
+        names = list(feature_names) + ['score']
+
+        for metric_name, func in single_bin_metrics.items():
+            values = np.hstack([func(feature_stats), func(score_stats)])
+            results.append(_long_frame(values, band_labels, metric_name, names))
+
+    if multi_bin_metrics:
+        # we calculate multi bin metrics for all possible ratios between bins 
+        bin_pairs = list(itertools.permutations(range(len(band_labels)), 2))
+        left = np.array([x[0] for x in bin_pairs], dtype=int)
+        right = np.array([x[1] for x in bin_pairs], dtype=int)
+
+        for metric_name, func in multi_bin_metrics.items():
+            pair_labels = [
+                multi_bin_separators[metric_name].join((band_labels[l], band_labels[r])) for l, r in bin_pairs
+            ]
+
+            for name, values in func(feature_stats, left, right).items():
+                results.append(_long_frame(values, pair_labels, name, feature_names))
+
+    results = pd.concat(results, ignore_index=True)
+    results['value'] = results['value'].fillna(0)
+
+    return results
+
+
 def _fetch_model_matrix_info(db_engine, model_ids):
     """ For the given experiment and model groups, fetch the model_ids, and match them with their train/test matrix pairs 
         Args:
@@ -81,113 +250,142 @@ def _fetch_model_matrix_info(db_engine, model_ids):
     return pd.read_sql(q, db_engine)
 
 
-def crosstabs_model(engine, model_id, matrix_store, score_bands, single_bin_metrics=None, multi_bin_metrics=None):
-    """ run crosstabs for one model
-        Args:
-            engine (psycopg2 engine): database engine
-            model_id (int): The id of the trained model
-            matrix_store (catwalk.storage.MatrixStore): The wrapper for the test matrix
-            single_bin_metrics (Dict['metric_name': function]): Metrics to be calculated on a single bin
-                A dictionary mapping the metric names and the function definitions to calc the metric
-            multi_bin_metrics: Metrics to be calculated between multiple bins (currently only two).
-                A dictionary metric names and the function definitions to calc the metric.
-                At least one type of metrics need to be provided
-    """
+def _load_test_matrix(matrix_store):
+    """ The test matrix indexed by entity_id and as_of_date"""
+    matrix = matrix_store.matrix_label_tuple[0]
+
+    if not set(index_columns).issubset(matrix.index.names):
+        matrix = matrix.set_index(index_columns)
+
+    matrix.index = pd.MultiIndex.from_arrays(
+        [matrix.index.get_level_values('entity_id'), pd.to_datetime(matrix.index.get_level_values('as_of_date'))],
+        names=index_columns
+    )
+
+    return matrix
 
-    if single_bin_metrics is None and multi_bin_metrics is None:
-        raise ValueError('At least one type of metric need to be specified') 
 
-    # fetch predictions
+def _fetch_model_scores(engine, model_ids, matrix_index):
+    """ The scores of the models for the records of the test matrix (records x models). nan if a record has no prediction"""
     q = """
         select
+            model_id,
             entity_id, 
             as_of_date,
             score
         from test_results.predictions
-        where model_id = {}
-    """.format(model_id)
+        where model_id = any(%(model_ids)s)
+    """
 
-    predictions = pd.read_sql(q, engine)
+    predictions = pd.read_sql(q, engine, params={'model_ids': [int(x) for x in model_ids]})
+    predictions['as_of_date'] = pd.to_datetime(predictions['as_of_date'])
 
-    # Loading the matrix
-    matrix = matrix_store.matrix_label_tuple[0]
-    matrix = matrix.merge(predictions, on=['entity_id', 'as_of_date'])
-    matrix.set_index(index_columns, inplace=True)
+    scores = predictions.pivot_table(index=index_columns, columns='model_id', values='score', aggfunc='first')
 
-    # splitting the matrix into the score bands and assigning records to a scoreband dataframe
-    # {'likelihood_bin_label': dataframe}
-    dfs_for_bins = dict()
+    return scores.reindex(index=matrix_index, columns=list(model_ids))
 
-    # The dataframe that holds the results for both single bin and multi bin metrics we calculate
-    results = pd.DataFrame()
 
-    for band_label, limits in score_bands.items():
-        # Limits of the score band / likelihood bins
-        lower_lim = limits[0]
-        upper_lim = limits[1]
+# The test matrix shared by the crosstabs workers. Set by the pool initializer
+_worker_matrix = dict()
 
-        msk = (matrix['score'] >= lower_lim) & (matrix['score'] < upper_lim)
-        df = matrix[msk]
 
-        # We only need the feature data for the calculations
-        dfs_for_bins[band_label] = df.drop('score', axis='columns')
+def _init_crosstabs_worker(features, feature_names, score_bands, single_bin_metrics, multi_bin_metrics):
+    _worker_matrix.update(
+        features=features,
+        feature_names=feature_names,
+        score_bands=score_bands,
+        single_bin_metrics=single_bin_metrics,
+        multi_bin_metrics=multi_bin_metrics
+    )
 
-        # we can calculate the single bin metrics here
-        for metric_name, func in single_bin_metrics.items():
-            logging.info('Calculating {} for likelihood bin -- {}'.format(metric_name, band_label))
-            
-            this_result = pd.DataFrame(func(df)).reset_index()
-            this_result.fillna(0, inplace=True)
-            this_result.columns = ['feature_name', 'value']
-            
-            this_result['metric'] = metric_name
-            this_result['related_likelihood_bins'] = band_label
 
-            results = results.append(this_result, ignore_index=True)
+def _crosstabs_worker(args):
+    model_id, scores = args
 
+    return model_id, crosstabs_scores(scores=scores, **_worker_matrix)
 
-    # we calculate multi bin metrics for all possible ratios between bins 
-    for bin_pair in itertools.permutations(score_bands.keys(), 2):
 
-        # left / right
-        left_df = dfs_for_bins[bin_pair[0]]
-        right_df = dfs_for_bins[bin_pair[1]]
-        
-        for metric_name, func in multi_bin_metrics.items():
-            logging.info('Calculating {} for likelihood bins -- {}'.format(metric_name, bin_pair))
-            this_result = pd.DataFrame(func(left_df, right_df)).reset_index()
-            this_result.fillna(0, inplace=True)
+def crosstabs_matrix(engine, model_ids, matrix_store, score_bands, single_bin_metrics=None, multi_bin_metrics=None, n_jobs=1):
+    """ run crosstabs for the models that share a test matrix. The matrix and the predictions of the models are loaded once
+        Args:
+            engine (psycopg2 engine): database engine
+            model_ids (List[int]): The ids of the trained models, predicting on the matrix
+            matrix_store (catwalk.storage.MatrixStore): The wrapper for the test matrix
+            score_bands (dict): {label: [lower_limit, upper_limit]}
+            single_bin_metrics (Dict['metric_name': function]): Metrics to be calculated on a single bin
+            multi_bin_metrics (Dict['metric_name': function]): Metrics to be calculated between two bins.
+                The functions are sent to the worker processes, so they should be module level functions (not lambdas)
+            n_jobs (int): Number of processes computing the models in parallel. -1 uses all the cores.
+                Each process receives a copy of the feature values
 
-            # The ttest function returns the p-value and the t-stat, so we handle it differently
-            # NOTE -- This is a crude way of preserving structure. Maybe there's a better way
-            if metric_name == 'ttest':
-                this_result.columns = ['feature_name', 'value', 'metric']
-                this_result['related_likelihood_bins'] = ', '.join(bin_pair)
-            else:
-                this_result.columns = ['feature_name', 'value']
-                this_result['metric'] = metric_name
+        Return:
+            {model_id: results DataFrame}
+    """
+    if single_bin_metrics is None and multi_bin_metrics is None:
+        raise ValueError('At least one type of metric need to be specified') 
 
-                # The other metric is a mean ratio, so indicating the numerator and the denominator
-                this_result['related_likelihood_bins'] = '/'.join(bin_pair)
+    matrix = _load_test_matrix(matrix_store)
+    scores = _fetch_model_scores(engine, model_ids, matrix.index)
 
-            results = results.append(this_result, ignore_index=True)
+    worker_args = (
+        matrix.to_numpy(dtype=float), 
+        list(matrix.columns), 
+        score_bands, 
+        single_bin_metrics, 
+        multi_bin_metrics
+    )
+    tasks = [(model_id, scores[model_id].to_numpy(dtype=float)) for model_id in model_ids]
 
-    return results
+    if (n_jobs > mp.cpu_count()) or n_jobs == -1:
+        n_jobs = mp.cpu_count()
+    n_jobs = max(min(n_jobs, len(tasks)), 1)
 
+    logging.info('Calculating crosstabs of {} models on a {} x {} matrix with {} processes'.format(
+        len(tasks), matrix.shape[0], matrix.shape[1], n_jobs
+    ))
 
-def run_crosstabs(engine, crosstabs_config, single_bin_metrics=None, multi_bin_metrics=None):
-    """run crosstabs for the given set of models
+    if n_jobs == 1:
+        _init_crosstabs_worker(*worker_args)
+        return dict([_crosstabs_worker(x) for x in tasks])
+
+    with mp.Pool(processes=n_jobs, initializer=_init_crosstabs_worker, initargs=worker_args) as pool:
+        return dict(pool.imap_unordered(_crosstabs_worker, tasks))
+
+
+def crosstabs_model(engine, model_id, matrix_store, score_bands, single_bin_metrics=None, multi_bin_metrics=None):
+    """ run crosstabs for one model
+        Args:
+            engine (psycopg2 engine): database engine
+            model_id (int): The id of the trained model
+            matrix_store (catwalk.storage.MatrixStore): The wrapper for the test matrix
+            single_bin_metrics (Dict['metric_name': function]): Metrics to be calculated on a single bin
+            multi_bin_metrics (Dict['metric_name': function]): Metrics to be calculated between multiple bins (currently only two).
+                At least one type of metrics need to be provided
+    """
+    return crosstabs_matrix(
+        engine=engine,
+        model_ids=[model_id],
+        matrix_store=matrix_store,
+        score_bands=score_bands,
+        single_bin_metrics=single_bin_metrics,
+        multi_bin_metrics=multi_bin_metrics
+    )[model_id]
+
+
+def run_crosstabs(engine, crosstabs_config, single_bin_metrics=None, multi_bin_metrics=None, n_jobs=1):
+    """run crosstabs for the given set of models. 
+        The models are grouped by their test matrix, so each matrix is loaded once, and the results of a matrix are written with one COPY.
+        Re-running replaces the results of the models
         Args:
             engine: 
             crosstabs_config:
-            score_bands (dict): A dictionary that maps the bin label to the score threshlods of the bin.
+                The score bands (thresholds['score_bins']) map the bin label to the score threshlods of the bin.
                 The key is the bin label, and the value is an array of two elements -- the lower limit and the upper limit.
                 {label: [lower_limit, upper_limit]}
             single_bin_metrics (Dict['metric_name': function]): Metrics to be calculated on a single bin
-                A dictionary mapping the metric names and the function definitions to calc the metric
-            multi_bin_metrics: Metrics to be calculated between multiple bins (currently only two).
-                A dictionary metric names and the function definitions to calc the metric.
+            multi_bin_metrics (Dict['metric_name': function]): Metrics to be calculated between multiple bins (currently only two).
                 At least one type of metric need to be provided
+            n_jobs (int): Number of processes computing the models of a matrix in parallel
     """
 
     if single_bin_metrics is None and multi_bin_metrics is None:
@@ -205,31 +403,36 @@ def run_crosstabs(engine, crosstabs_config, single_bin_metrics=None, multi_bin_m
     score_bands = crosstabs_config.thresholds['score_bins']
     matrix_storage_engine = ProjectStorage(crosstabs_config.project_path).matrix_storage_engine() 
 
-    for row in model_info.itertuples(index=False):
-        matrix_store = matrix_storage_engine.get_store(matrix_uuid=row.test_matrix_uuid)
-        
-        res = crosstabs_model(
+    for test_matrix_uuid, models in model_info.groupby('test_matrix_uuid'):
+        matrix_store = matrix_storage_engine.get_store(matrix_uuid=test_matrix_uuid)
+        model_ids = [int(x) for x in models['model_id'].unique()]
+        train_end_times = models.groupby('model_id')['train_end_time'].first()
+
+        logging.info('Calculating crosstabs for the models {} on the test matrix {}'.format(model_ids, test_matrix_uuid))
+        model_results = crosstabs_matrix(
             engine=engine,
-            model_id=row.model_id,
+            model_ids=model_ids,
             matrix_store=matrix_store,
             score_bands=score_bands,
             single_bin_metrics=single_bin_metrics,
-            multi_bin_metrics=multi_bin_metrics
+            multi_bin_metrics=multi_bin_metrics,
+            n_jobs=n_jobs
         )        
 
-        res['model_id'] = row.model_id
-        res['train_end_time'] = row.train_end_time
+        res = list()
+        for model_id, df in model_results.items():
+            df['model_id'] = model_id
+            df['train_end_time'] = train_end_times[model_id]
+            res.append(df)
 
         logging.info('Writing crosstab results to DB')
-        try:
-            copy_df_to_pg(
-                engine=engine,
-                table_name=table_name,
-                df=res,
-            )
-        except (Exception, psycopg2.DatabaseError) as error:
-            logging.error(error)
-            raise psycopg2.DatabaseError(error)             
+        copy_df_to_pg(
+            engine=engine,
+            table_name=table_name,
+            df=pd.concat(res, ignore_index=True),
+            columns_to_write=result_columns,
+            replace_where={'model_id': model_ids}
+        )
 
     logging.info('Crosstabs calculation sucessfully completed!')
 
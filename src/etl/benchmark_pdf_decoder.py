@@ -0,0 +1,137 @@
+import os
+import sys
+import time
+import logging
+import multiprocessing as mp
+
+from pdfreader import PDFDocument, SimplePDFViewer
+
+from src.utils.decoders import pdf_decoder, _extract_strings_per_page, PDF_PAGES_PER_TASK
+from src.utils import project_constants as constants
+
+logging.basicConfig(level=logging.INFO, filename="../../logs/benchmark_pdf_decoder.DEBUG", filemode='w')
+logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
+
+"""
+    Compares the single pass pdf decoder in utils.decoders against the previous implementation
+    (parse the document to count the pages, then parse it again to render the pages one by one).
+
+    The fixture corpus is a folder of bill pdfs (e.g. pdfs downloaded from state_link of a few long and short bills).
+    For each implementation, we report the pages/second over the corpus and whether the text matches the previous implementation.
+    The pool only splits the documents longer than PDF_PAGES_PER_TASK pages, so the pages/second on those documents are reported separately,
+    to compare the split against decoding them in a single process.
+
+    usage: python benchmark_pdf_decoder.py [fixture_folder] [n_jobs]
+"""
+
+fixture_folder = os.path.join(constants.PROJECT_FOLDER, 'pdf_decoder_fixtures')
+
+
+def _reference_pdf_decoder(base64_decoded):
+    """The pdf decoder before the single pass implementation. Kept as the baseline of the benchmark"""
+    try:
+        pdf_doc = PDFDocument(base64_decoded)
+    except Exception:
+        return ''
+
+    all_pages = len([p for p in pdf_doc.pages()])
+
+    viewer = SimplePDFViewer(base64_decoded)
+    content = []
+
+    for page in range(1, (all_pages + 1)):
+        content.append(_extract_strings_per_page(page, viewer))
+
+    return " ".join(content)
+
+
+def _count_pages(pdf_content):
+    try:
+        return len([p for p in PDFDocument(pdf_content).pages()])
+    except Exception:
+        return 0
+
+
+def benchmark_pdf_decoder(fixture_folder, n_jobs=4):
+    """
+    Decode every pdf in the fixture folder with the reference decoder, the single pass decoder,
+    and the single pass decoder splitting the pages across a pool of n_jobs processes
+
+    Returns:
+        Dictionary with the number of pages, seconds, pages/second and the number of mismatching documents of each implementation.
+        The split_* entries are the same numbers over the documents that are long enough to be split across the pool
+    """
+    pdf_files = sorted([x for x in os.listdir(fixture_folder) if x.lower().endswith('.pdf')])
+
+    if len(pdf_files) == 0:
+        raise FileNotFoundError('There are no pdf files in {}'.format(fixture_folder))
+
+    logging.info('Benchmarking with {} pdfs from {}'.format(len(pdf_files), fixture_folder))
+
+    implementations = {
+        'reference': lambda x, pool: _reference_pdf_decoder(x),
+        'single_pass': lambda x, pool: pdf_decoder(x),
+        'single_pass_pool': lambda x, pool: pdf_decoder(x, pool=pool)
+    }
+
+    results = {
+        name: {'pages': 0, 'seconds': 0.0, 'split_pages': 0, 'split_seconds': 0.0, 'mismatches': []} 
+        for name in implementations.keys()
+    }
+
+    with mp.Pool(processes=n_jobs) as pool:
+        for fname in pdf_files:
+            with open(os.path.join(fixture_folder, fname), 'rb') as f:
+                pdf_content = f.read()
+
+            num_pages = _count_pages(pdf_content)
+            reference_text = None
+
+            for name, decoder in implementations.items():
+                start = time.time()
+                text = decoder(pdf_content, pool)
+                seconds = time.time() - start
+
+                if reference_text is None:
+                    reference_text = text
+                elif text != reference_text:
+                    results[name]['mismatches'].append(fname)
+
+                results[name]['pages'] = results[name]['pages'] + num_pages
+                results[name]['seconds'] = results[name]['seconds'] + seconds
+
+                if num_pages > PDF_PAGES_PER_TASK:
+                    results[name]['split_pages'] = results[name]['split_pages'] + num_pages
+                    results[name]['split_seconds'] = results[name]['split_seconds'] + seconds
+
+                logging.debug('{}: {} ({} pages) in {:.2f} s'.format(name, fname, num_pages, seconds))
+
+    for name, res in results.items():
+        res['pages_per_second'] = res['pages'] / res['seconds'] if res['seconds'] > 0 else float('nan')
+        res['split_pages_per_second'] = res['split_pages'] / res['split_seconds'] if res['split_seconds'] > 0 else float('nan')
+
+        logging.info('{}: {} pages in {:.2f} s -- {:.1f} pages/s. {} documents with text different from the reference'.format(
+            name, res['pages'], res['seconds'], res['pages_per_second'], len(res['mismatches'])
+        ))
+        logging.info('{}: documents longer than {} pages -- {} pages in {:.2f} s -- {:.1f} pages/s'.format(
+            name, PDF_PAGES_PER_TASK, res['split_pages'], res['split_seconds'], res['split_pages_per_second']
+        ))
+
+        if res['mismatches']:
+            logging.warning('{}: mismatching documents {}'.format(name, res['mismatches']))
+
+    speedup = results['reference']['seconds'] / results['single_pass']['seconds'] if results['single_pass']['seconds'] > 0 else float('nan')
+    logging.info('The single pass decoder is {:.1f}x the speed of the reference decoder'.format(speedup))
+
+    pool_seconds = results['single_pass_pool']['split_seconds']
+    pool_speedup = results['single_pass']['split_seconds'] / pool_seconds if pool_seconds > 0 else float('nan')
+    logging.info('On the documents split across {} processes, the pool is {:.1f}x the speed of the single pass decoder'.format(n_jobs, pool_speedup))
+
+    return results
+
+
+if __name__ == '__main__':
+    folder = sys.argv[1] if len(sys.argv) > 1 else fixture_folder
+    n_jobs = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+    benchmark_pdf_decoder(folder, n_jobs)
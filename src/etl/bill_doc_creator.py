@@ -1,15 +1,13 @@
 import json
 import logging
 import tempfile
-import base64
 import multiprocessing as mp
 
 from zipfile import ZipFile
 
-from src.utils.decoders import html_decoder, pdf_decoder
+from src.utils.decoders import get_decoder
 from src.utils import project_constants as constants
 
-
 def parse_session_zip_file(zip_file_content, s3, s3_target):
     """ Parse a zip file of a session
         Returns a list of dictionaries where each entry is a bill.
@@ -92,15 +90,11 @@ def parse_session_zip_file(zip_file_content, s3, s3_target):
 
 
 def _decode_bill_doc_content(base64_eoncoded_text, mime_id):
-    decoded_text = base64.b64decode(base64_eoncoded_text, validate=True)
-    
-    bill_text=''
-    if mime_id == 1:
-        bill_text = html_decoder(decoded_text)
-    elif mime_id == 2:
-        bill_text = pdf_decoder(decoded_text)
-    else:
-        logging.warning('A decoder is not defined for mime_id {}'.format(mime_id))
+    # Decoded bill texts are cached on disk, so the same document is never decoded twice
+    bill_text = get_decoder().decode(base64_eoncoded_text, mime_id)
+
+    if bill_text is None:
         logging.warning('Returning empty string')
+        bill_text = ''
         
-    return bill_text
\ No newline at end of file
+    return bill_text
@@ -2,10 +2,8 @@ import os
 import sys
 import json
 import logging
-import multiprocessing as mp
-import base64
 
-from src.utils.decoders import html_decoder, pdf_decoder
+from src.utils.decoders import get_decoder
 from src.utils import project_constants as constants
 
 logging.basicConfig(level=logging.INFO, filename="../../logs/decode_bills_2021_dump.DEBUG", filemode='w')
@@ -26,28 +24,14 @@ def _get_subdir(dir_path):
     return subdir
 
 
-def _decode_bill_doc_content(base64_eoncoded_text, mime_id):
-    decoded_text = base64.b64decode(base64_eoncoded_text, validate=True)
-    
-    bill_text=None
-    if mime_id == 1:
-        bill_text = html_decoder(decoded_text)
-    elif mime_id == 2:
-        bill_text = pdf_decoder(decoded_text)
-    else:
-        logging.warning('A decoder is not defined for mime_id {}'.format(mime_id))
-        logging.warning('Returning None')
-        
-    return bill_text
-
+# Number of text files loaded into memory and handed to the decoder at a time
+FILES_PER_CHUNK = 200
 
-def _subprocess_target(text_files_list, text_path):
-    """Decodes a given list of text file"""
 
-    process_name = mp.current_process().name
-
-    logging.info('{}:Decoding {} documents'.format(process_name, len(text_files_list)))
+def _decode_text_files(decoder, text_files_list, text_path):
+    """Decodes a given list of text files using the decoder's process pool and writes the decoded text back to the files"""
 
+    contents = dict()
     for txt in text_files_list:
         with open(os.path.join(text_path, txt)) as txt_fp:
             content = json.load(txt_fp)
@@ -61,77 +45,50 @@ def _subprocess_target(text_files_list, text_path):
             ))
             continue
 
-        encoded_text = txt_content.get('doc')
-        mime_id = txt_content.get('mime_id')
-
-        if encoded_text is not None:
-            decoded_txt = _decode_bill_doc_content(encoded_text, mime_id)
-            txt_content['doc_decoded'] = decoded_txt
-            content['text'] = txt_content
-            
-            with open(os.path.join(text_path, txt), 'w') as txt_fp:
-                json.dump(content, txt_fp)
-
-
-def decode_texts(data_dump_path, n_jobs=-1):
-    states = _get_subdir(data_dump_path)
-
-    for state in states:
-        tpth = os.path.join(data_dump_path, state)
-
-        # Each session has a sub directory
-        sessions = _get_subdir(tpth)
-
-        for session in sessions:
-            logging.info('Processing state {}, session {}'.format(state, session))
-            tpth2 = os.path.join(tpth, session)
-
-            text_path = os.path.join(tpth2, 'text')
-            text_files = os.listdir(text_path) if os.path.isdir(text_path) else []
+        if txt_content.get('doc') is not None:
+            contents[txt] = content
 
-            num_files = len(text_files)
+    decoded = decoder.decode_many([(x['text']['doc'], x['text']['mime_id']) for x in contents.values()])
 
-            # Parallelizing the decoding process
-            if (n_jobs > mp.cpu_count()) or n_jobs==-1:
-                n_jobs = mp.cpu_count()
-            
-            # Assigning jobs
-            chunk_size, mod = divmod(num_files, n_jobs)
-            chunks_list = [chunk_size] * n_jobs
-
-            # Distributing the remainder
-            for i in range(mod):
-                chunks_list[i] = chunks_list[i] + 1 
+    for (txt, content), decoded_txt in zip(contents.items(), decoded):
+        content['text']['doc_decoded'] = decoded_txt
+        
+        with open(os.path.join(text_path, txt), 'w') as txt_fp:
+            json.dump(content, txt_fp)
 
-            logging.info('Job assignments : {}'.format(chunks_list))
 
-            # Multiprocessing
-            # manager = mp.Manager()
+def decode_texts(data_dump_path, n_jobs=-1, cache_dir=constants.DECODED_TEXT_CACHE):
+    """
+    Decode the bill texts of all the sessions in the dump. 
+    One pool of processes is used for the whole dump. Documents that were decoded before (in this or an earlier dump) are read from the cache
+    """
+    states = _get_subdir(data_dump_path)
 
-            idx_cursor = 0
-            jobs = []
+    decoder = get_decoder(n_jobs=n_jobs, cache_dir=cache_dir)
+    try:
+        for state in states:
+            tpth = os.path.join(data_dump_path, state)
 
-            for i, chunk_size in enumerate(chunks_list):
-                p = mp.Process(
-                    name=f'p{i}',
-                    target=_subprocess_target,
-                    kwargs={
-                        'text_files_list': text_files[idx_cursor:(idx_cursor+chunk_size)],
-                        'text_path': text_path,
-                    }
-                )
+            # Each session has a sub directory
+            sessions = _get_subdir(tpth)
 
-                jobs.append(p)
-                p.start()
+            for session in sessions:
+                logging.info('Processing state {}, session {}'.format(state, session))
+                tpth2 = os.path.join(tpth, session)
 
-                idx_cursor = idx_cursor + chunk_size 
-    
-            for proc in jobs:
-                proc.join()
+                text_path = os.path.join(tpth2, 'text')
+                text_files = os.listdir(text_path) if os.path.isdir(text_path) else []
 
+                logging.info('Decoding {} documents across {} processes'.format(len(text_files), decoder.n_jobs))
 
-        logging.info('Successfully completed decoding bills in state {}'.format(state))
+                for i in range(0, len(text_files), FILES_PER_CHUNK):
+                    _decode_text_files(decoder, text_files[i:(i + FILES_PER_CHUNK)], text_path)
 
+            logging.info('Successfully completed decoding bills in state {}'.format(state))
+            decoder.log_metrics()
+    finally:
+        # The pool is created again if the decoder is used after this
+        decoder.close()
 
 
 if __name__ == '__main__':
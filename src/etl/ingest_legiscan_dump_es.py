@@ -2,12 +2,15 @@ import os
 import sys
 import logging
 import json
+import time
+import hashlib
 import boto3
 import subprocess
 import random
 import multiprocessing as mp
 
-from elasticsearch import Elasticsearch
+from functools import partial
+from elasticsearch import Elasticsearch, helpers
 from datetime import datetime
 
 import src.utils.project_constants as constants
@@ -52,6 +55,22 @@ DEFAULT_DATE = '1970-01-01'
 # We can't use this in elasticsearch. THerefore, we replace this with the DEFAULT DATE GIVEN above
 LEGISCAN_PLACEHOLDER_DATE = '0000-00-00'
 
+# Defaults for the _bulk requests used in the bulk ingestion mode
+# A request is sent when either the number of docs or the size reaches the limit
+# Decoded bill texts can be large, so the byte limit is what usually kicks in for the bill_text index
+BULK_CHUNK_SIZE = 500
+BULK_MAX_CHUNK_BYTES = 50 * 1024 * 1024
+
+# Number of times a chunk is retried when elasticsearch rejects it with a 429 (queue is full)
+BULK_MAX_RETRIES = 3
+
+# The index each type of file in the dump is stored in
+INDEX_NAMES = {
+    'bill': 'bill_meta',
+    'text': 'bill_text',
+    'people': 'session_people'
+}
+
 def _get_subdir(dir_path):
     """In a given directory, return all the immediate subdirectories"""
 
@@ -63,173 +82,612 @@ def _get_subdir(dir_path):
     return subdir
 
 
-def _distribute_jobs(num_files, n_jobs):
-    """Given a number of tasks divide it across processes"""
+def _get_session_id(bills_path, bills_files):
+    """The people json files don't contain the session_id. We can find it in any bill json of the session"""
+    if len(bills_files) == 0:
+        return None
 
-    # Parallelizing the decoding process
-    if (n_jobs > mp.cpu_count()) or n_jobs==-1:
-        n_jobs = mp.cpu_count()
+    b = os.path.join(bills_path, bills_files[0])
+    with open(b) as bfp:
+        session_id = json.load(bfp)['bill']['session_id']
 
-    chunk_size, mod = divmod(num_files, n_jobs)
-    chunks_list = [chunk_size] * n_jobs
+    return session_id
 
-    # Distributing the remainder
-    for i in range(mod):
-        chunks_list[i] = chunks_list[i] + 1
-    
-    return chunks_list
 
+def _file_hash(fp):
+    """md5 hash of the content of a file"""
+    hash_object = hashlib.md5()
+
+    with open(fp, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            hash_object.update(block)
+
+    return hash_object.hexdigest()
+
+
+def _manifest_key(state, session, kind, file_name):
+    """Files are identified in the manifest by their path relative to the dump folder. 
+        This way, manifests of different dumps can be compared
+    """
+    return '{}/{}/{}/{}'.format(state, session, kind, file_name)
+
+
+def load_manifest(manifest_path):
+    """
+    Load the ingestion manifest. 
+    The manifest is a json-lines file with one record per ingested file. If a file appears more than once, the last record is used
+
+    Returns:
+        Dictionary of the manifest records, keyed by the path of the file relative to the dump folder
+    """
+    manifest = dict()
+
+    if (manifest_path is None) or (not os.path.isfile(manifest_path)):
+        return manifest
+
+    with open(manifest_path) as f:
+        for line in f:
+            # A crash could leave a partially written line at the end
+            try:
+                record = json.loads(line)
+            except ValueError:
+                logging.warning('Skipping a malformed line in the manifest {}'.format(manifest_path))
+                continue
+
+            key = _manifest_key(record['state'], record['session'], record['kind'], record['file'])
+            manifest[key] = record
+
+    return manifest
+
+
+def _append_to_manifest(manifest_fp, records):
+    """Write the records of a completed batch to the manifest and flush, so that the checkpoint survives a crash"""
+    for record in records:
+        manifest_fp.write(json.dumps(record) + '\n')
+
+    manifest_fp.flush()
+    os.fsync(manifest_fp.fileno())
+
+
+def _create_work_batches(processed_data_dump_path, files_per_batch, bytes_per_batch, completed_files=None, previous_hashes=None):
+    """
+    Walk the dump and create the work queue for the ingestion.
+    Every (state, session, file) in the dump is assigned to a batch. A batch only contains files of the same session and type (bill, text, people)
+    and is capped by the number of files and the total file size, so that a batch costs roughly the same regardless of the session it belongs to.
+
+    Args:
+        processed_data_dump_path (str): The folder where the dump is located
+        files_per_batch (int): Max number of files in a batch
+        bytes_per_batch (int): Max total size of the files in a batch
+        completed_files (Set[str]): Manifest keys of the files that were already ingested. These are not added to the queue
+        previous_hashes (Dict[str, str]): Content hashes of the files in the previously ingested dump, keyed by the manifest key. 
+            Attached to the batches, so that the workers can skip the files that haven't changed
+
+    Returns:
+        List of batches (dicts), sorted by size (largest first)
+    """
+    completed_files = completed_files or set()
+    previous_hashes = previous_hashes or dict()
+
+    states = _get_subdir(processed_data_dump_path)  
+    logging.info('Processing states in this order: {}'.format(states))
+
+    batches = list()
+    for state in states:
+        tpth = os.path.join(processed_data_dump_path, state)
+
+        # Each session has a sub directory
+        for session in _get_subdir(tpth):
+            tpth2 = os.path.join(tpth, session)
+            session_id = None
+
+            for kind in ['bill', 'text', 'people']:
+                folder_path = os.path.join(tpth2, kind)
+                files = os.listdir(folder_path) if os.path.isdir(folder_path) else []
+
+                if kind == 'text':
+                    files = [x for x in files if x.endswith('.json')]
+
+                if kind == 'bill':
+                    session_id = _get_session_id(folder_path, files)
+
+                if (kind == 'people') and (session_id is None) and (len(files) > 0):
+                    logging.warning('Could not find the session_id of state {}, session {}. Skipping {} people files'.format(state, session, len(files)))
+                    continue
+
+                batch = None
+                for f in files:
+                    key = _manifest_key(state, session, kind, f)
+                    if key in completed_files:
+                        continue
+
+                    fsize = os.path.getsize(os.path.join(folder_path, f))
+
+                    if (batch is None) or (len(batch['files']) >= files_per_batch) or (batch['bytes'] + fsize > bytes_per_batch):
+                        batch = {
+                            'state': state,
+                            'session': session,
+                            'session_id': session_id,
+                            'kind': kind,
+                            'folder_path': folder_path,
+                            'files': [],
+                            'previous_hashes': {},
+                            'bytes': 0
+                        }
+                        batches.append(batch)
+
+                    batch['files'].append(f)
+                    batch['bytes'] = batch['bytes'] + fsize
+
+                    if key in previous_hashes:
+                        batch['previous_hashes'][f] = previous_hashes[key]
+
+    # Handing out the largest batches first so that the pool doesn't wait on a large straggler at the end 
+    batches = sorted(batches, key=lambda x: x['bytes'], reverse=True)
+
+    return batches
+
+
+# Each worker process of the ingestion pool owns one elasticsearch client, which is reused across batches
+_worker_es_conn = None
+
+
+def _init_worker(creds_file):
+    """Initializer of the ingestion pool. Creates the elasticsearch client of the worker"""
+    global _worker_es_conn
+    _worker_es_conn = get_elasticsearch_conn(creds_file)
+
+
+def _ingest_batch(batch, bulk, chunk_size, max_chunk_bytes):
+    """
+    Index one batch of files from the work queue using the elasticsearch client of the worker.
+    Files whose content hash matches the hash in batch['previous_hashes'] are not indexed
+    
+    Returns:
+        The batch (without the file lists), the ingestion stats (None when bulk=False), and the manifest records of the files in the batch
+    """
+    bulk_kwargs = {'bulk': bulk, 'chunk_size': chunk_size, 'max_chunk_bytes': max_chunk_bytes}
+    index_name = INDEX_NAMES[batch['kind']]
+
+    hashes = {f: _file_hash(os.path.join(batch['folder_path'], f)) for f in batch['files']}
+    files_to_index = [f for f in batch['files'] if batch['previous_hashes'].get(f) != hashes[f]]
+
+    if batch['kind'] == 'bill':
+        stats = store_bills(
+            es_conn=_worker_es_conn, 
+            bill_files=files_to_index, 
+            folder_path=batch['folder_path'], 
+            index_name=index_name, 
+            **bulk_kwargs
+        )
+    elif batch['kind'] == 'text':
+        stats = store_bill_texts(
+            es_conn=_worker_es_conn, 
+            text_files=files_to_index, 
+            folder_path=batch['folder_path'], 
+            index_name=index_name, 
+            **bulk_kwargs
+        )
+    else:
+        stats = store_people(
+            es_conn=_worker_es_conn,
+            people_files=files_to_index,
+            folder_path=batch['folder_path'],
+            session_id=batch['session_id'],
+            index_name=index_name,
+            **bulk_kwargs
+        )
+
+    failed_files = set()
+    if stats is not None:
+        failed_files = set([os.path.basename(x['file']) for x in stats['errors'] if x.get('file') is not None])
+
+    # Unchanged files are recorded as well, so that the manifest always describes the complete dump
+    files_to_index = set(files_to_index)
+    ingested_at = datetime.now().isoformat()
+    records = list()
+    for f in batch['files']:
+        if f in failed_files:
+            status = 'failed'
+        elif f in files_to_index:
+            status = 'indexed'
+        else:
+            status = 'unchanged'
+
+        records.append({
+            'state': batch['state'],
+            'session': batch['session'],
+            'kind': batch['kind'],
+            'file': f,
+            'hash': hashes[f],
+            'status': status,
+            'ingested_at': ingested_at
+        })
+
+    batch_info = {k: v for k, v in batch.items() if k not in ('files', 'previous_hashes')}
+    batch_info['num_files'] = len(batch['files'])
+    batch_info['num_indexed'] = len(files_to_index)
+    
+    return batch_info, stats, records
 
 
 def ingest_dump_es(
     es_conn, 
     processed_data_dump_path, 
-    n_jobs=-1
+    n_jobs=-1,
+    bulk=False,
+    bulk_chunk_size=BULK_CHUNK_SIZE,
+    bulk_max_chunk_bytes=BULK_MAX_CHUNK_BYTES,
+    creds_file=credentials_file,
+    manifest_path=None,
+    previous_manifest_path=None
     ):
     """
     Insert the data from the legiscan dump to elasticsearch indexes:
+    The whole dump is split into a single queue of batches of (state, session, file) items, which is consumed by a pool of worker processes. 
+    The pool lives for the whole ingestion and each worker uses one elasticsearch client.
 
     args:
-        es_conn: elasticsearch connection object
+        es_conn: elasticsearch connection object. Used when n_jobs=1. Otherwise, each worker creates its own client
         processed_data_dump_path (str): The folder where the dump is located. 
             The zip archives in the data dump need to be unzipped and the documents ned to be decoded before running this script.
             Has to be a FS path. Doesn't handle S3 buckets, yet.  
         n_jobs: Number of processes to distribute the jobs across. If -1, all available cores are used   
+        bulk (bool): Whether to index the documents with streaming _bulk requests. 
+            In the bulk mode, documents that fail are logged and reported at the end instead of aborting the ingestion
+        bulk_chunk_size (int): Max number of docs per _bulk request. Also the max number of files in a batch of the work queue
+        bulk_max_chunk_bytes (int): Max size of a _bulk request in bytes. Also the max size of a batch of the work queue
+        creds_file (str): The credentials file the workers use to connect to elasticsearch
+        manifest_path (str): Optional. A json-lines file where the status and content hash of every ingested file is recorded as the ingestion proceeds. 
+            If the file exists (e.g. the ingestion crashed before), the files that are already recorded as indexed are skipped
+        previous_manifest_path (str): Optional. The manifest of the last ingested dump. 
+            If given, only the files whose content hash changed since that dump are indexed
     """
-    states = _get_subdir(processed_data_dump_path)  
+    if (n_jobs > mp.cpu_count()) or n_jobs==-1:
+        n_jobs = mp.cpu_count()
 
-    # random.shuffle(states)
-    logging.info('Processing states in this order: {}'.format(states))
+    # Resuming from the checkpoint
+    manifest = load_manifest(manifest_path)
+    completed_files = set([k for k, v in manifest.items() if v['status'] in ('indexed', 'unchanged')])
+    if len(completed_files) > 0:
+        logging.info('Resuming the ingestion. {} files are already recorded as completed in the manifest {}'.format(len(completed_files), manifest_path))
+
+    # Delta ingestion
+    previous_hashes = None
+    if previous_manifest_path is not None:
+        previous_manifest = load_manifest(previous_manifest_path)
+        previous_hashes = {k: v['hash'] for k, v in previous_manifest.items() if v['status'] in ('indexed', 'unchanged')}
+        logging.info('Only indexing files that changed since the dump in {} ({} files)'.format(previous_manifest_path, len(previous_hashes)))
+
+    batches = _create_work_batches(
+        processed_data_dump_path, 
+        bulk_chunk_size, 
+        bulk_max_chunk_bytes, 
+        completed_files=completed_files, 
+        previous_hashes=previous_hashes
+    )
+
+    file_counts = {kind: sum([len(x['files']) for x in batches if x['kind']==kind]) for kind in INDEX_NAMES.keys()}
+    total_bytes = sum([x['bytes'] for x in batches])
+    sessions = set([(x['state'], x['session']) for x in batches])
+    states = set([x['state'] for x in batches])
 
-    state_counter = 0
-    session_counter = 0
-    bill_counter = 0
-    text_counter = 0
-    people_counter = 0 # not unique people, but unique person, session pairs
+    logging.info('There are {} bills, {} texts, and {} people files ({:.2f} MB) to process, split into {} batches'.format(
+        file_counts['bill'], file_counts['text'], file_counts['people'], total_bytes / (1024 * 1024), len(batches)
+    ))
+
+    # Throughput and errors of the bulk ingestion, per index 
+    bulk_stats = dict()
+    batch_kwargs = {'bulk': bulk, 'chunk_size': bulk_chunk_size, 'max_chunk_bytes': bulk_max_chunk_bytes}
     
-    logging.info('Starting ingestion')
-    for state in states:
-        tpth = os.path.join(processed_data_dump_path, state)
+    logging.info('Starting ingestion with {} processes'.format(n_jobs))
+    start = time.time()
+    processed_bytes = 0
+    num_indexed = 0
+    manifest_fp = open(manifest_path, 'a') if manifest_path is not None else None
+
+    if n_jobs == 1:
+        global _worker_es_conn
+        _worker_es_conn = es_conn
+        results = (_ingest_batch(batch, **batch_kwargs) for batch in batches)
+        pool = None
+    else:
+        pool = mp.Pool(processes=n_jobs, initializer=_init_worker, initargs=(creds_file,))
+        results = pool.imap_unordered(partial(_ingest_batch, **batch_kwargs), batches, chunksize=1)
+
+    try:
+        for i, (batch_info, stats, records) in enumerate(results):
+            if stats is not None:
+                _merge_ingestion_stats(bulk_stats, stats)
+
+            if manifest_fp is not None:
+                _append_to_manifest(manifest_fp, records)
+
+            num_indexed = num_indexed + batch_info['num_indexed']
+
+            processed_bytes = processed_bytes + batch_info['bytes']
+            logging.info('Completed batch {}/{} ({} {} files of state {}, session {}). {:.1f}% of the dump in {:.1f} s'.format(
+                i + 1, len(batches), batch_info['num_files'], batch_info['kind'], batch_info['state'], batch_info['session'], 
+                100 * processed_bytes / max(total_bytes, 1), time.time() - start
+            ))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        if manifest_fp is not None:
+            manifest_fp.close()
 
-        # Each session has a sub directory
-        sessions = _get_subdir(tpth)
+    logging.info('Completed the ingestion! There were {} bills, {} texts, and {} people files in the dump across {} states and {} sessions'.format(
+        file_counts['bill'], file_counts['text'], file_counts['people'], len(states), len(sessions)
+    ))
+    logging.info('{} files were indexed. The rest had not changed since the previous dump'.format(num_indexed))
 
-        for session in sessions:
-            logging.info('Processing state {}, session {}'.format(state, session))
-            tpth2 = os.path.join(tpth, session)
+    if bulk_stats:
+        _log_throughput_report(bulk_stats)
 
-            # Bills
-            bills_path = os.path.join(tpth2, 'bill')
-            bills_files = os.listdir(bills_path) if os.path.isdir(bills_path) else []
+    return bulk_stats
 
-            logging.info('Contains {} bills'.format(len(bills_files)))
-            
-            if n_jobs==1:
-                store_bills(es_conn=es_conn, bill_files=bills_files, folder_path=bills_path, index_name='bill_meta')
-                logging.info('Processing sequentially')
-            else:    
-                job_chunks = _distribute_jobs(len(bills_files), n_jobs)
-
-                logging.info('Distributing the bills across {} cores'.format(len(job_chunks)))
-
-                idx_cursor = 0
-                jobs = []
-                for i, chunk_size in enumerate(job_chunks):
-                    p = mp.Process(
-                        name=f'p{i}',
-                        target=store_bills,
-                        kwargs={
-                            'es_conn': es_conn,
-                            'bill_files': bills_files[idx_cursor: idx_cursor+chunk_size],
-                            'folder_path': bills_path,
-                            'index_name': 'bill_meta'
-                        }
-                    )
 
-                    jobs.append(p)
-                    p.start()
+def _bill_doc_from_file(fp):
+    """Read a bill json file from the dump and format it as the document for the bill_meta index. 
+        Returns the document id (bill_id) and the document
+    """
+    with open(fp) as json_fp:
+        bill_json = json.load(json_fp)['bill']
+
+    if bill_json.get('status_date') == LEGISCAN_PLACEHOLDER_DATE:
+        bill_json['status_date'] = DEFAULT_DATE
+
+    # Fields which has date in their sub elements
+    fields_with_date = ['progress', 'history', 'votes', 'amendments', 'calendar', 'texts']
+    for field in fields_with_date:
+        for item in bill_json.get(field):
+            if item.get('date') == LEGISCAN_PLACEHOLDER_DATE:
+                item['date'] = DEFAULT_DATE
+
+    # Explicitly defining the json structure for future change/debugging purposes
+    json_object = {
+        "bill_id": bill_json.get('bill_id'),
+        "bill_number": bill_json.get('bill_number'),
+        "bill_type":  bill_json.get('bill_type'),
+        "bill_type_id": bill_json.get('bill_type_id'),
+        "body": bill_json.get('body'),
+        "body_id": bill_json.get('body_id'),
+        "change_hash": bill_json.get('change_hash'),
+        "committee": bill_json.get('committee'),
+        "pending_committee_id": bill_json.get('pending_committee_id'),
+        "current_body": bill_json.get('current_body'),
+        "current_body_id": bill_json.get('current_body_id'),
+        "description": bill_json.get('description'),
+        "history": bill_json.get('history'),
+        "session": bill_json.get('session'),
+        "session_id": bill_json.get('session_id'),
+        "sponsors": bill_json.get('sponsors'),
+        "sats": bill_json.get('sats'),
+        "state": bill_json.get('state'),
+        "state_id": bill_json.get('state_id'),
+        "state_link": bill_json.get('state_link'),
+        "status": bill_json.get('status'),
+        "status_date": bill_json.get('status_date'),
+        "subjects": bill_json.get('subjects'),
+        "title": bill_json.get('title'),
+        "url": bill_json.get('url'),
+        "votes": bill_json.get('votes'),
+        "completed": bill_json.get('completed'),
+        "amendments": bill_json.get('amendments'),
+        "calendar": bill_json.get('calendar'),
+        "progress": bill_json.get('progress'),
+        "texts": bill_json.get('texts')
+    }
 
-                    idx_cursor = idx_cursor + chunk_size
+    # The doc id in elasticsearch is the bill_id
+    return bill_json['bill_id'], json_object
 
-                for proc in jobs:
-                    proc.join()
 
-            bill_counter = bill_counter + len(bills_files)
-            logging.info('Completed bills. Now on to bill texts')
-            
-            # Text
-            text_path = os.path.join(tpth2, 'text')
-            text_files = os.listdir(text_path) if os.path.isdir(text_path) else []    
-
-            logging.info('Contains {} bill text versions'.format(len(text_files)))
-            if n_jobs==1:
-                store_bill_texts(es_conn=es_conn, text_files=text_files, folder_path=text_path, index_name='bill_text')
-                logging.info('Processing sequentially')
-            else:
-                job_chunks = _distribute_jobs(len(text_files), n_jobs)
-
-                logging.info('Distributing the texts across {} cores'.format(len(job_chunks)))
-
-                idx_cursor = 0
-                jobs = []
-                for i, chunk_size in enumerate(job_chunks):
-                    p = mp.Process(
-                        name=f'p{i}',
-                        target=store_bill_texts,
-                        kwargs={
-                            'es_conn': es_conn,
-                            'text_files': text_files[idx_cursor: idx_cursor+chunk_size],
-                            'folder_path': text_path,
-                            'index_name': 'bill_text'
-                        }
-                    )
+def _text_doc_from_file(fp):
+    """Read a (decoded) bill text json file from the dump and format it as the document for the bill_text index.
+        Returns the document id (<bill_id>_<doc_id>) and the document 
+    """
+    with open(fp) as json_fp:
+        content = json.load(json_fp)
+        
+    doc = content["text"]
 
-                    jobs.append(p)
-                    p.start()
+    if (doc.get('date') == LEGISCAN_PLACEHOLDER_DATE) or (doc.get('date') is None or (doc.get('date')=='0000-00-00')):
+        doc['date'] = DEFAULT_DATE
+        
+    # TODO: The bill json file contains a `texts` field. We can use that to impute the missing doc dates.  
+    json_object = {
+        "bill_id": doc['bill_id'],
+        "doc_date": doc['date'],
+        "doc": doc.get('doc_decoded'),
+        # "encoded_doc": doc.get('doc'),
+        "doc_id": doc['doc_id'],
+        "mime": doc['mime'],
+        "mime_id": doc['mime_id'],
+        "state_link": doc.get('state_link'),
+        "text_size": doc['text_size'],
+        "type": doc['type'],
+        "type_id": doc['type_id'],
+        "url": doc.get('url')
+    }
 
-                    idx_cursor = idx_cursor + chunk_size
-                
-                for proc in jobs:
-                    proc.join()
+    # The document is indexed by the <bill_id>_<doc_id>
+    return '{}_{}'.format(doc['bill_id'], doc['doc_id']), json_object
 
-            text_counter = text_counter + len(text_files)
-            logging.info('Completed texts. Now on to people in the session')
 
-            # people
-            # We need the session_id to append to the people json file
-            # We can find it in a bill json
-            b = os.path.join(bills_path, bills_files[0])
-            with open(b) as bfp:
-                session_id = json.load(bfp)['bill']['session_id']
+def _person_doc_from_file(fp, session_id):
+    """Read a person json file from the dump and format it as the document for the session_people index. 
+        Returns the document id (<session_id>_<people_id>) and the document
+    """
+    # We add the session_id to the document content and the document id
+    with open(fp) as json_fp:
+        person_json = json.load(json_fp)['person']
+    
+    json_object = {
+        'session_id': session_id,
+        'people_id': person_json.get('people_id'),
+        'person_hash': person_json.get('person_hash'),
+        'state_id': person_json.get('state_id'),
+        'party_id': person_json.get('party_id'),
+        'party': person_json.get('party'),
+        'role_id': person_json.get('role_id'),
+        'role': person_json.get('role'),
+        'name': person_json.get('name'),
+        'first_name': person_json.get('first_name'),
+        'middle_name': person_json.get('middle_name'),
+        'last_name': person_json.get('last_name'),
+        'suffix': person_json.get('suffix'),
+        'nickname': person_json.get('nickname'),
+        'district': person_json.get('district'),
+        'ftm_eid': person_json.get('ftm_eid'),
+        'votesmart_id': person_json.get('votesmart_id'),
+        'opensecrets_id': person_json.get('opensecrets_id'),
+        'ballotpedia': person_json.get('ballotpedia'),
+        'committee_sponsor': person_json.get('committee_sponsor'),
+        'committee_id': person_json.get('committee_id')
+    }
 
+    # The document is indexed by the <session_id>_<people_id>
+    return '{}_{}'.format(session_id, person_json.get('people_id')), json_object
+
+
+def _index_one_doc(es_conn, index_name, doc_id, json_object):
+    """Index a single document. If the document already exists, it will replace it"""
+    try: 
+        es_conn.index(
+            index=index_name, 
+            id=doc_id, 
+            body=json.dumps(json_object)
+        )
+    except ConnectionRefusedError:
+        logging.error('Connection error. Aborting!')
+        raise ConnectionRefusedError('Connection refused by elasticsearch instance')
+    except ConnectionError:
+        logging.error('Connection error. Aborting!')
+        raise ConnectionError('Connection refused by elasticsearch instance')
+    except Exception as e:
+        logging.warning('Could not index {} due to exception {}'.format(doc_id, e) )
+        raise ValueError('Aborting!')
+
+
+def _empty_ingestion_stats(index_name):
+    """The counters we keep while bulk indexing documents to an index"""
+    return {
+        'index': index_name,
+        'docs': 0,
+        'bytes': 0,
+        'seconds': 0.0,
+        'errors': []
+    }
 
-            people_path = os.path.join(tpth2, 'people')
-            people_files = os.listdir(people_path) if os.path.isdir(people_path) else []  
-            job_chunks = _distribute_jobs(len(people_files), n_jobs)
 
-            logging.info('Session has {} people'.format(len(people_files)))
-            # logging.info('Distributing them across {} cores'.format(len(job_chunks)))
-            logging.info('Processing sequentially')
+def _merge_ingestion_stats(totals, stats):
+    """Accumulate the stats of one bulk ingestion into the totals dictionary (keyed by index name)"""
+    index_name = stats['index']
 
-            store_people(
-                es_conn=es_conn,
-                people_files=people_files,
-                folder_path=people_path,
-                session_id=session_id,
-                index_name='session_people'
-            )
+    if index_name not in totals:
+        totals[index_name] = _empty_ingestion_stats(index_name)
 
-            people_counter = people_counter + len(people_files)
-            session_counter = session_counter + 1
-        
-        state_counter = state_counter + 1
+    for k in ['docs', 'bytes', 'seconds']:
+        totals[index_name][k] = totals[index_name][k] + stats[k]
+    
+    totals[index_name]['errors'].extend(stats['errors'])
 
-    logging.info('Completed the ingestion! There were {} bills, {} texts, and {} people files in the dump across {} states and {} sessions'.format(
-        bill_counter, text_counter, people_counter, state_counter, session_counter
+    return totals
+
+
+def _log_throughput_report(totals):
+    """Log the number of docs, docs/s and MB/s for each index after a bulk ingestion"""
+    for index_name, stats in totals.items():
+        seconds = stats['seconds'] if stats['seconds'] > 0 else float('nan')
+        mb = stats['bytes'] / (1024 * 1024)
+
+        logging.info('Index {}: indexed {} docs ({:.2f} MB) in {:.1f} s -- {:.1f} docs/s, {:.2f} MB/s. {} docs failed'.format(
+            index_name, stats['docs'], mb, stats['seconds'], stats['docs'] / seconds, mb / seconds, len(stats['errors'])
+        ))
+
+        for err in stats['errors'][:10]:
+            logging.warning('{}: {}'.format(index_name, err))
+
+
+def bulk_index_files(es_conn, file_paths, index_name, doc_parser, chunk_size=BULK_CHUNK_SIZE, max_chunk_bytes=BULK_MAX_CHUNK_BYTES, **parser_kwargs):
+    """
+    Stream the documents in a list of json files to an elasticsearch index using _bulk requests.
+    The files are read lazily, so only one chunk of documents is held in memory at a time.
+    Documents that fail (either parsing the file or indexing the doc) are collected and reported instead of aborting the ingestion.
+
+    Args:
+        es_conn: Elasticsearch connection object
+        file_paths (List[str]): Paths of the json files to index
+        index_name (str): The name of the elasticsearch index
+        doc_parser (function): Function that takes a file path (and parser_kwargs) and returns the (doc_id, document) pair
+        chunk_size (int): Max number of docs in a single _bulk request
+        max_chunk_bytes (int): Max size of a single _bulk request in bytes
+        parser_kwargs: Any additional arguments to the doc_parser
+    
+    Returns:
+        A dictionary with the number of docs and bytes indexed, the time taken and the list of errors
+    """
+    stats = _empty_ingestion_stats(index_name)
+
+    # To trace the failed documents back to their files
+    id_to_file = dict()
+
+    def _actions():
+        for fp in file_paths:
+            try:
+                doc_id, json_object = doc_parser(fp, **parser_kwargs)
+            except Exception as e:
+                logging.warning('Could not parse {} due to exception {}'.format(fp, e))
+                stats['errors'].append({'file': fp, 'error': str(e)})
+                continue
+            
+            # Serializing here to keep track of the volume we send
+            # The elasticsearch client passes strings through without re-serializing 
+            source = json.dumps(json_object)
+            stats['bytes'] = stats['bytes'] + len(source.encode('utf-8'))
+            id_to_file[str(doc_id)] = fp
+
+            yield {
+                '_op_type': 'index',
+                '_index': index_name,
+                '_id': doc_id,
+                '_source': source
+            }
+
+    start = time.time()
+    for ok, item in helpers.streaming_bulk(
+        es_conn, 
+        _actions(), 
+        chunk_size=chunk_size, 
+        max_chunk_bytes=max_chunk_bytes,
+        raise_on_error=False,
+        max_retries=BULK_MAX_RETRIES,
+        request_timeout=60
+    ):
+        if ok:
+            stats['docs'] = stats['docs'] + 1
+        else:
+            err = item.get('index', item)
+            stats['errors'].append({
+                'id': err.get('_id'), 
+                'file': id_to_file.get(str(err.get('_id'))), 
+                'status': err.get('status'), 
+                'error': err.get('error')
+            })
+
+    stats['seconds'] = time.time() - start
+
+    logging.info('{}: bulk indexed {} docs to {} in {:.1f} s with {} errors'.format(
+        mp.current_process().name, stats['docs'], index_name, stats['seconds'], len(stats['errors'])
     ))
 
+    return stats
+
 
-def store_bills(es_conn, bill_files, folder_path, index_name):
+def store_bills(es_conn, bill_files, folder_path, index_name, bulk=False, chunk_size=BULK_CHUNK_SIZE, max_chunk_bytes=BULK_MAX_CHUNK_BYTES):
     """
         Given a set of bill files, store them in elasticsearch
         Args:
@@ -237,82 +695,26 @@ def store_bills(es_conn, bill_files, folder_path, index_name):
             bill_files (List[str]): List of file names containing bill info (json files)
             folder_path (str): Location where the bill files are located
             index_name (str): The name of the elasticsearch index to store the bills 
+            bulk (bool): Whether to use _bulk requests instead of indexing one document at a time
+            chunk_size (int): Max number of docs per _bulk request
+            max_chunk_bytes (int): Max size of a _bulk request in bytes
+        
+        Returns:
+            The ingestion stats when bulk=True. None otherwise 
     """
 
     # Joining the folder and the file name to create the path
     file_paths = [ os.path.join(folder_path, x) for x in bill_files]
 
+    if bulk:
+        return bulk_index_files(es_conn, file_paths, index_name, _bill_doc_from_file, chunk_size, max_chunk_bytes)
+
     for fp in file_paths:
-        with open(fp) as json_fp:
-            bill_json = json.load(json_fp)['bill']
-
-        if bill_json.get('status_date') == LEGISCAN_PLACEHOLDER_DATE:
-            bill_json['status_date'] = DEFAULT_DATE
-
-        # Fields which has date in their sub elements
-        fields_with_date = ['progress', 'history', 'votes', 'amendments', 'calendar', 'texts']
-        for field in fields_with_date:
-            for item in bill_json.get(field):
-                if item.get('date') == LEGISCAN_PLACEHOLDER_DATE:
-                    item['date'] = DEFAULT_DATE
-
-        # Explicitly defining the json structure for future change/debugging purposes
-        json_object = {
-            "bill_id": bill_json.get('bill_id'),
-            "bill_number": bill_json.get('bill_number'),
-            "bill_type":  bill_json.get('bill_type'),
-            "bill_type_id": bill_json.get('bill_type_id'),
-            "body": bill_json.get('body'),
-            "body_id": bill_json.get('body_id'),
-            "change_hash": bill_json.get('change_hash'),
-            "committee": bill_json.get('committee'),
-            "pending_committee_id": bill_json.get('pending_committee_id'),
-            "current_body": bill_json.get('current_body'),
-            "current_body_id": bill_json.get('current_body_id'),
-            "description": bill_json.get('description'),
-            "history": bill_json.get('history'),
-            "session": bill_json.get('session'),
-            "session_id": bill_json.get('session_id'),
-            "sponsors": bill_json.get('sponsors'),
-            "sats": bill_json.get('sats'),
-            "state": bill_json.get('state'),
-            "state_id": bill_json.get('state_id'),
-            "state_link": bill_json.get('state_link'),
-            "status": bill_json.get('status'),
-            "status_date": bill_json.get('status_date'),
-            "subjects": bill_json.get('subjects'),
-            "title": bill_json.get('title'),
-            "url": bill_json.get('url'),
-            "votes": bill_json.get('votes'),
-            "completed": bill_json.get('completed'),
-            "amendments": bill_json.get('amendments'),
-            "calendar": bill_json.get('calendar'),
-            "progress": bill_json.get('progress'),
-            "texts": bill_json.get('texts')
-        }
-
-        # Indexing the document. 
-        # The doc id in elasticsearch is the bill_id
-        # If the document already exists, it will replace it
-        try: 
-            es_conn.index(
-                index=index_name, 
-                id=bill_json['bill_id'], 
-                body=json.dumps(json_object)
-            )
-        except ConnectionRefusedError:
-            logging.error('Connection error. Aborting!')
-            raise ConnectionRefusedError('Connection refused by elasticsearch instance')
-        except ConnectionError:
-            logging.error('Connection error. Aborting!')
-            raise ConnectionError('Connection refused by elasticsearch instance')
-        except Exception as e:
-            logging.warning('Could not index {} due to exception {}'.format(bill_json['bill_id'], e) )
-            raise ValueError('Aborting!')
-
-
-
-def store_bill_texts(es_conn, text_files, folder_path, index_name):
+        doc_id, json_object = _bill_doc_from_file(fp)
+        _index_one_doc(es_conn, index_name, doc_id, json_object)
+
+
+def store_bill_texts(es_conn, text_files, folder_path, index_name, bulk=False, chunk_size=BULK_CHUNK_SIZE, max_chunk_bytes=BULK_MAX_CHUNK_BYTES):
     """
         Given a set of bill text files, store them in an elasticsearch index.
         Here the unit of analysis is a bill text version (document). 
@@ -324,57 +726,26 @@ def store_bill_texts(es_conn, text_files, folder_path, index_name):
             text_files (List[str]): List of file names containing bill doc info (json files)
             folder_path (str): Location where the text files are located
             index_name (str): The name of the elasticsearch index to store the bill_texts 
+            bulk (bool): Whether to use _bulk requests instead of indexing one document at a time
+            chunk_size (int): Max number of docs per _bulk request
+            max_chunk_bytes (int): Max size of a _bulk request in bytes
+
+        Returns:
+            The ingestion stats when bulk=True. None otherwise 
     """
     # Joining the folder and the file name to create the path
     file_paths = [ os.path.join(folder_path, x) for x in text_files if x.endswith('.json')]
 
+    if bulk:
+        return bulk_index_files(es_conn, file_paths, index_name, _text_doc_from_file, chunk_size, max_chunk_bytes)
+
     for fp in file_paths:
         logging.info('Processing {}'.format(fp))
-        with open(fp) as json_fp:
-            # print(json.load(json_fp))
-            # doc = json.load(json_fp).get("text")
-            content = json.load(json_fp)
-            
-            doc = content["text"]
-
-            if (doc.get('date') == LEGISCAN_PLACEHOLDER_DATE) or (doc.get('date') is None or (doc.get('date')=='0000-00-00')):
-                doc['date'] = DEFAULT_DATE
-                
-            # TODO: The bill json file contains a `texts` field. We can use that to impute the missing doc dates.  
-            json_object = {
-                "bill_id": doc['bill_id'],
-                "doc_date": doc['date'],
-                "doc": doc.get('doc_decoded'),
-                # "encoded_doc": doc.get('doc'),
-                "doc_id": doc['doc_id'],
-                "mime": doc['mime'],
-                "mime_id": doc['mime_id'],
-                "state_link": doc.get('state_link'),
-                "text_size": doc['text_size'],
-                "type": doc['type'],
-                "type_id": doc['type_id'],
-                "url": doc.get('url')
-            }
+        doc_id, json_object = _text_doc_from_file(fp)
+        _index_one_doc(es_conn, index_name, doc_id, json_object)
 
-            # The document is indexed by the <bill_id>_<doc_id>
-            try:
-                es_conn.index(
-                    index=index_name, 
-                    id='{}_{}'.format(doc['bill_id'], doc['doc_id']), 
-                    body=json.dumps(json_object)
-                )
-            except ConnectionRefusedError:
-                logging.error('Connection error. Aborting!')
-                raise ConnectionRefusedError('Connection refused by elasticsearch instance')
-            except ConnectionError:
-                logging.error('Connection error. Aborting!')
-                raise ConnectionError('Connection refused by elasticsearch instance')
-            except Exception as e:
-                logging.warning('Could not index {} due to exception {}'.format(doc['doc_id'], e) )
-                raise ValueError('Aborting!')
 
-
-def store_people(es_conn, people_files, folder_path, index_name, session_id):
+def store_people(es_conn, people_files, folder_path, index_name, session_id, bulk=False, chunk_size=BULK_CHUNK_SIZE, max_chunk_bytes=BULK_MAX_CHUNK_BYTES):
     """
     Given a list of people files, index them in elasticsearch
     Args:
@@ -382,56 +753,24 @@ def store_people(es_conn, people_files, folder_path, index_name, session_id):
         people_files (List[str]): List of file names containing people info (json files)
         folder_path (str): Location where the text files are located
         index_name (str): The name of the elasticsearch index to store the bill_texts
+        session_id (int): The session the people belong to. Added to the document and the document id
+        bulk (bool): Whether to use _bulk requests instead of indexing one document at a time
+        chunk_size (int): Max number of docs per _bulk request
+        max_chunk_bytes (int): Max size of a _bulk request in bytes
+
+    Returns:
+        The ingestion stats when bulk=True. None otherwise 
     """
 
     # Joining the folder and the file name to create the path
     file_paths = [ os.path.join(folder_path, x) for x in people_files]
 
+    if bulk:
+        return bulk_index_files(es_conn, file_paths, index_name, _person_doc_from_file, chunk_size, max_chunk_bytes, session_id=session_id)
+
     for fp in file_paths:
-        # We add the session_id to the document content and the document id
-        with open(fp) as json_fp:
-            person_json = json.load(json_fp)['person']
-        
-        json_object = {
-            'session_id': session_id,
-            'people_id': person_json.get('people_id'),
-            'person_hash': person_json.get('person_hash'),
-            'state_id': person_json.get('state_id'),
-            'party_id': person_json.get('party_id'),
-            'party': person_json.get('party'),
-            'role_id': person_json.get('role_id'),
-            'role': person_json.get('role'),
-            'name': person_json.get('name'),
-            'first_name': person_json.get('first_name'),
-            'middle_name': person_json.get('middle_name'),
-            'last_name': person_json.get('last_name'),
-            'suffix': person_json.get('suffix'),
-            'nickname': person_json.get('nickname'),
-            'district': person_json.get('district'),
-            'ftm_eid': person_json.get('ftm_eid'),
-            'votesmart_id': person_json.get('votesmart_id'),
-            'opensecrets_id': person_json.get('opensecrets_id'),
-            'ballotpedia': person_json.get('ballotpedia'),
-            'committee_sponsor': person_json.get('committee_sponsor'),
-            'committee_id': person_json.get('committee_id')
-        }
-
-        # The document is indexed by the <session_id>_<people_id>
-        try: 
-            es_conn.index(
-                index=index_name, 
-                id='{}_{}'.format(session_id, person_json.get('people_id')), 
-                body=json.dumps(json_object)
-            )
-        except ConnectionRefusedError:
-            logging.error('Connection error. Aborting!')
-            raise ConnectionRefusedError('Connection refused by elasticsearch instance')
-        except ConnectionError:
-            logging.error('Connection error. Aborting!')
-            raise ConnectionError('Connection refused by elasticsearch instance')
-        except Exception as e:
-            logging.warning('Could not index {} due to exception {}'.format(person_json.get('people_id'), e) )
-            raise ValueError('Aborting!')
+        doc_id, json_object = _person_doc_from_file(fp, session_id)
+        _index_one_doc(es_conn, index_name, doc_id, json_object)
 
 
 
@@ -442,11 +781,19 @@ def run():
     # dump_location = '/mnt/data/projects/aclu_leg_tracker/legiscan_dump_20200615_processed'
     dump_location = '/mnt/data/projects/aclu_leg_tracker/legiscan_dump_20210709_processed'
 
-    # Multiple processes writing to Elasticsearch seems to throw errors, so keep n_jobs=1 for now
+    # Re-running with the same manifest resumes the ingestion from where it stopped
+    manifest = '/mnt/data/projects/aclu_leg_tracker/legiscan_dump_20210709_ingestion_manifest.jsonl'
+
+    # Multiple processes writing to Elasticsearch seems to throw errors, so keep the pool small
+    # Each worker of the pool uses its own elasticsearch client. Use n_jobs=1 if the errors come back
+    # The bulk mode batches the documents into _bulk requests, which takes care of most of the round trips
     ingest_dump_es(
         es_conn=es,
         processed_data_dump_path=dump_location,
-        n_jobs=1
+        n_jobs=4,
+        bulk=True,
+        manifest_path=manifest,
+        previous_manifest_path=None
     )
 
 if __name__ == '__main__':
@@ -238,7 +238,9 @@ def _parse_search_results(es, res, statuses_to_update, status_dates_to_update):
 
 
 def update_status_flags(es, engine, index, as_of_date, query_size=10):
-    """Update the status flag and the status date for all the active bills added before the as_of_date"""
+    """Update the status flag and the status date for all the active bills added before the as_of_date
+        The bills that are still active as of the as_of_date (pre_triage_features.active_bills) keep the active status, so they are skipped
+    """
 
     # TODO -- double check the query for correct status
     q = """
@@ -247,10 +249,13 @@ def update_status_flags(es, engine, index, as_of_date, query_size=10):
                 distinct bill_id,
                 max(progress_date) as last_progress_date,
                 min(('{as_of_date}'::DATE - event_date::DATE)::int) as days_since_last_event
-            from deploy.passage_predictions 
+            from deploy.passage_predictions p
                 join clean.bill_progress using(bill_id)
                     join clean.bill_events using(bill_id)
             where as_of_date < '{as_of_date}' and progress_date < '{as_of_date}' and event_date < '{as_of_date}'
+                and not exists (
+                    select 1 from pre_triage_features.get_active_bills('{as_of_date}'::date) a where a.bill_id = p.bill_id
+                )
             group by bill_id
         )
         select 
@@ -1,19 +1,396 @@
+import os
 import json
-import base64
+import gzip
+import time
 import logging
+import threading
 
 from urllib.request import urlopen
+from urllib.parse import urlencode
+from urllib.error import URLError
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from typing import List, Dict
 
-from src.utils.decoders import html_decoder, pdf_decoder
+from src.utils.decoders import get_decoder
+
+LEGISCAN_API_URL = 'https://api.legiscan.com/'
+
+# Defaults for the shared API client
+# Legiscan enforces a monthly query quota. The rate limit keeps bursts (e.g. fetching hundreds of bill texts) polite
+LEGISCAN_MAX_WORKERS = 8
+LEGISCAN_CALLS_PER_SECOND = 5
+LEGISCAN_MAX_RETRIES = 3
+LEGISCAN_BACKOFF_SECONDS = 2
+
+
+class LegiscanQuotaExceeded(Exception):
+    """Raised when the client has used up the number of API calls it is allowed to make"""
+    pass
+
+
+class _TokenBucket:
+    """Thread safe token bucket. A token is refilled every 1/rate seconds, up to capacity tokens"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available and take it"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+
+                if self._tokens >= 1:
+                    self._tokens = self._tokens - 1
+                    return
+
+                wait_time = (1 - self._tokens) / self.rate
+            
+            time.sleep(wait_time)
+
+
+class LegiscanClient:
+    """
+    Client for the Legiscan API shared by the data loaders and the weekly update.
+
+    - Calls can be made one at a time (call) or concurrently on a bounded thread pool (iter_many)
+    - All calls go through a token bucket rate limiter
+    - Concurrent requests for the same (op, params), e.g. the same doc_id, are coalesced into one API call
+    - Network errors are retried with exponential backoff
+    - Every API call is counted here (api_calls), including retries
+    """
+
+    def __init__(
+        self, 
+        api_key, 
+        max_workers=LEGISCAN_MAX_WORKERS, 
+        calls_per_second=LEGISCAN_CALLS_PER_SECOND, 
+        max_retries=LEGISCAN_MAX_RETRIES, 
+        backoff_seconds=LEGISCAN_BACKOFF_SECONDS,
+        max_calls=None,
+        timeout=60,
+        base_url=LEGISCAN_API_URL
+    ):
+        """
+        Args:
+            api_key (str): Legiscan API key
+            max_workers (int): Max number of concurrent API calls
+            calls_per_second (float): Rate limit of the API calls. Bursts of up to max_workers calls are allowed 
+            max_retries (int): Number of times a call is retried on a network error
+            backoff_seconds (float): Wait before the first retry. Doubles with each retry
+            max_calls (int): Optional. Max number of API calls this client is allowed to make. LegiscanQuotaExceeded is raised after that
+            timeout (int): Timeout of a single request in seconds
+            base_url (str): The API url. Can be pointed to a stub server for testing
+        """
+        self.api_key = api_key
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.max_calls = max_calls
+        self.timeout = timeout
+        self.base_url = base_url
+
+        self.api_calls = 0
+        self.coalesced_calls = 0
+
+        self._bucket = _TokenBucket(calls_per_second, max(1, max_workers))
+        self._lock = threading.Lock()
+        self._in_flight = dict()
+        self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='legiscan')
+
+        return self._executor
+
+    def _count_call(self):
+        with self._lock:
+            if (self.max_calls is not None) and (self.api_calls >= self.max_calls):
+                raise LegiscanQuotaExceeded('The client has used up its {} API calls'.format(self.max_calls))
+            self.api_calls = self.api_calls + 1
+
+    def _request(self, op, params):
+        """Make the API call, retrying on network errors"""
+        query = {'key': self.api_key, 'op': op}
+        query.update(params)
+        api_url = '{}?{}'.format(self.base_url, urlencode(query))
+
+        for attempt in range(self.max_retries + 1):
+            self._bucket.acquire()
+            self._count_call()
+
+            try:
+                r = urlopen(api_url, timeout=self.timeout).read().decode()
+                response = json.loads(r)
+                break
+            except (URLError, OSError, ValueError) as error:
+                if attempt == self.max_retries:
+                    logging.error('Legiscan API call {} {} failed after {} attempts: {}'.format(op, params, attempt + 1, error))
+                    raise
+
+                wait_time = self.backoff_seconds * (2 ** attempt)
+                logging.warning('Legiscan API call {} {} failed ({}). Retrying in {} seconds'.format(op, params, error, wait_time))
+                time.sleep(wait_time)
+
+        if response.get('status') == 'ERROR':
+            alert = response.get('alert') or {}
+            logging.error('Legiscan API returned an error for {} {}: {}'.format(op, params, alert.get('message')))
+
+        return response
+
+    def submit(self, op, **params):
+        """
+        Schedule an API call on the thread pool and return its future.
+        If the same call is already in flight, the future of that call is returned instead of making another call
+        """
+        key = (op, tuple(sorted(params.items())))
+
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.coalesced_calls = self.coalesced_calls + 1
+                return future
+
+        executor = self._get_executor()
+        
+        with self._lock:
+            # Another thread could have submitted the call in the meantime
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.coalesced_calls = self.coalesced_calls + 1
+                return future
+
+            future = executor.submit(self._request, op, params)
+            self._in_flight[key] = future
+        
+        future.add_done_callback(lambda f: self._forget(key))
+
+        return future
+
+    def _forget(self, key):
+        with self._lock:
+            self._in_flight.pop(key, None)
+
+    def call(self, op, **params):
+        """Make a single (blocking) API call and return the json response"""
+        return self.submit(op, **params).result()
+
+    def iter_many(self, op, ids, id_param='id', **params):
+        """
+        Make the same API call for a list of ids concurrently. Duplicate ids are only fetched once.
+        At most 2 x max_workers calls are pending at a time, so the responses that are not consumed yet don't pile up in memory
+
+        Args:
+            op (str): The API operation. e.g. getBillText
+            ids (List): The ids to fetch
+            id_param (str): The name of the id parameter of the operation
+            params: Any other parameters of the operation
+        
+        Yields:
+            (id, response) pairs in the order they complete
+        """
+        pending_ids = list(dict.fromkeys(ids))
+        window = 2 * self.max_workers
+        futures = dict()
+
+        while pending_ids or futures:
+            while pending_ids and (len(futures) < window):
+                _id = pending_ids.pop(0)
+                futures[self.submit(op, **{id_param: _id}, **params)] = _id
+
+            done, _ = wait(list(futures.keys()), return_when=FIRST_COMPLETED)
+            for future in done:
+                _id = futures.pop(future)
+                yield _id, future.result()
+
+
+# One client per API key, shared across the module functions 
+_clients = dict()
+
+
+def get_legiscan_client(api_key: str) -> LegiscanClient:
+    """Get the shared Legiscan API client for the key"""
+    if api_key not in _clients:
+        _clients[api_key] = LegiscanClient(api_key)
+
+    return _clients[api_key]
+
+
+class LegiscanResponseCache:
+    """
+    Tiered cache of Legiscan API responses. 
+
+    A response is keyed by (op, id, dataset_hash), e.g. ('getDataset', session_id, dataset_hash) or ('getBillText', doc_id, None).
+    The dataset_hash makes the key content addressed: a session dataset is only fetched again when legiscan reports a new hash. 
+    
+    - The local tier is a folder on disk: <cache_dir>/<op>/<id>[_<dataset_hash>].json.gz
+    - S3 is an optional backing tier with the same layout under s3_prefix. Responses are written through to S3, and read from S3 on a local miss
+    - The local files are indexed in memory once, when the cache is created. So, a lookup doesn't list the folder or the bucket
+    - Responses are stored as gzipped compact json
+    """
+
+    def __init__(self, cache_dir, s3_session=None, s3_bucket=None, s3_prefix=None):
+        """
+        Args:
+            cache_dir (str): The folder of the local tier
+            s3_session (boto3.Session): Optional. If not given, only the local tier is used
+            s3_bucket (str): The bucket of the S3 tier
+            s3_prefix (str): The key prefix of the S3 tier
+        """
+        self.cache_dir = cache_dir
+        self.s3_bucket = s3_bucket
+        self.s3_prefix = s3_prefix
+        self._s3 = s3_session.resource('s3') if s3_session is not None else None
+
+        self.hits = {'local': 0, 's3': 0}
+        self.misses = 0
+
+        self._index = set()
+        self._build_index()
+
+    def _build_index(self):
+        if not os.path.isdir(self.cache_dir):
+            return
+
+        for op in os.listdir(self.cache_dir):
+            op_dir = os.path.join(self.cache_dir, op)
+            if not os.path.isdir(op_dir):
+                continue
+
+            for fname in os.listdir(op_dir):
+                if fname.endswith('.json.gz'):
+                    self._index.add('{}/{}'.format(op, fname))
+
+        logging.info('Indexed {} cached legiscan responses in {}'.format(len(self._index), self.cache_dir))
+
+    @staticmethod
+    def _key(op, _id, dataset_hash=None):
+        if dataset_hash is None:
+            return '{}/{}.json.gz'.format(op, _id)
+
+        return '{}/{}_{}.json.gz'.format(op, _id, dataset_hash)
+
+    def _s3_key(self, key):
+        return '{}/{}'.format(self.s3_prefix, key) if self.s3_prefix else key
+
+    def _write_local(self, key, content):
+        fpath = os.path.join(self.cache_dir, key)
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+
+        # Writing to a temp file first, so that an interrupted run doesn't leave a truncated response in the cache
+        tmp_path = fpath + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, fpath)
+
+        self._index.add(key)
+
+    def __contains__(self, key_tuple):
+        return self._key(*key_tuple) in self._index
+
+    def _fetch_s3(self, key):
+        """Copy a response from S3 to the local tier. The bytes are streamed to disk without being read or parsed. Returns whether the response was on S3"""
+        fpath = os.path.join(self.cache_dir, key)
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+
+        tmp_path = fpath + '.tmp'
+        try:
+            self._s3.Object(self.s3_bucket, self._s3_key(key)).download_file(tmp_path)
+        except Exception as error:
+            logging.debug('{} is not in the S3 cache: {}'.format(key, error))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
+
+        os.replace(tmp_path, fpath)
+        self._index.add(key)
+
+        return True
+
+    def fetch_to_local(self, op, _id, dataset_hash=None):
+        """
+        Make sure a response is in the local tier, copying it from S3 on a local miss. 
+        Unlike get, the response is not loaded, so checking for a large dataset is cheap
+
+        Returns:
+            Whether the response is cached
+        """
+        key = self._key(op, _id, dataset_hash)
+
+        if key in self._index:
+            return True
+
+        if self._s3 is not None and self._fetch_s3(key):
+            self.hits['s3'] = self.hits['s3'] + 1
+            return True
+
+        self.misses = self.misses + 1
+        return False
+
+    def get(self, op, _id, dataset_hash=None):
+        """
+        Get a cached response. Looks up the local tier and then the S3 tier.
+        A response found on S3 is copied to the local tier.
+
+        Returns:
+            The json response. None if the response is not cached
+        """
+        key = self._key(op, _id, dataset_hash)
+
+        if key in self._index:
+            self.hits['local'] = self.hits['local'] + 1
+        elif self._s3 is not None and self._fetch_s3(key):
+            self.hits['s3'] = self.hits['s3'] + 1
+        else:
+            self.misses = self.misses + 1
+            return None
+
+        with open(os.path.join(self.cache_dir, key), 'rb') as f:
+            content = f.read()
+
+        return json.loads(gzip.decompress(content).decode('utf-8'))
+
+    def put(self, op, _id, response, dataset_hash=None):
+        """Store a response in the local tier, and the S3 tier if there is one"""
+        key = self._key(op, _id, dataset_hash)
+        content = gzip.compress(json.dumps(response, separators=(',', ':')).encode('utf-8'))
+
+        self._write_local(key, content)
+
+        if self._s3 is not None:
+            try:
+                self._s3.Object(self.s3_bucket, self._s3_key(key)).put(Body=content)
+            except Exception as error:
+                logging.warning('Could not write {} to the S3 cache: {}'.format(key, error))
+
+    def log_metrics(self):
+        logging.info('Legiscan response cache: {} local hits, {} S3 hits, {} misses'.format(
+            self.hits['local'], self.hits['s3'], self.misses
+        ))
 
 
-# TODO: write a util function to create the url and get the json given the required api function and patamers 
 def get_state_sessions(api_key: str, state: str) -> List[Dict]:
     """ Get a list of state ids for a given state abbreviation"""
-    api_url = "https://api.legiscan.com/?key={0}&op=getSessionList&state={1}".format(api_key, state)
-    r = urlopen(api_url).read().decode()
-    response = json.loads(r)
+    response = get_legiscan_client(api_key).call('getSessionList', state=state)
     status = response['status']
     
     if status=='ERROR':
@@ -25,10 +402,7 @@ def get_state_sessions(api_key: str, state: str) -> List[Dict]:
 
 def get_bills_in_session(api_key: str, session_id: int) -> List[Dict]:
     """ Get a list of bills in a session """
-    api_url = "https://api.legiscan.com/?key={0}&op=getMasterList&id={1}".format(api_key, session_id)
-
-    r = urlopen(api_url).read().decode()
-    response = json.loads(r)
+    response = get_legiscan_client(api_key).call('getMasterList', id=session_id)
 
     l = response['masterlist']
     l.pop('session')
@@ -38,10 +412,7 @@ def get_bills_in_session(api_key: str, session_id: int) -> List[Dict]:
 
 def get_bill_info(api_key: str, bill_id: int) -> Dict:
     """ Get information of a bill """
-    api_url = "https://api.legiscan.com/?key={0}&op=getBill&id={1}".format(api_key, bill_id)
-
-    r = urlopen(api_url).read().decode()
-    response = json.loads(r)
+    response = get_legiscan_client(api_key).call('getBill', id=bill_id)
 
     return response['bill']
 
@@ -51,21 +422,16 @@ def get_bill_content(api_key: str, bill_id: int) -> Dict:
 
     logging.debug('Fetching contents of bill_id: {}'.format(bill_id))
     
-    api_url = "https://api.legiscan.com/?key={0}&op=getBillText&id={1}".format(api_key, bill_id)
-
-    r = urlopen(api_url).read().decode()
-    response = json.loads(r)
+    response = get_legiscan_client(api_key).call('getBillText', id=bill_id)
     bill_details = response['text']
 
     mime_id = bill_details['mime_id']
     
     encoded_text = bill_details['doc']
-    decoded_text = base64.b64decode(encoded_text, validate=True)
 
-    # Mapping the MIME type to the appriprate decoder
+    # The shared decoder maps the MIME type to the appriprate decoder, and caches the decoded text
     logging.info('Decoding bill content for MIME type {}'.format(mime_id))
-    decoder_mapper = {1: html_decoder, 2: pdf_decoder}
-    bill_content = decoder_mapper[mime_id](decoded_text)
+    bill_content = get_decoder().decode(encoded_text, mime_id)
     logging.debug(bill_content)
 
     bill_details['doc_decoded'] = bill_content
@@ -75,9 +441,7 @@ def get_bill_content(api_key: str, bill_id: int) -> Dict:
 def get_available_datasets(api_key: str):
     """ Get datasets that are available to download at the time of running """
     
-    api_url = "https://api.legiscan.com/?key={0}&op=getDatasetList".format(api_key)
-    r = urlopen(api_url).read().decode()
-    response = json.loads(r)
+    response = get_legiscan_client(api_key).call('getDatasetList')
     dataset_list = response.get('datasetlist')
     # logging.debug('num datasets: {}'.format(len(response)))
 
@@ -92,10 +456,8 @@ def get_dataset_content(api_key: str, session_id: int, access_key: str):
         fetch the zip encoded dataset content
     """
     
-    api_url = "https://api.legiscan.com/?key={0}&op=getDataset&id={1}&access_key={2}".format(api_key, session_id, access_key)
     logging.info('Fetching dataset for session {} '.format(session_id))
-    r = urlopen(api_url).read().decode()
-    response = json.loads(r)
+    response = get_legiscan_client(api_key).call('getDataset', id=session_id, access_key=access_key)
 
     encoded_content = response.get('dataset').get('zip')
     mime_type = response.get('dataset').get('mime_type')
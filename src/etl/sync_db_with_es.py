@@ -5,6 +5,7 @@ from src.pipeline.legiscan_updates import TODAY
 
 from src.utils.general import get_db_conn
 from src.bill_passage.feature_generation.calculate_sponsor_success_rates import calculate_bill_sponsor_success_rates
+from src.bill_passage.feature_generation.refresh_active_bills import refresh_active_bills
 
 """This script syncs up the clean schema of the DB with the elastic search indexes by droppping clean tables and recreating them"""
 
@@ -129,7 +130,7 @@ def _compare_current_and_new(db_conn):
     return checks_passed
 
 
-def sync_db_with_es():
+def sync_db_with_es(full_refresh_active_bills=False):
     """
         Syncing the database with elasticsearch.
         The process:
@@ -137,6 +138,8 @@ def sync_db_with_es():
             2. Perform some checks to ensure we have everything from current clean schema in the clean_new
             3. Drop the current clean schema and rename clean_new to clean. 
             4. If the checks didn't pass, rename clean_new to clean_bad and leave for inspection
+        The active bills of the recent dates are refreshed after a successful sync. 
+        full_refresh_active_bills recomputes every stored date instead (e.g. when older sessions were backfilled)
     """
     db_conn = get_db_conn('../../conf/local/credentials.yaml')
     cursor = db_conn.cursor()
@@ -216,6 +219,9 @@ def sync_db_with_es():
 
         logging.info('Success rates calculated!')
 
+        logging.info('Refreshing the active bills of the {} dates'.format('stored' if full_refresh_active_bills else 'recent'))
+        refresh_active_bills(db_conn, full_refresh=full_refresh_active_bills)
+
         logging.info('Data syncing is complete!')
     else:
         # TODO: A better name for the clean_bad
@@ -228,11 +234,32 @@ def sync_db_with_es():
             alter schema clean_new rename to clean_bad;
 
             -- Have to take care of the session and bill hashes tables
+            -- The hashes stored today are removed, and the previous hash of each bill/session is restored from the history
             delete from legiscan_update_metadata.bill_hashes
             where update_date = '{today}';
 
+            delete from legiscan_update_metadata.bill_hashes_history
+            where update_date = '{today}';
+
+            insert into legiscan_update_metadata.bill_hashes (bill_id, session_id, bill_hash, update_date)
+            select 
+                distinct on (bill_id, session_id) bill_id, session_id, bill_hash, update_date
+            from legiscan_update_metadata.bill_hashes_history
+            order by bill_id, session_id, update_date desc nulls last
+            on conflict (bill_id, session_id) do nothing;
+
             delete from legiscan_update_metadata.session_hashes
-            where update_date = '{today}'
+            where update_date = '{today}';
+
+            delete from legiscan_update_metadata.session_hashes_history
+            where update_date = '{today}';
+
+            insert into legiscan_update_metadata.session_hashes (session_id, state_id, session_hash, update_date)
+            select 
+                distinct on (session_id, state_id) session_id, state_id, session_hash, update_date
+            from legiscan_update_metadata.session_hashes_history
+            order by session_id, state_id, update_date desc nulls last
+            on conflict (session_id, state_id) do nothing
         """.format(today=TODAY)
 
         try:
@@ -0,0 +1,144 @@
+import os
+import sys
+import time
+import json
+import logging
+import tempfile
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from scipy import sparse
+
+from src.utils.modeling import save_sparse_feature_matrix, load_sparse_feature_matrix, parse_sparse_bow_json
+
+logging.basicConfig(level=logging.INFO, filename="../../logs/benchmark_sparse_matrix_store.DEBUG", filemode='w')
+logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
+
+"""
+    Compares the npz sparse matrix store in utils.modeling against the previous DOK-JSON store of the issue classifier
+    (FeatureMatrixCreator stored the matrix as a dictionary of keys in a JSON, and parse_sparse_bow_json densified it).
+
+    A synthetic TF-IDF like matrix is written in both formats, and for each format we report the file size,
+    the load time and the peak memory allocated while loading the matrix
+
+    usage: python benchmark_sparse_matrix_store.py [rows] [vocabulary_size] [density]
+"""
+
+
+def _reference_store_bow_json(target, matrix, vocabulary, indexes):
+    """The DOK-JSON store before the npz store. Kept as the baseline of the benchmark"""
+    id_mapping = {(str(x[0]), x[1].strftime('%Y-%m-%d')): i for i, x in enumerate(indexes)}
+
+    mat = matrix.todok()
+
+    mat = {', '.join((str(k[0]), str(k[1]))): v for k, v in mat.items()}
+    id_mapping = {', '.join(k): v for k, v in id_mapping.items()}
+
+    d = dict()
+    d['matrix'] = mat
+    d['vocabulary'] = vocabulary
+    d['id_mapping'] = id_mapping
+
+    with open(target, 'w') as f:
+        json.dump(d, f)
+
+
+def _reference_load_bow_json(source):
+    with open(source, 'r') as f:
+        return parse_sparse_bow_json(f.read())
+
+
+def _synthetic_matrix(rows, vocabulary_size, density, seed=42):
+    """ A random CSR matrix with a vocabulary and (entity_id, as_of_date) row ids"""
+    matrix = sparse.random(rows, vocabulary_size, density=density, format='csr', dtype=np.float64, random_state=seed)
+
+    vocabulary = {'word_{}'.format(i): i for i in range(vocabulary_size)}
+
+    as_of_dates = pd.date_range('2019-01-01', periods=4, freq='MS')
+    indexes = pd.MultiIndex.from_arrays(
+        [np.arange(rows), [as_of_dates[i % len(as_of_dates)] for i in range(rows)]],
+        names=['entity_id', 'as_of_date']
+    )
+
+    labels = pd.DataFrame(
+        {'reproductive_rights_label': np.random.RandomState(seed).randint(0, 2, rows)},
+        index=indexes
+    )
+
+    return matrix, vocabulary, indexes, labels
+
+
+def _measure(load_function, source):
+    """ load time (s) and the peak memory (MB) allocated while loading """
+    tracemalloc.start()
+    start = time.time()
+
+    loaded = load_function(source)
+
+    seconds = time.time() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return loaded, seconds, peak / 2**20
+
+
+def benchmark_sparse_matrix_store(rows=500, vocabulary_size=5000, density=0.01):
+    """
+    Store the same synthetic matrix as DOK-JSON and as npz, and load it back with each loader
+
+    Returns:
+        Dictionary with the file size (MB), load seconds and the peak memory (MB) of each format
+    """
+    matrix, vocabulary, indexes, labels = _synthetic_matrix(rows, vocabulary_size, density)
+
+    logging.info('Benchmarking a {} x {} matrix with {} non zero elements'.format(rows, vocabulary_size, matrix.nnz))
+
+    results = dict()
+
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        json_path = os.path.join(tmp_folder, 'matrix.json')
+        npz_path = os.path.join(tmp_folder, 'matrix.npz')
+
+        _reference_store_bow_json(json_path, matrix, vocabulary, indexes)
+        save_sparse_feature_matrix(npz_path, matrix, vocabulary, indexes, labels=labels)
+
+        json_df, json_seconds, json_peak = _measure(_reference_load_bow_json, json_path)
+        npz_mat, npz_seconds, npz_peak = _measure(load_sparse_feature_matrix, npz_path)
+
+        results['json'] = {
+            'file_mb': os.path.getsize(json_path) / 2**20,
+            'seconds': json_seconds,
+            'peak_mb': json_peak
+        }
+        results['npz'] = {
+            'file_mb': os.path.getsize(npz_path) / 2**20,
+            'seconds': npz_seconds,
+            'peak_mb': npz_peak
+        }
+
+    # Both loaders should give back the same values
+    dense_json = json_df.set_index(['entity_id', 'as_of_date']).to_numpy()
+    matches = np.allclose(dense_json, npz_mat.matrix.toarray())
+
+    for name, res in results.items():
+        logging.info('{}: file {:.2f} MB, loaded in {:.3f} s, peak memory {:.2f} MB'.format(
+            name, res['file_mb'], res['seconds'], res['peak_mb']
+        ))
+
+    if not matches:
+        logging.warning('The npz matrix does not match the JSON matrix')
+
+    speedup = results['json']['seconds'] / results['npz']['seconds'] if results['npz']['seconds'] > 0 else float('nan')
+    logging.info('The npz store loads {:.1f}x faster than the JSON store'.format(speedup))
+
+    return results
+
+
+if __name__ == '__main__':
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    vocabulary_size = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    density = float(sys.argv[3]) if len(sys.argv) > 3 else 0.01
+
+    benchmark_sparse_matrix_store(rows, vocabulary_size, density)
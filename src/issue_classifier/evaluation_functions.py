@@ -1,55 +1,50 @@
 import pandas as pd
-import logging
-import psycopg2
 
-from evaluation_metrics import get_roc_auc, get_precision_at_k, get_recall_at_k
+from src.utils.modeling import predict_scores
+from src.utils.general import copy_df_to_pg
+from src.issue_classifier.evaluation_metrics import evaluate_scores, EVALUATION_COLUMNS
+
+# Columns of the train_predictions and test_predictions tables written by the grid
+PREDICTION_COLUMNS = [
+    'model_id', 'matrix_uuid', 'experiment_hash', 'entity_id', 'as_of_date', 'issue_area', 'score', 'label_value'
+]
 
 
 def get_model_predictions(model, matrix):
     """ Get predictions from a trained model for a matrix and a issue area 
         args:
             model: The trained model
-            matrix: Matrix to be scored. Should be indexed by the (entity_id, as_of_date) and should only contain the features
+            matrix: SparseFeatureMatrix to be scored. The index has the (entity_id, as_of_date) of the rows
             type: whether train or test
     """
 
     # The model object should have a predict_proba function. 
     # TODO: Kind of confined to sklearn architecture. Generalize.
 
-    scores = model.predict_proba(matrix.values)
-
     # The score we are intersted in is the score for the "1" class
-    predictions = pd.DataFrame(scores[:, 1], index=matrix.index, columns=['score'])
+    scores = predict_scores(model, matrix.matrix)
+
+    predictions = pd.DataFrame(scores, index=matrix.index, columns=['score'])
 
     return predictions
 
 
-# TODO: Testing
 def evaluate_model(predictions, label_values, metric_groups):
-    """ calculate the evaluations for a given set of model predictions, labels and a set of metric groups"""
-
-    function_mapping = {
-        'precision@': get_precision_at_k,
-        'recall@': get_recall_at_k,
-        'roc_auc': get_roc_auc
-    }
-
-    results = dict()
+    """ calculate the evaluations for a given set of model predictions, labels and a set of metric groups
+        The scores are sorted once, and every metric and threshold is read from that ranking
+        args:
+            predictions: Dataframe indexed by entity_id, as_of_date with one column named 'score'
+            label_values: The labels in the order of the predictions (array like), 
+                or a Dataframe indexed by entity_id, as_of_date with one column named 'label_value'
+            metric_groups: The training_metric_groups or testing_metric_groups of the scoring config
 
-    for met_group in metric_groups:
-        for met in met_group['metrics']:
-            if met is 'roc_auc':
-                results[met] = function_mapping[met](predictions, label_values)
-            else:
-                for thresh_type, values in met_group['thresholds'].items():
-                    if thresh_type == 'percentiles':                   
-                        metric_vals = [{ str(k)+'pct':  function_mapping[met](predictions, label_values, k*0.01)} for k in values]
-                        results[met] = metric_vals    
-                    else:
-                        metric_vals = [{ str(k):  function_mapping[met](predictions, label_values, k)} for k in values]
-                        results[met] = metric_vals
+        return:
+            Dataframe with a row per metric and threshold (metric, parameter, value and the counts)
+    """
+    if isinstance(label_values, pd.DataFrame):
+        label_values = label_values['label_value'].reindex(predictions.index).values
 
-    return results
+    return evaluate_scores(predictions['score'].values, label_values, metric_groups)
 
 
 def write_to_predictions(
@@ -85,27 +80,39 @@ def write_to_predictions(
     # Resetting the entity_id, as_of_date indexes
     predictions = predictions.reset_index()
 
-    # TODO: Improve with OHIO
-
-    preds_tuple = [tuple(x) for x in predictions.to_numpy()]
-    # predictions.to_sql(table, engine, schema=schema, if_exists='append',index=False)
-    cols = ', '.join(list(predictions.columns))
-    cursor = engine.cursor()
-
-    q = "insert into {}.{} ({}) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)".format(
-        schema, table, cols
+    # The predictions of the model on the matrix are replaced if the task is re-run. 
+    # Not committed here, the grid commits the model and its predictions together
+    copy_df_to_pg(
+        engine=engine,
+        table_name='{}.{}'.format(schema, table),
+        df=predictions,
+        columns_to_write=PREDICTION_COLUMNS,
+        replace_where={'model_id': model_id, 'matrix_uuid': matrix_uuid, 'issue_area': issue_area},
+        commit=False
     )
-    
-    try:
-        cursor.executemany(q, preds_tuple)
-        # engine.commit()
-    except (Exception, psycopg2.DatabaseError) as error:
-        logging.error(error)
-        raise psycopg2.DatabaseError(error)
-
-    # # engine.commit()
 
 
-# TODO
-def write_to_evaluations(model_id):
-    pass
+def write_to_evaluations(engine, evaluations, model_id, evaluation_start, evaluation_end, schema, table):
+    """
+        Write the evaluations of a model to the respective evaluations table, in one COPY
+        args:
+            engine: sql engine
+            evaluations: Dataframe from evaluate_model
+            model_id: ID of the model
+            evaluation_start: The first as_of_date of the evaluated matrix
+            evaluation_end: The last as_of_date of the evaluated matrix
+    """
+    evaluations = evaluations.copy()
+    evaluations['model_id'] = model_id
+    evaluations['evaluation_start'] = evaluation_start
+    evaluations['evaluation_end'] = evaluation_end
+
+    # Replaced if the task is re-run. Committed by the grid with the model
+    copy_df_to_pg(
+        engine=engine,
+        table_name='{}.{}'.format(schema, table),
+        df=evaluations,
+        columns_to_write=['model_id', 'evaluation_start', 'evaluation_end'] + EVALUATION_COLUMNS,
+        replace_where={'model_id': model_id, 'evaluation_start': evaluation_start, 'evaluation_end': evaluation_end},
+        commit=False
+    )
@@ -1,30 +1,85 @@
+import numpy as np
 import pandas as pd 
-from sklearn.metrics import roc_auc_score
 
+# Columns of the train_evaluations and test_evaluations tables computed from the scores
+EVALUATION_COLUMNS = [
+    'metric', 'parameter', 'value', 'num_labeled_examples', 'num_labeled_above_threshold', 'num_positive_labels'
+]
 
-def _get_topk(predictions, labels, k):
-    """ get the top-k records 
-        args:
-            preditions: dataframe indexed by entity_id, as_of_date which has the 'score'
-            labels: dataframe indexed by entity_id, as_of_date that has the label_value
-            k: top percentile or top number of records to be considered.
-                Could be float or int. If float, percentile, if int num records. 
-
-        return:
-            Dataframe indexed by (entity_id, as_of_date) with columns, [score, label_value]
-    """ 
 
+def _num_records(num_recs, k):
+    """ The number of top records of a threshold. A float k <= 1 is a fraction of the records, otherwise a number of records"""
     if k <= 1:
-        num_recs = predictions.shape[0]
-        k_recs = int(num_recs * k)
-    else:
-        k_recs = k
+        return int(num_recs * k)
+
+    return int(k)
+
+
+class RankedScores:
+    def __init__(self, scores, labels):
+        """
+            The scores of a model sorted once, with the cumulative count of the positive labels.
+            All the threshold metrics and the ROC-AUC are read from the cumulative counts
+
+            Args:
+                scores: The scores of the model (array like)
+                labels: The binary labels, in the order of the scores (array like)
+        """
+        scores = np.asarray(scores, dtype=np.float64).ravel()
+        labels = np.asarray(labels).ravel()
+
+        # stable sort, so the ties keep the order of the rows as in a pandas sort_values
+        order = np.argsort(-scores, kind='mergesort')
+        self.scores = scores[order]
+        self.cum_positives = np.cumsum(labels[order] == 1)
+
+        self.num_labeled = self.scores.shape[0]
+        self.num_positives = int(self.cum_positives[-1]) if self.num_labeled > 0 else 0
+
+    def positives_at(self, k_recs):
+        if k_recs <= 0:
+            return 0
+
+        return int(self.cum_positives[min(k_recs, self.num_labeled) - 1])
+
+    def precision_at(self, k_recs):
+        """ precision of the top k_recs records"""
+        k_recs = min(k_recs, self.num_labeled)
+        if k_recs <= 0:
+            return np.nan
 
-    # combining the predictions and the labels
+        return self.positives_at(k_recs) / k_recs
+
+    def recall_at(self, k_recs):
+        """ recall of the top k_recs records"""
+        if self.num_positives == 0:
+            return np.nan
+
+        return self.positives_at(k_recs) / self.num_positives
+
+    def roc_auc(self):
+        """ Area under the ROC curve, from the true and false positives at each distinct score (as sklearn.metrics.roc_curve)"""
+        num_negatives = self.num_labeled - self.num_positives
+        if self.num_positives == 0 or num_negatives == 0:
+            return np.nan
+
+        # The last row of each group of tied scores
+        threshold_idx = np.r_[np.where(np.diff(self.scores))[0], self.num_labeled - 1]
+        tps = np.r_[0, self.cum_positives[threshold_idx]]
+        fps = np.r_[0, threshold_idx + 1 - self.cum_positives[threshold_idx]]
+
+        tpr = tps / self.num_positives
+        fpr = fps / num_negatives
+
+        # trapezoidal rule
+        return float(np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1]) / 2))
+
+
+def _rank(predictions, labels):
+    """ RankedScores of the predictions joined to the labels on (entity_id, as_of_date)"""
     joined = predictions.join(labels, how='inner')
-    top_k = joined.sort_values('score', ascending=False).iloc[:k_recs]
 
-    return top_k
+    return RankedScores(joined['score'].values, joined['label_value'].values)
 
 
 def get_precision_at_k(predictions, labels, k):
@@ -35,13 +90,10 @@ def get_precision_at_k(predictions, labels, k):
             k: top percentile or top number of records to be considered.
                 Could be float or int. If float, percentile, if int num records. 
     """   
-    top_k = _get_topk(predictions, labels, k)
-    
-    label_counts = top_k.groupby('label_value').count()['score']
-    
-    precision = label_counts.loc[1]/top_k.shape[0]
+    ranked = _rank(predictions, labels)
+
+    return ranked.precision_at(_num_records(ranked.num_labeled, k))
 
-    return precision
 
 def get_recall_at_k(predictions, labels, k):
     """
@@ -52,15 +104,10 @@ def get_recall_at_k(predictions, labels, k):
             k: top percentile or top number of records to be considered.
                 Could be float or int. If float, percentile, if int num records. 
     """
+    ranked = _rank(predictions, labels)
 
-    top_k = _get_topk(predictions, labels, k)
-    label_counts = top_k.groupby('label_value').count()['score']
+    return ranked.recall_at(_num_records(ranked.num_labeled, k))
 
-    label_counts_universe = labels.groupby('label_value').count()
-
-    recall = label_counts.loc[1]/ label_counts_universe.loc[1]
-
-    return recall
 
 def get_roc_auc(predictions, labels):
     """
@@ -68,13 +115,49 @@ def get_roc_auc(predictions, labels):
         args:
             preditions: dataframe indexed by entity_id, as_of_date which has the 'score'
             labels: dataframe indexed by entity_id, as_of_date that has the label_value
-            k: top percentile or top number of records to be considered.
-                Could be float or int. If float, percentile, if int num records. 
     """
+    return _rank(predictions, labels).roc_auc()
 
-    y_hat = predictions['score'].values
-    y = labels['label_values'].values
 
-    auc = roc_auc_score(y_true=y, y_score=y_hat)
+def evaluate_scores(scores, labels, metric_groups):
+    """ 
+        All the metrics of the metric groups from a single sort of the scores 
+        args:
+            scores: The scores of the model (array like)
+            labels: The binary labels in the order of the scores (array like)
+            metric_groups: The metric groups of the scoring config. 
+                A list of {'metrics': [precision@, recall@, roc_auc], 'thresholds': {'percentiles': [..], 'top_n': [..]}}
 
-    return auc
\ No newline at end of file
+        return:
+            Dataframe with the EVALUATION_COLUMNS, one row per metric and threshold
+    """
+    ranked = RankedScores(scores, labels)
+
+    threshold_metrics = {
+        'precision@': ranked.precision_at,
+        'recall@': ranked.recall_at
+    }
+
+    rows = list()
+    for met_group in metric_groups:
+        for met in met_group['metrics']:
+            if met == 'roc_auc':
+                rows.append((met, '', ranked.roc_auc(), ranked.num_labeled, ranked.num_labeled, ranked.num_positives))
+                continue
+
+            if met not in threshold_metrics:
+                raise ValueError('Unknown metric {}'.format(met))
+
+            for thresh_type, values in met_group.get('thresholds', dict()).items():
+                for k in values:
+                    if thresh_type == 'percentiles':
+                        parameter = '{}_pct'.format(k)
+                        k_recs = int(ranked.num_labeled * k * 0.01)
+                    else:
+                        parameter = '{}_abs'.format(k)
+                        k_recs = int(k)
+
+                    k_recs = min(k_recs, ranked.num_labeled)
+                    rows.append((met, parameter, threshold_metrics[met](k_recs), ranked.num_labeled, k_recs, ranked.num_positives))
+
+    return pd.DataFrame(rows, columns=EVALUATION_COLUMNS)
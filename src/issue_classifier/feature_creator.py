@@ -1,4 +1,6 @@
 import os
+import re
+import numpy as np
 import pandas as pd
 import logging
 import psycopg2
@@ -9,17 +11,32 @@ import json
 import tempfile
 import joblib
 
-from sklearn.feature_extraction.text import TfidfVectorizer
 from psycopg2.extras import execute_batch, Json
 from io import StringIO, BytesIO
 
 import src.utils.project_constants as constants
 
-from src.pipeline.text_preprocessing import run_preprocessing_steps
 from src.pipeline.generate_timesplits import get_time_splits
 from src.pipeline.tf_id_features import tf_idf_features
+from src.pipeline.document_term_store import DocumentTermStore
+from src.pipeline.preprocessed_text_store import PreprocessedTextStore
+from src.pipeline.es_text_fetcher import ESTextFetcher
 
 from src.utils.general import get_db_conn, read_yaml_file, get_elasticsearch_conn, format_s3_path
+from src.utils.modeling import save_sparse_feature_matrix
+
+# The issue areas of the labels_es tables. Each table has a column with the name of the issue area
+LABEL_ISSUE_AREAS = [
+    'reproductive_rights', 
+    'criminal_law_reform', 
+    'immigrant_rights', 
+    'lgbt_rights', 
+    'racial_justice', 
+    'voting_rights'
+]
+
+# Number of cohort rows fetched from the server side cursor at a time
+COHORT_FETCH_SIZE = 10000
 
 
 class FeatureMatrixCreator:
@@ -34,7 +51,8 @@ class FeatureMatrixCreator:
         es_config,
         experiment_hash,
         project_folder,
-        s3_session=None
+        s3_session=None,
+        term_store_folder=constants.DOC_TERM_COUNTS_CACHE
     ):
         """
             Creating and storing the feature matrices
@@ -48,6 +66,7 @@ class FeatureMatrixCreator:
                 experiment_hash: Hash for the experiment (str)
                 project_folder: The target folder for saving the project components. 
                                 A 'matrices' folder will be created in the project folder
+                term_store_folder: The local folder of the term counts of the preprocessed documents
         """
         self.sql_engine = engine
         self.es = es_connection
@@ -59,6 +78,13 @@ class FeatureMatrixCreator:
         self.es_config = es_config
         self.matrix_uuids = list()
         self.s3_session = s3_session
+        self.term_store_folder = term_store_folder
+        self._labels_table_ready = False
+        self.text_store = PreprocessedTextStore(
+            preprocessing_steps=self.preprocessing_steps, 
+            text_field=self.es_config['text_field'],
+            fast=self.es_config.get('fast_preprocessing', False)
+        )
 
         if project_folder[:3] == 's3:':           
             self.martrix_folder = '{}/{}'.format(project_folder, 'matrices')
@@ -75,52 +101,59 @@ class FeatureMatrixCreator:
             if not os.path.isdir(self.martrix_folder):
                 os.mkdir(self.feature_models_folder)
 
-    def _prepare_matrix(self, as_of_dates, n_jobs=-1):
-        """ Prepares the cohort, labels and text for feature creation
+    def _prepare_matrix(self, as_of_dates, term_store, n_jobs=-1):
+        """ Prepares the cohort, labels and the term counts of the documents for feature creation
             1. fetches cohort
             2. fetches labels and relevant doc_ids
-            3. Fetches text from elastic search
-            4. Runs the preprocessing steps specified in the config
+            3. Fetches text from elastic search, only for the documents that are not in the term store or the preprocessed text store
+            4. Runs the preprocessing steps specified in the config on those texts, and adds their term counts to the term store
             
             args:
                 as_of_dates: List of as_of_dates included in the matrix
+                term_store: DocumentTermStore of the preprocessing steps and the text field
             return:
-                A dataframe with 
-                    ids, as_of_date, labels, text, preprocessed text 
+                A dataframe indexed by entity_id, as_of_date with the doc_id of each row
                 matrix uuid
+                labels
 
         """
 
         ids_and_labels = self._get_cohort(as_of_dates)
-        ids = ids_and_labels[['bill_id', 'doc_id']].to_dict('records')
 
-        texts = self._retrieve_text_from_es(
-            ids, 
-            query_size=self.es_config['query_size'], 
-            text_key=self.es_config['text_field']
-        )
+        new_doc_ids = set(term_store.missing(ids_and_labels['doc_id'].unique()))
+        new_docs = ids_and_labels[ids_and_labels['doc_id'].isin(new_doc_ids)].drop_duplicates('doc_id')
+        logging.info('{} of the {} documents of the matrix are new'.format(new_docs.shape[0], ids_and_labels['doc_id'].nunique()))
 
-        # Labels, entity_id, and texts
-        master_mat = ids_and_labels.merge(texts, on=['bill_id', 'doc_id'], how='inner')
-        master_mat.rename(columns={'bill_id': 'entity_id'}, inplace=True)
+        if new_docs.shape[0] > 0:
+            # Only the texts that were never preprocessed with these steps are fetched
+            to_fetch = new_docs[new_docs['doc_id'].isin(self.text_store.missing(new_docs['doc_id']))]
 
-        # set index to bill_id, and as_of_date
-        master_mat.set_index(['entity_id', 'as_of_date'], inplace=True)
+            if to_fetch.shape[0] > 0:
+                texts = self._retrieve_text_from_es(
+                    to_fetch[['bill_id', 'doc_id']].to_dict('records'), 
+                    query_size=self.es_config['query_size'], 
+                    text_key=self.es_config['text_field']
+                )
 
-        preprocessed = run_preprocessing_steps(
-            texts=master_mat['text'], 
-            processing_steps=self.preprocessing_steps,
-            n_jobs=n_jobs
-        )
+                if texts.shape[0] > 0:
+                    self.text_store.preprocess(texts.set_index('doc_id')['text'], n_jobs=n_jobs)
+
+            preprocessed = self.text_store.get(new_docs['doc_id'])
+            term_store.add(preprocessed.index, preprocessed.values)
 
-        master_mat = master_mat.join(preprocessed) 
+        # The documents that could not be fetched are not in the store
+        master_mat = ids_and_labels[~ids_and_labels['doc_id'].isin(term_store.missing(ids_and_labels['doc_id']))]
+        master_mat = master_mat.rename(columns={'bill_id': 'entity_id'})
+
+        # set index to bill_id, and as_of_date
+        master_mat = master_mat.set_index(['entity_id', 'as_of_date'])
 
         mat_uuid = uuid.uuid4().hex
 
         # separating labels
         label_columns = [x for x in ids_and_labels.columns if '_label' in x]
         labels = master_mat[label_columns]
-        master_mat.drop(label_columns, axis=1, inplace=True)
+        master_mat = master_mat.drop(label_columns, axis=1)
 
         return master_mat, mat_uuid, labels
 
@@ -233,6 +266,15 @@ class FeatureMatrixCreator:
         feature_type = self.features_config['type']
         hp = self.features_config.get('hyperparameters') # This could be null
 
+        # Term counts of the documents, shared by all the time chops (and the previous runs with the same preprocessing)
+        term_store = DocumentTermStore(
+            folder=self.term_store_folder,
+            preprocessing_steps=self.preprocessing_steps,
+            text_field=self.es_config['text_field'],
+            tfidf_params=hp,
+            fast_preprocessing=self.text_store.fast
+        )
+
         for i, time_chop in enumerate(time_splits):
             train_as_of_dates = time_chop['train_matrix']['as_of_times']
             test_as_of_dates = time_chop['test_matrices'][0]['as_of_times']
@@ -242,25 +284,23 @@ class FeatureMatrixCreator:
 
             # train 
             logging.info('Fetching text data for train matrix')
-            train_data, train_uuid, train_labels = self._prepare_matrix(train_as_of_dates)
+            train_data, train_uuid, train_labels = self._prepare_matrix(train_as_of_dates, term_store)
 
             logging.info('Fetching text data for test matrix')
-            test_data, test_uuid, test_labels = self._prepare_matrix(test_as_of_dates)
+            test_data, test_uuid, test_labels = self._prepare_matrix(test_as_of_dates, term_store)
 
             # Keeping track of uuids
             self.matrix_uuids.append({'train': train_uuid, 'test': test_uuid})
 
             # TODO: This only handles TF-IDF. Handle other features as well
-            # Features
-            if hp is not None:
-                tf = TfidfVectorizer(**hp)
-            else:
-                tf = TfidfVectorizer()
-
-            # Training the model
-            tf.fit(train_data['preprocessed'].tolist())
+            # Features. The vocabulary and the IDF are fit on the train rows
+            logging.info('extracting the train and test sparse matrices')
+            train_features_csr, test_features_csr, tf = term_store.fit_transform(
+                train_data['doc_id'], 
+                test_data['doc_id']
+            )
 
-            model_hp = tf.get_params()
+            model_hp = term_store.tfidf_params
             feature_model_hash = self._create_feature_model_hash(feature_type, train_uuid, model_hp)
 
             # Writing to the model group
@@ -282,26 +322,22 @@ class FeatureMatrixCreator:
                 model_hash=feature_model_hash
             )
 
-            logging.info('extracting the train sparse matrix')
-            train_features_csr = tf.transform(train_data['preprocessed'].tolist())
-
-            logging.info('extracting the test sparse matrix')
-            test_features_csr = tf.transform(test_data['preprocessed'].tolist())
-
             logging.info('Beginning to store the feature matrices')
             if feature_matrix_storage_format=='sparse':
                 self._store_bow_sparse_matrix(
                     matrix=train_features_csr, 
                     vocabulary=tf.vocabulary_, 
                     indexes=train_data.index,
-                    matrix_uuid=train_uuid
+                    matrix_uuid=train_uuid,
+                    labels=train_labels
                 )
 
                 self._store_bow_sparse_matrix(
                     matrix=test_features_csr, 
                     vocabulary=tf.vocabulary_, 
                     indexes=test_data.index,
-                    matrix_uuid=test_uuid
+                    matrix_uuid=test_uuid,
+                    labels=test_labels
                 )
             else:
                 logging.warning('Storing the feature matrix as dense. Can cause memory issues')
@@ -376,52 +412,34 @@ class FeatureMatrixCreator:
 
             joblib.dump(model_object, save_target)
 
-    def _store_bow_sparse_matrix(self, matrix, vocabulary, indexes, matrix_uuid):
-        """ Store the feature matrix as a compressed sparse matrix. Combining relevant info to a dictonary and saving as a JSON
-            Using JSON to preserve the readability. Might not be the most efficient way to store this information
+    def _store_bow_sparse_matrix(self, matrix, vocabulary, indexes, matrix_uuid, labels=None):
+        """ Store the feature matrix as a compressed sparse matrix. 
+            The CSR arrays, the vocabulary, the (entity_id, as_of_date) of the rows and the labels are stored in one npz file,
+            so that the model grid can load the matrix straight into a CSR matrix (see utils.modeling.save_sparse_feature_matrix)
         
         Args:
             matrix (sparse matrix): The sparse matrix that representes the BoW
             vocabulary (Dict): vocabulary mapping to the columns indices of the sparse mat)
             indexes (pd.Index): The list of indexes (entity_id, as_of_date) that will map to the row indices of the sparse matrix
             matrix_uuid: The uuid used for governance
+            labels (pd.DataFrame): The label columns of the matrix, in the same row order as the indexes
         """
-
-        # creating the mapping between the integer indexes and the entity_ids
-        # Mapping it as a dict to keep the mappings consistent with the vocabulary
-        id_mapping = {(str(x[0]), x[1].strftime('%Y-%m-%d')): i for i, x in enumerate(indexes)}
-
-        # We convert the sparse matrix to a dictionary to make it JSON serializable. 
-        # converting the scipy sparse matrix to a dictionary of keys
-        mat = matrix.todok()
-
-        # Converting the tuple keys to string to enable JSON
-        mat = {', '.join((str(k[0]), str(k[1]))): v for k, v in mat.items()}
-        id_mapping = {', '.join(k): v for k, v in id_mapping.items()}
-
-        d = dict()
-        d['matrix'] = mat
-        d['vocabulary'] = vocabulary
-        d['id_mapping'] = id_mapping
-
-        fn = '{}.json'.format(matrix_uuid)
-        s3_bucket = constants.S3_BUCKET
+        fn = '{}.npz'.format(matrix_uuid)
 
         if self.s3_session is not None:
-            # removing the S3://<bucket-name>/ from the folder name
-            mat_folder = format_s3_path(self.martrix_folder)
-            fkey = '{}/{}'.format(mat_folder, fn)
-            s3 = self.s3_session.resource('s3')
-
-            logging.info('Storing the matrix {} at {}'.format(matrix_uuid, fkey))
-            # s3.upload_fileobj(json.dumps(d), s3_bucket, fkey)
-            s3.Bucket(s3_bucket).put_object(Key=fkey, Body=json.dumps(d))
+            target = '{}/{}'.format(self.martrix_folder, fn)
         else:
-            mat_path = os.path.join(self.martrix_folder, fn)
-            logging.info('Storing the matrix {} at {}'.format(matrix_uuid, mat_path))
-
-            with open(mat_path, 'w') as f:
-                json.dump(d, f)
+            target = os.path.join(self.martrix_folder, fn)
+
+        logging.info('Storing the matrix {} at {}'.format(matrix_uuid, target))
+        save_sparse_feature_matrix(
+            target=target,
+            matrix=matrix,
+            vocabulary=vocabulary,
+            indexes=indexes,
+            labels=labels,
+            s3_session=self.s3_session
+        )
 
     def _store_dense_feature_matrix(self, matrix, matrix_uuid):
         """ Storing a dense feature matrix as a csv in an S3 bucket/Disk """
@@ -505,155 +523,156 @@ class FeatureMatrixCreator:
         except (Exception, psycopg2.DatabaseError) as error:
             logging.error(error)
 
-    def _get_cohort(self, as_of_dates):
-        """ Fetch the set of bill ids and doc ids for a set of as_of_dates """
+    def _cohort_query_for_dates(self):
+        """ The cohort query of the config, with the as_of_date placeholder pointing to the as_of_date column of the dates list"""
+        q = self.cohort_query.strip().rstrip(';')
 
-        cohort = pd.DataFrame()
-        for aod in as_of_dates:
-            bill_ids = self._get_bill_ids_for_aod(aod)
+        # The query is run with parameters, so literal % signs are escaped
+        q = q.replace('%', '%%')
 
-            docs_labels = self._fetch_doc_ids_labels(bill_ids, aod)
-            cohort = cohort.append(docs_labels, ignore_index=True)
+        return re.sub(r"'?\{as_of_date\}'?", 'aod.as_of_date', q)
 
-        return cohort
+    def _create_labels_table(self):
+        """ Aggregates the labels_es tables into a temporary table with one row per (bill_id, doc_id). 
+            Created once per connection, and reused by the cohorts of all the time splits
+        """
+        if self._labels_table_ready:
+            return
+
+        label_ctes = ', '.join([
+            """{0} as (
+                select bill_id, doc_id, max({0}) as {0}
+                from labels_es.{0}
+                group by bill_id, doc_id
+            )""".format(x) for x in LABEL_ISSUE_AREAS
+        ])
+
+        q = """
+            create temporary table if not exists issue_area_labels on commit preserve rows as
+            with {}
+            select bill_id, doc_id, {}
+            from {}
+        """.format(
+            label_ctes,
+            ', '.join(LABEL_ISSUE_AREAS),
+            ' full outer join '.join(
+                [LABEL_ISSUE_AREAS[0]] + ['{} using(bill_id, doc_id)'.format(x) for x in LABEL_ISSUE_AREAS[1:]]
+            )
+        )
 
-    def _get_bill_ids_for_aod(self, as_of_date):
-        """ get the bill ids for an as of date """
         cursor = self.sql_engine.cursor()
-        q = self.cohort_query.format(as_of_date=as_of_date)
         try:
             cursor.execute(q)
-            
-            bill_ids = cursor.fetchall()
-            bill_ids = [x[0] for x in bill_ids]
-            
+            cursor.execute('create index if not exists issue_area_labels_idx on issue_area_labels (bill_id, doc_id)')
+            cursor.execute('analyze issue_area_labels')
             self.sql_engine.commit()
         except (Exception, psycopg2.DatabaseError) as error:
             logging.error(error)
+            self.sql_engine.rollback()
+            raise
 
-        return bill_ids
+        self._labels_table_ready = True
 
-    def _fetch_doc_ids_labels(self, bill_ids, as_of_date):
-        """ Fetch the relevant doc_id for the given cohort"""
-        cursor = self.sql_engine.cursor()
-        q = """ 
-                with all_bills as( 
-                    select bill_id, max(doc_id) as doc_id
-                    from clean.bill_docs
-                    where bill_id in {} and doc_date < '{}'
-                    group by bill_id
-                ),
-                reproductive_rights as(
-                    select bill_id, doc_id, max(relevance_score), reproductive_rights 
-                    from labels_es.reproductive_rights
-                    group by bill_id, doc_id, reproductive_rights
-                ), 
-                criminal_law as(
-                    select bill_id, doc_id, max(relevance_score), criminal_law_reform
-                    from labels_es.criminal_law_reform
-                    group by bill_id, doc_id, criminal_law_reform
-                ),
-                immigrant_rights as(
-                    select bill_id, doc_id, max(relevance_score), immigrant_rights
-                    from labels_es.immigrant_rights
-                    group by bill_id, doc_id, immigrant_rights
-                ),
-                lgbt_rights as(
-                    select bill_id, doc_id, max(relevance_score), lgbt_rights
-                    from labels_es.lgbt_rights
-                    group by bill_id, doc_id, lgbt_rights
-                ),
-                racial_justice as(
-                    select bill_id, doc_id, max(relevance_score), racial_justice
-                    from labels_es.racial_justice
-                    group by bill_id, doc_id, racial_justice
-                ),
-                voting_rights as(
-                        select bill_id, doc_id, max(relevance_score), voting_rights
-                        from labels_es.voting_rights
-                        group by bill_id, doc_id, voting_rights
-                )
-                select 
-                    bill_id, 
-                    doc_id, 
-                    coalesce(reproductive_rights, 0) as reproductive_rights_label, 
-                    coalesce(criminal_law_reform, 0) as criminal_law_reform_label, 
-                    coalesce(immigrant_rights, 0) as immigrant_rights_label, 
-                    coalesce(lgbt_rights, 0) as lgbt_rights_label, 
-                    coalesce(racial_justice, 0) as racial_justice_label, 
-                    coalesce(voting_rights, 0) as voting_rights_label
-                from all_bills 
-                    left join reproductive_rights using(bill_id, doc_id)
-                        left join criminal_law using(bill_id, doc_id)
-                            left join immigrant_rights using(bill_id, doc_id)
-                                left join lgbt_rights using(bill_id, doc_id)
-                                    left join racial_justice using(bill_id, doc_id)
-                                        left join voting_rights using(bill_id, doc_id)
-            """.format(tuple(bill_ids), as_of_date)
+    def _get_cohort(self, as_of_dates):
+        """ Fetch the set of bill ids, doc ids and labels for a set of as_of_dates. 
+            All the as_of_dates are evaluated in a single query, and the rows are streamed into typed columns 
+        """
+        self._create_labels_table()
+
+        q = """
+            with as_of_dates as (
+                select unnest(%(as_of_dates)s::timestamp[]) as as_of_date
+            ),
+            cohort as (
+                select aod.as_of_date, c.bill_id
+                from as_of_dates aod
+                    cross join lateral ({cohort_query}) c
+            ),
+            cohort_docs as (
+                select c.as_of_date, c.bill_id, max(d.doc_id) as doc_id
+                from cohort c 
+                    join clean.bill_docs d on d.bill_id = c.bill_id and d.doc_date < c.as_of_date
+                group by c.as_of_date, c.bill_id
+            )
+            select 
+                bill_id, 
+                doc_id, 
+                {labels},
+                as_of_date
+            from cohort_docs
+                left join issue_area_labels using(bill_id, doc_id)
+            order by as_of_date, bill_id
+        """.format(
+            cohort_query=self._cohort_query_for_dates(),
+            labels=', '.join(['coalesce({0}, 0) as {0}_label'.format(x) for x in LABEL_ISSUE_AREAS])
+        )
 
+        label_columns = ['{}_label'.format(x) for x in LABEL_ISSUE_AREAS]
+        columns = ['bill_id', 'doc_id'] + label_columns + ['as_of_date']
+        values = {c: list() for c in columns}
+
+        # A server side cursor, so the rows are not held twice in memory
+        cursor = self.sql_engine.cursor(name='cohort_{}'.format(uuid.uuid4().hex))
         try:
-            cursor.execute(q)
-            results = cursor.fetchall()
-            self.sql_engine.commit()
+            cursor.execute(q, {'as_of_dates': list(as_of_dates)})
 
-            # Converting the results to a dict
-            results_dict_list = [{
-                'bill_id': x[0], 
-                'doc_id': x[1], 
-                'reproductive_rights_label': x[2], 
-                'criminal_law_reform_label': x[3], 
-                'immigrant_rights_label': x[4], 
-                'lgbt_rights_label': x[5], 
-                'racial_justice_label': x[6], 
-                'voting_rights_label': x[7]}
-                for x in results
-            ]
+            rows = cursor.fetchmany(COHORT_FETCH_SIZE)
+            while rows:
+                for i, c in enumerate(columns):
+                    values[c].extend([x[i] for x in rows])
+                rows = cursor.fetchmany(COHORT_FETCH_SIZE)
 
+            cursor.close()
+            self.sql_engine.commit()
         except (Exception, psycopg2.DatabaseError) as error:
             logging.error(error)
+            self.sql_engine.rollback()
+            raise
 
-        results_df = pd.DataFrame(results_dict_list)
-        results_df['as_of_date'] = as_of_date
-        
-        return results_df
+        cohort = pd.DataFrame({
+            'bill_id': np.array(values['bill_id'], dtype=np.int64),
+            'doc_id': np.array(values['doc_id'], dtype=np.int64),
+            **{c: np.array(values[c], dtype=np.int8) for c in label_columns},
+            'as_of_date': pd.to_datetime(values['as_of_date'])
+        }, columns=columns)
+
+        logging.info('Fetched a cohort of {} rows for {} as_of_dates'.format(cohort.shape[0], len(as_of_dates)))
+
+        return cohort
 
     def _retrieve_text_from_es(self, bill_doc_ids, query_size=100, text_key='description'):
         """
-            Fetch the texts from Elastic search
+            Fetch the texts from Elastic search with concurrent mget requests
             Args:
                 bill_doc_ids: A list of dictionaries [{'bill_id':xx , 'doc_id':xx}]
-                query_size: The size of to retrieve with elastic search
+                query_size: The number of documents in an mget request
                 text_key: The key in elastic search index that contains the text.
                             Could be 'description', 'title' or 'doc'
 
             return:
-                A List of dictionaries. Each dictionary has the keys, bill_id, doc_id, text
+                A DataFrame with the columns bill_id, doc_id, text. The documents missing in the index are left out
         """
 
         # Creating the elasticsearch indexes for the bill_text index
         # document id takes the form <bill_id>_<doc_id>
         doc_indexes = ['{}_{}'.format(x['bill_id'], x['doc_id']) for x in bill_doc_ids]
 
-        # creating the chunks of IDs to handle memory
-        chunks = [doc_indexes[i:i + query_size] for i in range(0, len(doc_indexes), query_size)]
-
-        texts = list()
-        for i, chunk in enumerate(chunks):
-            logging.info('Fetching indexes for chunk {}'.format(i))
-            body = {'ids': chunk}
-            res = self.es.mget(index=constants.BILL_TEXT_INDEX, body=body, _source_includes=[text_key, 'bill_id', 'doc_id'])
-            docs = res['docs']
-
-            texts_chunk = [
-                {
-                    'bill_id': x['_source']['bill_id'],
-                    'doc_id': x['_source']['doc_id'],
-                    'text': x['_source'][text_key]
-                }
-                for x in docs
-            ]
-            texts = texts + texts_chunk
-            
-        texts = pd.DataFrame(texts)
+        fetcher = ESTextFetcher(
+            self.es, 
+            index=constants.BILL_TEXT_INDEX, 
+            source_fields=[text_key, 'bill_id', 'doc_id'], 
+            batch_size=query_size
+        )
+        texts = fetcher.fetch(doc_indexes)
+
+        if fetcher.missing:
+            logging.warning('{} of the {} documents are not in the {} index: {}'.format(
+                len(fetcher.missing), len(doc_indexes), constants.BILL_TEXT_INDEX, fetcher.missing[:10]
+            ))
+
+        texts = texts.rename(columns={text_key: 'text'})[['bill_id', 'doc_id', 'text']]
+
+        # documents without the text field are treated as missing
+        texts = texts[texts['text'].notnull()]
 
         return texts
@@ -27,7 +27,9 @@ class IssueClassifier:
         log_file,
         create_matrices=True,
         matrix_exp_hash=None,
-        s3_session=None
+        s3_session=None,
+        n_jobs=1,
+        credentials_file=None
         ):
         """
             Experiment for running issue classification
@@ -42,6 +44,8 @@ class IssueClassifier:
                 log_file: File path of the log file
                 create_matrices: Flag to indicate whether the matrix should be created or whether they already exist
                 matrix_exp_hash: The experiment hash from which the matrices are reused. If create_matrices is False, this can't be None. 
+                n_jobs: Number of processes training the model grid
+                credentials_file: Credentials file used by the model grid processes. Needed if n_jobs > 1
         """
 
         self.engine = engine
@@ -80,6 +84,8 @@ class IssueClassifier:
 
         self.matrix_creator = None
         self.modeller = None
+        self.n_jobs = n_jobs
+        self.credentials_file = credentials_file
 
     def _get_experiment_hash(self):
         """ Create the MD5 hash of the experiment"""
@@ -132,7 +138,10 @@ class IssueClassifier:
             issue_areas=self.config['issue_areas'],
             matrix_uuids=mat_uuids,
             project_folder = self.project_folder,
-            s3_session=self.s3_session
+            s3_session=self.s3_session,
+            n_jobs=self.n_jobs,
+            credentials_file=self.credentials_file,
+            scoring_config=self.config.get('scoring')
         )
 
         logging.info('Running models')
@@ -210,7 +219,7 @@ class IssueClassifier:
         q = """
                 update {0}.experiment_runs
                     set run_status=%s
-                where experiment_hash='{1}' and start_time='{2}' 
+                where experiment_hash='{1}' and start_time='{2}' and model_hash is null
             """.format(
                     self.metadata_schema,
                     self.experiment_hash,
@@ -26,6 +26,9 @@ s3_session = boto3.Session(
     aws_secret_access_key=s3_creds['aws_secret_access_key']
 )
 
+# Processes training the model grid. The grid can be resumed by re-running the same config
+n_jobs = 1
+
 # experiment configuration
 configs = os.path.join('experiment_config')
 
@@ -63,7 +66,9 @@ exp = IssueClassifier(
         log_file=log_file,
         create_matrices=rep,
         matrix_exp_hash=mat_exp_hash,
-        s3_session=s3_session
+        s3_session=s3_session,
+        n_jobs=n_jobs,
+        credentials_file=cred_file
 )
 
 exp.run()
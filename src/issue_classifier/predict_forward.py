@@ -1,7 +1,6 @@
 import os
 import sys
 import logging
-import psycopg2
 import yaml
 import pandas as pd
 
@@ -11,8 +10,10 @@ from src.utils.general import (
     get_db_conn, 
     get_boto3_session, 
     get_elasticsearch_conn, 
-    load_matrix_s3, load_model_s3
+    load_model_s3,
+    copy_df_to_pg
 )
+from src.utils.modeling import load_sparse_feature_matrix, predict_scores
 from src.issue_classifier.issue_classifier import IssueClassifier
 
 credentials_file = '../../conf/local/credentials.yaml'
@@ -121,15 +122,14 @@ def predict_issue_area(issue_area):
     )   
 
     # load the matrix
-    mat_path = '{project_path}/matrices/{matrix_uuid}.csv'.format(
+    mat_path = '{project_path}/matrices/{matrix_uuid}.npz'.format(
         project_path=project_path,
         matrix_uuid=test_matrix_uuid
     )
 
-    matrix = load_matrix_s3(
-        s3_session, 
-        matrix_path=mat_path, 
-        compression=None
+    matrix = load_sparse_feature_matrix(
+        mat_path, 
+        s3_session=s3_session
     )
  
     logging.info('Loading the model for prediction')
@@ -147,18 +147,13 @@ def predict_issue_area(issue_area):
 
 
     logging.info('Scoring the bills for issue area {}'.format(issue_area))
-    test_mat = _prepare_matrix(
-        data_df=matrix,
-        id_columns=['entity_id', 'as_of_date'],
-        label_column='outcome'
-    )
-
-    predictions = model.predict_proba(test_mat.values)
+    # Scoring the CSR matrix directly. The score of the "1" class
+    scores = predict_scores(model, matrix.matrix)
     predictions = pd.DataFrame(
-        predictions,
+        scores,
         columns=['score'],
-        index=test_mat.index
-    )  
+        index=matrix.index
+    ).reset_index()
 
     # write the predictions to the deploy schema tables
     logging.info('Writing the scores to the DB')
@@ -170,19 +165,6 @@ def predict_issue_area(issue_area):
         issue_area=issue_area
     )
 
-def _prepare_matrix(data_df, id_columns=['entity_id', 'as_of_date'], label_column='outcome'):
-    """Preparing the saved matrix for prediction"""
-
-    data_df.set_index(id_columns, inplace=True)
-
-    X = data_df.drop(
-        label_column, 
-        inplace=False, 
-        axis=1
-    ) 
-
-    return X
-
 
 def _fetch_model_id(db_conn, model_hash, issue_area):
     """Fetch the id of the used model"""
@@ -203,29 +185,20 @@ def _fetch_model_id(db_conn, model_hash, issue_area):
     return df.at[0, 'model_id']
 
 def _write_predictions_to_db(db_conn, predictions, model_id, matrix_uuid, issue_area):
-    """Write the predictions of one issue_area to the DB"""
+    """Write the predictions of one issue_area to the DB. The previous scores of the model, matrix and issue area are replaced"""
 
     predictions['model_id'] = model_id
     predictions['matrix_uuid'] = matrix_uuid
     predictions['issue_area'] = issue_area
 
-    preds_tuple = [tuple(x) for x in predictions.to_numpy()]
-    cols = ', '.join(list(predictions.columns))
-
-    cursor = db_conn.cursor()
-
-    q = """
-        insert into deploy.temp_issue_scores 
-        ({}) VALUES (%s, %s, %s, %s, %s, %s)
-    """.format(
-        cols
+    num_rows = copy_df_to_pg(
+        engine=db_conn,
+        table_name='deploy.temp_issue_scores',
+        df=predictions,
+        replace_where={'model_id': model_id, 'matrix_uuid': matrix_uuid, 'issue_area': issue_area}
     )
 
-    try:
-        cursor.executemany(q, preds_tuple)
-    except (Exception, psycopg2.DatabaseError) as error:
-        logging.error(error)
-        raise psycopg2.DatabaseError(error)
+    logging.info('Wrote {} scores of {} to the DB'.format(num_rows, issue_area))
 
 
 def _fetch_test_matrix_uuid(db_conn, experiment_hash):
@@ -10,19 +10,124 @@ import ohio.ext.pandas
 import joblib
 import boto3
 import tempfile
+import resource
+import multiprocessing as mp
 
 from typing import List, Dict
+from collections import OrderedDict, namedtuple
 from io import BytesIO
+from scipy import sparse
 
 import src.utils.project_constants as constants
 
-from src.utils.general import read_yaml_file, get_db_conn, format_s3_path
-from src.issue_classifier.evaluation_functions import get_model_predictions, write_to_predictions
-from src.utils.modeling import parse_sparse_bow_json
+from src.utils.general import read_yaml_file, get_db_conn, get_boto3_session, format_s3_path
+from src.issue_classifier.evaluation_functions import get_model_predictions, write_to_predictions, evaluate_model, write_to_evaluations
+from src.utils.modeling import (
+    load_sparse_feature_matrix, 
+    save_memmapped_feature_matrix, 
+    load_memmapped_feature_matrix, 
+    fit_model, 
+    SparseFeatureMatrix
+)
 
 logging.basicConfig(level=logging.DEBUG)
 
 
+def _peak_rss_mb():
+    """ peak resident set size of the process in MB (ru_maxrss is in KB on linux) """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# Default memory budget of the matrices held by the model grid
+MATRIX_CACHE_MB = 4096
+
+
+def _matrix_mb(mat):
+    """ memory held by a SparseFeatureMatrix in MB """
+    nbytes = mat.matrix.data.nbytes + mat.matrix.indices.nbytes + mat.matrix.indptr.nbytes + mat.vocabulary.nbytes
+    if mat.labels is not None:
+        nbytes = nbytes + mat.labels.memory_usage(index=False).sum()
+
+    return nbytes / 2**20
+
+
+# A unit of work of the grid: one model group of one issue area on one time split
+GridTask = namedtuple(
+    'GridTask', 
+    ['issue_area', 'model_type', 'hyperparameters', 'model_group_id', 'time_split_index', 'train_uuid', 'test_uuid', 'model_hash']
+)
+
+
+class MatrixCache:
+    def __init__(self, load_function, max_mb=MATRIX_CACHE_MB):
+        """
+            LRU cache of the loaded feature matrices keyed by matrix uuid. 
+            The least recently used matrices are dropped when the loaded matrices exceed the memory budget
+            args:
+                load_function : Function that loads a matrix given its uuid
+                max_mb        : Memory budget in MB. A matrix larger than the budget is still held while it is the most recent one
+        """
+        self.load_function = load_function
+        self.max_mb = max_mb
+        self.matrices = OrderedDict()
+        self.sizes = dict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, matrix_uuid):
+        if matrix_uuid in self.matrices:
+            self.hits = self.hits + 1
+            self.matrices.move_to_end(matrix_uuid)
+            return self.matrices[matrix_uuid]
+
+        self.misses = self.misses + 1
+        logging.info('loading the matrix {}'.format(matrix_uuid))
+        mat = self.load_function(matrix_uuid)
+
+        self.matrices[matrix_uuid] = mat
+        self.sizes[matrix_uuid] = _matrix_mb(mat)
+
+        while len(self.matrices) > 1 and self.size_mb() > self.max_mb:
+            lru_uuid = next(iter(self.matrices))
+            logging.info('Matrix cache over budget. Dropping the matrix {}'.format(lru_uuid))
+            self._drop(lru_uuid)
+            self.evictions = self.evictions + 1
+
+        return mat
+
+    def evict(self, matrix_uuid):
+        """ release a matrix that will not be used again """
+        if matrix_uuid in self.matrices:
+            self._drop(matrix_uuid)
+
+    def _drop(self, matrix_uuid):
+        del self.matrices[matrix_uuid]
+        del self.sizes[matrix_uuid]
+
+    def size_mb(self):
+        return sum(self.sizes.values())
+
+    def counters(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def add_counters(self, counters):
+        """ add the counters of another cache (e.g. the cache of a worker process) to the report of this one """
+        self.hits = self.hits + counters['hits']
+        self.misses = self.misses + counters['misses']
+        self.evictions = self.evictions + counters['evictions']
+
+    def report(self):
+        requests = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / requests if requests > 0 else float('nan'),
+            'evictions': self.evictions,
+            'held_mb': self.size_mb()
+        }
+
+
 class ModelGrid:
     def __init__(self, 
         engine, 
@@ -35,6 +140,10 @@ class ModelGrid:
         matrix_uuids: List[Dict],
         project_folder: str,
         s3_session=None,
+        matrix_cache_mb=MATRIX_CACHE_MB,
+        n_jobs=1,
+        credentials_file=None,
+        scoring_config=None
         ):
         """
             The class that runs the model grid for the issue area classifier
@@ -49,17 +158,27 @@ class ModelGrid:
                 matrix_uuids    : A list of dictionaries that has the train and test matrix uuids for each time split. 
                                   Each dictionary should have a 'train' and a 'test' key
                 project_folder   : The folder in disk or S3 where the project matrices and 
+                matrix_cache_mb : Memory budget (MB) of the loaded matrices kept in memory
+                n_jobs          : Number of processes training the models. The tasks are run serially if 1
+                credentials_file: The credentials file the worker processes use to connect to the db (and S3). Needed if n_jobs > 1
+                scoring_config  : The scoring section of the experiment config (training_metric_groups, testing_metric_groups). 
+                                  The models are not evaluated if None
         """
         self.sql_engine = engine
         self.metadata_schema = metadata_schema
         self.results_schema = results_schema
         self.features_schema = features_schema
         self.exp_hash = exp_hash
+        self.grid_config = grid_config
         self.model_grid = self._parse_model_grid(grid_config)
         self.issue_areas = issue_areas
         self.matrix_uuids = matrix_uuids 
         self.project_folder = project_folder
         self.s3_session = s3_session
+        self.matrix_cache = MatrixCache(self._load_matrix, max_mb=matrix_cache_mb)
+        self.n_jobs = n_jobs
+        self.credentials_file = credentials_file
+        self.scoring_config = scoring_config or dict()
 
         if self.project_folder[:3] =='s3:':
             if s3_session is None:
@@ -167,7 +286,8 @@ class ModelGrid:
         q = """
                INSERT INTO {}.models 
                 (model_hash, model_group_id, built_by_experiment, train_matrix_uuid, issue_area)
-               VALUES ({});
+               VALUES ({})
+               RETURNING model_id;
             """.format(
                 self.metadata_schema, 
                 ', '.join(['%s'] * 5)
@@ -182,37 +302,32 @@ class ModelGrid:
         )
 
         db_cursor.execute(q, var)
-
-
-        # Fetching the model_id for the written row
-        # TODO: This is hacky. Improve
-        q = f"select max(model_id) from {self.metadata_schema}.models"
-        db_cursor.execute(q)
         modid = db_cursor.fetchone()
         
         return modid[0]
 
-    def _load_feature_matrix(self, matrix_uuid, issue_area, feature_mat_format='sparse'):
+    def _load_matrix(self, matrix_uuid, feature_mat_format='sparse'):
         """ 
-            fetch the feature matrix for the uuid and the relevant label for the issue area
+            fetch the feature matrix for the uuid with all the label columns
             The matrix should be already saved on the disk. 
+
+            return:
+                SparseFeatureMatrix
         """
         
+        if feature_mat_format == 'sparse':
+            return self._load_sparse_feature_matrix(matrix_uuid)
+
         if self.s3_session is not None:
             logging.info('loading the matrix from S3')
             s3 = self.s3_session.resource('s3')
 
             s3_bucket = constants.S3_BUCKET
-            mat_folder = self.matrices_folder.lstrip('s3://{}/'.format(s3_bucket))
             # Stripping the s3://<s3_bucket>/ 
             mat_folder = format_s3_path(self.matrices_folder)
-            if feature_mat_format == 'sparse':
-                fkey = '{}/{}.json'.format(mat_folder, matrix_uuid) 
-                df = parse_sparse_bow_json(json_file=fkey)
-            else:
-                fkey = '{}/{}.csv'.format(mat_folder, matrix_uuid)
-                content = s3.Object(s3_bucket, fkey).get()['Body'].read()
-                df = pd.read_csv(BytesIO(content))
+            fkey = '{}/{}.csv'.format(mat_folder, matrix_uuid)
+            content = s3.Object(s3_bucket, fkey).get()['Body'].read()
+            df = pd.read_csv(BytesIO(content))
         else:
             try:
                 mat_path = os.path.join(self.matrices_folder, f'{matrix_uuid}.csv')
@@ -226,15 +341,54 @@ class ModelGrid:
         df.set_index(['entity_id', 'as_of_date'], inplace=True)
 
         # labels
-        logging.info('Extracting relevant label for {}'.format(issue_area))
         label_columns = [x for x in df.columns if '_label' in x]
         labels = df[label_columns]
-        relevant_label = labels[f'{issue_area}_label']
 
         # drop labels
         df.drop(label_columns, axis=1, inplace=True)
 
-        return df, relevant_label
+        mat = SparseFeatureMatrix(
+            matrix=sparse.csr_matrix(df.values), 
+            index=df.index, 
+            vocabulary=df.columns.values, 
+            labels=labels
+        )
+
+        return mat
+
+    def _load_sparse_feature_matrix(self, matrix_uuid):
+        """ 
+            fetch the BoW matrix stored as npz by the FeatureMatrixCreator.
+            The CSR arrays are loaded as they are, and the matrix is not densified
+        """
+        if self.s3_session is not None:
+            mat_path = '{}/{}.npz'.format(self.matrices_folder, matrix_uuid)
+        else:
+            mat_path = os.path.join(self.matrices_folder, f'{matrix_uuid}.npz')
+            if not os.path.isfile(mat_path):
+                raise FileNotFoundError('Matrix {} not found in the matrices folder'.format(matrix_uuid))
+
+        logging.info('loading the sparse matrix {}'.format(mat_path))
+        mat = load_sparse_feature_matrix(mat_path, s3_session=self.s3_session)
+
+        if mat.labels is None:
+            raise ValueError('Matrix {} was stored without labels'.format(matrix_uuid))
+
+        return mat
+
+    def _load_feature_matrix(self, matrix_uuid, issue_area):
+        """ 
+            fetch the feature matrix for the uuid (through the matrix cache) and the relevant label for the issue area
+
+            return:
+                SparseFeatureMatrix of the features, and the labels of the issue area as an array in the row order of the matrix
+        """
+        mat = self.matrix_cache.get(matrix_uuid)
+
+        logging.info('Extracting relevant label for {}'.format(issue_area))
+        relevant_label = mat.labels[f'{issue_area}_label'].to_numpy()
+
+        return mat, relevant_label
 
     def _store_model(self, model_obj, model_hash):
         """write the model to the disk or S3 bucket"""
@@ -257,124 +411,367 @@ class ModelGrid:
             logging.info('Storing the trained model at {}'.format(save_target))
             joblib.dump(model_obj, save_target)
        
-    def run_model_grid_issue_area(self, issue_area):
+    def _fetch_task_states(self, db_cursor):
+        """ 
+            The task rows of the experiment in the experiment_runs table
+            return:
+                Dict of model_hash -> (model_group_id, run_status)
         """
-            Run the model grid specified for a single issue area
-                1. Trains the models for all model groups
-                2. Update model_groups, and models tables
-                3. Write the train and test results to the train/test matrices
+        q = """
+            select 
+                model_hash, model_group_id, run_status
+            from {}.experiment_runs
+            where experiment_hash=%s and model_hash is not null
+        """.format(self.metadata_schema)
+
+        db_cursor.execute(q, (self.exp_hash,))
+
+        return {x[0]: (x[1], x[2]) for x in db_cursor.fetchall()}
+
+    def _write_task_state(self, db_cursor, task, status):
+        """ 
+            Record the state of a grid task (pending, running, completed, failed) in the experiment_runs table.
+            A task is a (issue area, model group, time split), and is keyed by the model hash 
         """
-        logging.info('Running model grid for issue area {}'.format(issue_area))
+        q = """
+            INSERT INTO {}.experiment_runs
+                (experiment_hash, start_time, run_status, project_folder, model_hash, issue_area, model_group_id, time_split_index)
+            VALUES (%s, now(), %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (experiment_hash, model_hash) DO UPDATE SET
+                run_status=excluded.run_status,
+                start_time=case when excluded.run_status='running' then now() else experiment_runs.start_time end,
+                end_time=case when excluded.run_status in ('completed', 'failed') then now() end
+        """.format(self.metadata_schema)
 
-        cur = self.sql_engine.cursor()
-        no_time_splits = len(self.matrix_uuids)
+        var = (
+            self.exp_hash,
+            status,
+            self.project_folder,
+            task.model_hash,
+            task.issue_area,
+            task.model_group_id,
+            task.time_split_index
+        )
 
-        # Iterate over all model types
-        for mod_type, mod_groups in self.model_grid.items():
-            mod_class = self._import_model_from_str(mod_type)
-            
-            # Iterate over all model configs in the model type (model groups)
-            for hp in mod_groups:
-                mod_group_id = self._write_to_model_groups(cur, mod_type, hp)
-
-                logging.info('Processing the model group {} , model type {}, hyperparameter {}'.format(
-                        mod_group_id, 
-                        mod_type, 
-                        hp
-                    )
-                )
-            
-                # Iterating over the timesplits
-                for i in range(no_time_splits):
-                    logging.info('Processing time chop idx: {}'.format(i))
-
-                    # Fetching uuids
-                    train_uuid = self.matrix_uuids[i]['train']
-                    test_uuid = self.matrix_uuids[i]['test']
-
-                    # creating model hash
-                    mod_hash = self._create_model_hash(mod_type, train_uuid, hp, issue_area)
-                    logging.info('Writing the model {} to the DB'.format(mod_hash))
-                    
-                    mod_id = self._write_to_models(
-                        cur, 
-                        mod_group_id, 
-                        mod_hash, 
-                        train_uuid, 
-                        issue_area
-                    )
+        db_cursor.execute(q, var)
 
-                    # matrices
-                    logging.info('loading the train matrix {}'.format(train_uuid))
-                    train_mat, train_labels = self._load_feature_matrix(train_uuid, issue_area)
-                    
-                    # model object
-                    model = mod_class(**hp)
-                    
-                    # training the model
-                    logging.info('Training the model id {}'.format(mod_id))
-                    model.fit(train_mat.values, train_labels)
-                    
-                    # Save the model
-                    logging.info('Saving the model {} to disk'.format(mod_hash))
-                    self._store_model(model, mod_hash)
-
-                    # generate train predictions
-                    logging.info(
-                        'generating predictions for the train set {} using model {}'.format(
-                            train_uuid,
-                            mod_id
+    def _plan_tasks(self, db_cursor, issue_areas):
+        """ 
+            Create the tasks of the grid: every model group of every issue area on every time split. 
+            The tasks already completed by a previous run of the experiment are left out, 
+            and the model groups written by that run are reused 
+
+            return:
+                list of GridTask to run
+        """
+        task_states = self._fetch_task_states(db_cursor)
+        tasks = list()
+        completed = 0
+
+        for issue_area in issue_areas:
+            for mod_type, mod_groups in self.model_grid.items():
+                for hp in mod_groups:
+                    hashes = [
+                        self._create_model_hash(mod_type, uuids['train'], hp, issue_area) for uuids in self.matrix_uuids
+                    ]
+
+                    # model group of a previous run of the experiment
+                    previous = [task_states[h][0] for h in hashes if h in task_states]
+                    if previous:
+                        mod_group_id = previous[0]
+                    else:
+                        mod_group_id = self._write_to_model_groups(db_cursor, mod_type, hp)
+
+                    logging.info('Model group {} , issue area {}, model type {}, hyperparameter {}'.format(
+                            mod_group_id, 
+                            issue_area,
+                            mod_type, 
+                            hp
                         )
                     )
-                    train_preds = get_model_predictions(model, train_mat)    
-
-                    logging.info('Writing predictions to the DB')
-                    # Write to predictions table
-                    write_to_predictions(
-                        engine=self.sql_engine,
-                        predictions=train_preds,
-                        model_id=mod_id,
-                        matrix_uuid=train_uuid,
-                        experiment_hash=self.exp_hash,
-                        label_values=train_labels,
-                        issue_area=issue_area,
-                        schema=self.results_schema,
-                        table='train_predictions'
-                    )
 
-                    # generate test predictions
-                    test_mat, test_labels = self._load_feature_matrix(test_uuid, issue_area)
-                    logging.info(
-                        'generating predictions for the test set {} using model {}'.format(
-                            test_uuid,
-                            mod_id
+                    for i, (uuids, mod_hash) in enumerate(zip(self.matrix_uuids, hashes)):
+                        if task_states.get(mod_hash, (None, None))[1] == 'completed':
+                            completed = completed + 1
+                            continue
+
+                        task = GridTask(
+                            issue_area=issue_area,
+                            model_type=mod_type,
+                            hyperparameters=hp,
+                            model_group_id=mod_group_id,
+                            time_split_index=i,
+                            train_uuid=uuids['train'],
+                            test_uuid=uuids['test'],
+                            model_hash=mod_hash
+                        )
+                        self._write_task_state(db_cursor, task, 'pending')
+                        tasks.append(task)
+
+        self.sql_engine.commit()
+
+        if completed > 0:
+            logging.info('Resuming the grid. {} tasks were completed by a previous run'.format(completed))
+
+        return tasks
+
+    def _train_and_predict(self, cur, task):
+        """
+            Train one model on a time split, store it and write the train and test predictions
+        """
+        issue_area = task.issue_area
+        train_uuid = task.train_uuid
+        test_uuid = task.test_uuid
+
+        logging.info('Writing the model {} to the DB'.format(task.model_hash))
+        
+        mod_id = self._write_to_models(
+            cur, 
+            task.model_group_id, 
+            task.model_hash, 
+            train_uuid, 
+            issue_area
+        )
+
+        # matrices
+        train_mat, train_labels = self._load_feature_matrix(train_uuid, issue_area)
+        
+        # model object
+        mod_class = self._import_model_from_str(task.model_type)
+        model = mod_class(**task.hyperparameters)
+        
+        # training the model
+        logging.info('Training the model id {}'.format(mod_id))
+        fit_model(model, train_mat.matrix, train_labels)
+        
+        # Save the model
+        logging.info('Saving the model {} to disk'.format(task.model_hash))
+        self._store_model(model, task.model_hash)
+
+        # generate train predictions
+        logging.info(
+            'generating predictions for the train set {} using model {}'.format(
+                train_uuid,
+                mod_id
+            )
+        )
+        train_preds = get_model_predictions(model, train_mat)    
+
+        logging.info('Writing predictions to the DB')
+        # Write to predictions table
+        write_to_predictions(
+            engine=self.sql_engine,
+            predictions=train_preds,
+            model_id=mod_id,
+            matrix_uuid=train_uuid,
+            experiment_hash=self.exp_hash,
+            label_values=train_labels,
+            issue_area=issue_area,
+            schema=self.results_schema,
+            table='train_predictions'
+        )
+        self._evaluate(mod_id, train_mat, train_preds, train_labels, 'training_metric_groups', 'train_evaluations')
+
+        # generate test predictions
+        test_mat, test_labels = self._load_feature_matrix(test_uuid, issue_area)
+        logging.info(
+            'generating predictions for the test set {} using model {}'.format(
+                test_uuid,
+                mod_id
+            )
+        )
+        test_preds = get_model_predictions(model, test_mat)
+
+        logging.info('Writing predictions to the DB')
+        # Write to predictions table
+        write_to_predictions(
+            engine=self.sql_engine,
+            predictions=test_preds,
+            model_id=mod_id,
+            matrix_uuid=test_uuid,
+            experiment_hash=self.exp_hash,
+            label_values=test_labels,
+            issue_area=issue_area,
+            schema=self.results_schema,
+            table='test_predictions'
+        )
+        self._evaluate(mod_id, test_mat, test_preds, test_labels, 'testing_metric_groups', 'test_evaluations')
+
+        logging.info('Peak RSS after model {}: {:.1f} MB'.format(mod_id, _peak_rss_mb()))
+
+    def _evaluate(self, model_id, matrix, predictions, labels, metric_groups_key, table):
+        """ Evaluate the predictions of a model with the metric groups of the scoring config, and write the evaluations"""
+        metric_groups = self.scoring_config.get(metric_groups_key)
+        if not metric_groups:
+            return
+
+        evaluations = evaluate_model(predictions, labels, metric_groups)
+
+        as_of_dates = matrix.index.get_level_values('as_of_date')
+        write_to_evaluations(
+            engine=self.sql_engine,
+            evaluations=evaluations,
+            model_id=model_id,
+            evaluation_start=as_of_dates.min(),
+            evaluation_end=as_of_dates.max(),
+            schema=self.results_schema,
+            table=table
+        )
+
+    def _run_task(self, task):
+        """ 
+            Run a grid task and record its state. 
+            The model, its predictions and the completed state are committed together, so a task that fails leaves no partial results
+            return:
+                (model_hash, final status)
+        """
+        cur = self.sql_engine.cursor()
+
+        self._write_task_state(cur, task, 'running')
+        self.sql_engine.commit()
+
+        try:
+            self._train_and_predict(cur, task)
+            self._write_task_state(cur, task, 'completed')
+            self.sql_engine.commit()
+        except Exception as error:
+            logging.error('Task {} (issue area {}, time split {}) failed: {}'.format(
+                task.model_hash, task.issue_area, task.time_split_index, error
+            ))
+            self.sql_engine.rollback()
+            self._write_task_state(cur, task, 'failed')
+            self.sql_engine.commit()
+            return task.model_hash, 'failed'
+
+        return task.model_hash, 'completed'
+
+    def _run_schedule(self, issue_areas):
+        """
+            Run the model grid for the issue areas, time split by time split
+            The train and test matrices of a time split are loaded once, every model group of every issue area 
+            is trained and scored against them, and then they are released
+                1. Trains the models for all model groups
+                2. Update model_groups, and models tables
+                3. Write the train and test results to the train/test matrices
+        """
+        cur = self.sql_engine.cursor()
+        tasks = self._plan_tasks(cur, issue_areas)
+
+        if self.n_jobs > 1:
+            results = self._run_tasks_parallel(tasks)
+        else:
+            results = list()
+
+            # Iterating over the timesplits
+            for i, uuids in enumerate(self.matrix_uuids):
+                logging.info('Processing time chop idx: {}'.format(i))
+
+                for task in [x for x in tasks if x.time_split_index == i]:
+                    logging.info('Processing the model group {} , issue area {}, model type {}, hyperparameter {}'.format(
+                            task.model_group_id, 
+                            task.issue_area,
+                            task.model_type, 
+                            task.hyperparameters
                         )
                     )
-                    test_preds = get_model_predictions(model, test_mat)
-
-                    logging.info('Writing predictions to the DB')
-                    # Write to predictions table
-                    write_to_predictions(
-                        engine=self.sql_engine,
-                        predictions=test_preds,
-                        model_id=mod_id,
-                        matrix_uuid=test_uuid,
-                        experiment_hash=self.exp_hash,
-                        label_values=test_labels,
-                        issue_area=issue_area,
-                        schema=self.results_schema,
-                        table='test_predictions'
-                    )
-                    # TODO:
-                    # 4. Evaluate model
-                    # 5. Write evaluations to DB      
-                    self.sql_engine.commit()
+                    results.append(self._run_task(task))
+
+                # The matrices of a time split are not used by the other time splits
+                self.matrix_cache.evict(uuids['train'])
+                self.matrix_cache.evict(uuids['test'])
+
+        # In parallel runs, the counters of the worker caches are added to the ones of the parent
+        logging.info('Matrix cache: {}'.format(self.matrix_cache.report()))
+
+        failed = [x[0] for x in results if x[1] == 'failed']
+        logging.info('{} tasks completed, {} failed'.format(len(results) - len(failed), len(failed)))
+
+        if failed:
+            raise RuntimeError('{} grid tasks failed. Re-run the experiment to resume them: {}'.format(len(failed), failed))
+
+    def _run_tasks_parallel(self, tasks):
+        """ 
+            Dispatch the tasks to a pool of n_jobs processes. 
+            Each matrix is loaded once and written as .npy files, which the workers memory map instead of receiving pickled copies.
+            Each worker has its own db connection and writes its own results
+        """
+        if self.credentials_file is None:
+            raise ValueError('A credentials file is needed to run the model grid in parallel')
+
+        results = list()
+        matrix_uuids = sorted(set([x.train_uuid for x in tasks] + [x.test_uuid for x in tasks]))
+
+        with tempfile.TemporaryDirectory(prefix='model_grid_') as mmap_folder:
+            for matrix_uuid in matrix_uuids:
+                logging.info('Writing the matrix {} for memory mapping'.format(matrix_uuid))
+                save_memmapped_feature_matrix(os.path.join(mmap_folder, matrix_uuid), self.matrix_cache.get(matrix_uuid))
+                self.matrix_cache.evict(matrix_uuid)
+
+            # Grouping the tasks of a time split, so that a worker reuses the matrices it mapped
+            tasks = sorted(tasks, key=lambda x: x.time_split_index)
+
+            grid_args = dict(
+                metadata_schema=self.metadata_schema,
+                results_schema=self.results_schema,
+                features_schema=self.features_schema,
+                exp_hash=self.exp_hash,
+                grid_config=self.grid_config,
+                issue_areas=self.issue_areas,
+                matrix_uuids=self.matrix_uuids,
+                project_folder=self.project_folder,
+                matrix_cache_mb=self.matrix_cache.max_mb,
+                scoring_config=self.scoring_config
+            )
 
+            logging.info('Running {} tasks on {} processes'.format(len(tasks), self.n_jobs))
+            with mp.Pool(processes=self.n_jobs, initializer=_init_worker, initargs=(self.credentials_file, grid_args, mmap_folder)) as pool:
+                for model_hash, status, cache_counters in pool.imap_unordered(_run_worker_task, tasks):
+                    self.matrix_cache.add_counters(cache_counters)
+                    logging.info('Task {} {}. {}/{} done'.format(model_hash, status, len(results) + 1, len(tasks)))
+                    results.append((model_hash, status))
+
+        return results
+       
+    def run_model_grid_issue_area(self, issue_area):
+        """
+            Run the model grid specified for a single issue area
+        """
+        logging.info('Running model grid for issue area {}'.format(issue_area))
+        self._run_schedule([issue_area])
 
     def run(self):
-        """ run the complete model grid """
+        """ run the complete model grid for all the issue areas """
+        logging.info('Classifying issue areas {}'.format(self.issue_areas))
+        self._run_schedule(self.issue_areas)
+
+
+# The model grid of a worker process of the parallel executor
+_worker_grid = None
+
+
+def _init_worker(creds_file, grid_args, mmap_folder):
+    """ A ModelGrid with the worker's own db connection, that reads the memory mapped matrices """
+    global _worker_grid
+
+    s3_session = None
+    if grid_args['project_folder'][:3] == 's3:':
+        s3_session = get_boto3_session(creds_file)
+
+    _worker_grid = ModelGrid(
+        engine=get_db_conn(creds_file),
+        s3_session=s3_session,
+        **grid_args
+    )
+    _worker_grid.matrix_cache = MatrixCache(
+        lambda matrix_uuid: load_memmapped_feature_matrix(os.path.join(mmap_folder, matrix_uuid)),
+        max_mb=grid_args['matrix_cache_mb']
+    )
+
 
-        for issue in self.issue_areas:
-            logging.info('Classifying issue area {}'.format(issue))
-            self.run_model_grid_issue_area(issue)        
+def _run_worker_task(task):
+    """ Run a task in the worker. Also returns the matrix cache counters of the task, which the parent adds to its cache report """
+    before = _worker_grid.matrix_cache.counters()
+    model_hash, status = _worker_grid._run_task(task)
+    after = _worker_grid.matrix_cache.counters()
 
+    return model_hash, status, {k: after[k] - before[k] for k in after}
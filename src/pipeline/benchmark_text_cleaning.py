@@ -0,0 +1,143 @@
+import sys
+import time
+import logging
+
+import pandas as pd
+
+from src.pipeline.text_preprocessing import (
+    preprocess_text, fast_preprocess_texts, supports_fast_preprocessing,
+    basic_denoising, fast_basic_denoising, strip_html_tags, strip_urls
+)
+
+logging.basicConfig(level=logging.INFO, filename="../../logs/benchmark_text_cleaning.DEBUG", filemode='w')
+logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
+
+"""
+    Compares the fast (vectorized) text cleaning in text_preprocessing against the token pipeline (preprocess_text per document).
+
+    The fixture corpus has bill descriptions and titles in the style of the LegiScan fields, with the cases the tokenizer
+    handles specially (contractions, quotes, abbreviations, section numbers, brackets and a few documents with markup).
+    The corpus is repeated to the requested size, and for each step list we report the seconds of both paths and
+    the number of documents where the outputs differ.
+    basic_denoising is compared against the previous version that parsed every document with BeautifulSoup
+
+    usage: python benchmark_text_cleaning.py [n_docs]
+"""
+
+FIXTURE_CORPUS = [
+    'An Act relating to abortion; amending section 18-604, Idaho Code, to revise definitions.',
+    'Prohibits abortions after detection of a fetal heartbeat; provides exceptions. Effective date.',
+    "Relating to the right of a woman to terminate a pregnancy; the state can't restrict access before viability.",
+    'Provides that a physician cannot perform an abortion unless the woman has received the information required by s. 390.0111.',
+    'Requires the Department of Health to report annually on "partial-birth" abortion statistics (see 42 U.S.C. 1983).',
+    'AN ACT to amend Tennessee Code Annotated, Title 39, Chapter 15, Part 2, relative to abortion.',
+    'Establishes the Reproductive Health Act; repeals Sections 2-5 of Public Act 99-18.',
+    "Voter ID: requires a voter's photo identification at the polls; doesn't apply to absentee ballots.",
+    'Relates to automatic voter registration at the Department of Motor Vehicles [DMV]; appropriates $1,500,000.',
+    'Restores voting rights to persons convicted of a felony upon completion of sentence -- including parole & probation.',
+    "Modifies provisions relating to immigration enforcement; law enforcement officers won't be required to inquire about status.",
+    'Creates the offense of unlawful entry; Class A misdemeanor. Punishment: up to 1 year or $2,500 fine.',
+    'Concerning bail reform... eliminates cash bail for misdemeanors; effective January 1, 2021.',
+    'Prohibits the use of solitary confinement for juveniles (persons under 18) in state facilities.',
+    "Relating to 'sanctuary' policies of local entities; provides civil penalties of $1,000 to $1,500 per day.",
+    'Amends the Criminal Code of 2012; makes a technical change in a Section concerning the short title.',
+    'A BILL to be entitled an Act to amend Code Section 16-12-141 of the O.C.G.A., relating to abortion.',
+    'Authorizes the use of body cameras by law enforcement; requires retention of recordings for 90 days.',
+    'Abortion; informed consent; 72-hour waiting period; requires ultrasound. Emergency.',
+    "Gov't may not condition funding on a provider's participation in family planning services, i.e. Title X.",
+    'Requires state agencies to verify the immigration status of applicants for public benefits; e-verify.',
+    'Relative to the death penalty; abolishes capital punishment and replaces it with life without parole.',
+    '<p>Relating to <b>voter registration</b>; allows same&nbsp;day registration at polling places.</p>',
+    'Establishes a task force on maternal mortality &amp; morbidity; sunset date 2023.',
+    'See www.legislature.gov/bills/2019 for the full text; amends ss. 101.62 and 101.64, F.S.',
+    'Reproductive health; creates "Women\'s Health Protection Act"; prohibits restrictions on abortion services.',
+    'Criminal justice reform: expungement of records; sealing of arrest records (no conviction).',
+    'Relates to the detention of immigrants in private facilities; prohibits new contracts after 2020-01-01.',
+    'HB 1234 -- An act concerning the rights of crime victims; they shouldn\'t be required to testify twice.',
+    'Elections; requires mail ballots to be received by 7 p.m. on election day. Effective date. Emergency clause.',
+]
+
+
+def _synthetic_corpus(n_docs):
+    """ The fixture corpus repeated to n_docs, with the numbers of the copies changed so the documents differ"""
+    docs = list()
+    for i in range(n_docs):
+        doc = FIXTURE_CORPUS[i % len(FIXTURE_CORPUS)]
+        docs.append(doc if i < len(FIXTURE_CORPUS) else '{} ({})'.format(doc, i))
+
+    return pd.Series(docs)
+
+
+def _reference_basic_denoising(text):
+    """basic_denoising before the markup detection. Kept as the baseline of the benchmark"""
+    text = text.lower()
+    text = strip_html_tags(text)
+    text = strip_urls(text)
+
+    return text
+
+
+def _timed(function, *args):
+    start = time.time()
+    result = function(*args)
+
+    return result, time.time() - start
+
+
+def benchmark_text_cleaning(n_docs=20000, steps_lists=None):
+    """
+    Preprocess the same corpus with the token pipeline and the fast path
+
+    Returns:
+        Dictionary with the seconds of both paths and the number of mismatching documents, per step list and for the denoising
+    """
+    if steps_lists is None:
+        steps_lists = [
+            ['remove_punctuation', 'remove_numbers', 'remove_stop_words', 'lemmatize'],
+            ['lowercase', 'remove_punctuation', 'remove_numbers'],
+        ]
+
+    texts = _synthetic_corpus(n_docs)
+    logging.info('Benchmarking the text cleaning on {} documents'.format(n_docs))
+
+    results = dict()
+
+    for steps in steps_lists:
+        if not supports_fast_preprocessing(steps):
+            logging.warning('Skipping {}. The fast path needs remove_punctuation before the token level steps'.format(steps))
+            continue
+
+        token_pipeline, token_seconds = _timed(lambda x: x.apply(lambda t: preprocess_text(t, steps)), texts)
+        fast, fast_seconds = _timed(fast_preprocess_texts, texts, steps)
+
+        key = ', '.join(steps)
+        results[key] = {
+            'token_pipeline_seconds': token_seconds,
+            'fast_seconds': fast_seconds,
+            'mismatches': int((token_pipeline != fast).sum())
+        }
+
+    reference, reference_seconds = _timed(lambda x: x.apply(_reference_basic_denoising), texts)
+    denoised, denoised_seconds = _timed(lambda x: x.apply(basic_denoising), texts)
+    fast_denoised, fast_denoised_seconds = _timed(fast_basic_denoising, texts)
+
+    results['basic_denoising'] = {
+        'token_pipeline_seconds': reference_seconds,
+        'fast_seconds': fast_denoised_seconds,
+        'mismatches': int(((reference != denoised) | (reference != fast_denoised)).sum())
+    }
+    logging.info('basic_denoising with the markup check on each document: {:.3f} s'.format(denoised_seconds))
+
+    for name, res in results.items():
+        speedup = res['token_pipeline_seconds'] / res['fast_seconds'] if res['fast_seconds'] > 0 else float('nan')
+        logging.info('{}: previous {:.3f} s, fast {:.3f} s ({:.1f}x), {} mismatching documents'.format(
+            name, res['token_pipeline_seconds'], res['fast_seconds'], speedup, res['mismatches']
+        ))
+
+    return results
+
+
+if __name__ == '__main__':
+    n_docs = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    benchmark_text_cleaning(n_docs)
@@ -0,0 +1,241 @@
+import os
+import json
+import hashlib
+import logging
+import numpy as np
+
+from collections import Counter
+from scipy import sparse
+from sklearn.feature_extraction.text import TfidfVectorizer, TfidfTransformer
+
+# The TfidfVectorizer parameters that change the terms extracted from a document.
+# The other parameters (min_df, max_df, max_features, norm, idf weighting) only depend on the corpus of a matrix
+ANALYZER_PARAMS = [
+    'input', 'encoding', 'decode_error', 'strip_accents', 'lowercase', 'preprocessor',
+    'tokenizer', 'analyzer', 'stop_words', 'token_pattern', 'ngram_range'
+]
+
+
+def _store_key(preprocessing_steps, text_field, analyzer_params, fast_preprocessing=False):
+    """ md5 of the preprocessing steps, text field and the analyzer parameters (and the fast preprocessing flag, if set) """
+    key = [preprocessing_steps, text_field, analyzer_params]
+    if fast_preprocessing:
+        key.append('fast')
+
+    s = json.dumps(key, sort_keys=True, default=str)
+
+    return hashlib.md5(s.encode()).hexdigest()
+
+
+class DocumentTermStore:
+    def __init__(self, folder, preprocessing_steps, text_field, tfidf_params=None, fast_preprocessing=False):
+        """
+            Term counts of the preprocessed documents, keyed by doc_id.
+            A document is preprocessed and tokenized once, and the matrices of every time chop are assembled from the stored counts.
+            The counts are kept for a (preprocessing steps, text field, analyzer parameters) key, and are persisted
+            as append only npz shards in <folder>/<key>, so that later runs only process new documents
+
+            Args:
+                folder: The folder of the stores
+                preprocessing_steps: The preprocessing steps of the text (List[str])
+                text_field: The field of the bill_text index the text comes from
+                tfidf_params: The hyperparameters of the TfidfVectorizer (Dict). Defaults are used if None
+                fast_preprocessing: Whether the texts come from the fast preprocessing (kept under a separate key)
+        """
+        self.tfidf_params = TfidfVectorizer(**(tfidf_params or dict())).get_params()
+        self.analyzer = TfidfVectorizer(**self.tfidf_params).build_analyzer()
+
+        analyzer_params = {k: self.tfidf_params[k] for k in ANALYZER_PARAMS}
+        self.key = _store_key(preprocessing_steps, text_field, analyzer_params, fast_preprocessing)
+        self.folder = os.path.join(folder, self.key)
+
+        # term -> column, doc_id -> row
+        self.terms = dict()
+        self.rows = dict()
+        self.counts = sparse.csr_matrix((0, 0), dtype=np.int64)
+        self.num_shards = 0
+
+        if os.path.isdir(self.folder):
+            self._load_shards()
+        else:
+            os.makedirs(self.folder)
+
+    def _load_shards(self):
+        shards = sorted([x for x in os.listdir(self.folder) if x.startswith('shard_') and x.endswith('.npz')])
+
+        matrices = list()
+        for shard in shards:
+            with np.load(os.path.join(self.folder, shard), allow_pickle=False) as npz:
+                for term in npz['new_terms']:
+                    self.terms[str(term)] = len(self.terms)
+
+                for doc_id in npz['doc_ids']:
+                    self.rows[int(doc_id)] = len(self.rows)
+
+                matrices.append(sparse.csr_matrix(
+                    (npz['data'], npz['indices'], npz['indptr']),
+                    shape=tuple(npz['shape'])
+                ))
+
+        self.num_shards = len(shards)
+        self.counts = self._stack(matrices)
+
+        logging.info('Loaded the term counts of {} documents ({} terms) from {}'.format(
+            len(self.rows), len(self.terms), self.folder
+        ))
+
+    def _stack(self, matrices):
+        """ stacking the shards, padding the columns of the older shards to the current number of terms """
+        if not matrices:
+            return sparse.csr_matrix((0, len(self.terms)), dtype=np.int64)
+
+        matrices = [sparse.csr_matrix((m.data, m.indices, m.indptr), shape=(m.shape[0], len(self.terms))) for m in matrices]
+
+        return sparse.vstack(matrices, format='csr')
+
+    def missing(self, doc_ids):
+        """ The doc_ids that are not in the store """
+        return sorted(set([int(x) for x in doc_ids if int(x) not in self.rows]))
+
+    def add(self, doc_ids, preprocessed_texts):
+        """ Tokenize the preprocessed texts with the analyzer of the vectorizer, and store their term counts
+
+            Args:
+                doc_ids: The doc_ids of the texts
+                preprocessed_texts: The preprocessed texts, in the order of the doc_ids
+        """
+        new_terms = list()
+        data, indices, indptr, new_doc_ids = list(), list(), [0], list()
+
+        for doc_id, text in zip(doc_ids, preprocessed_texts):
+            doc_id = int(doc_id)
+            if doc_id in self.rows or doc_id in new_doc_ids:
+                continue
+
+            term_counts = Counter(self.analyzer(text))
+            for term, count in term_counts.items():
+                if term not in self.terms:
+                    self.terms[term] = len(self.terms)
+                    new_terms.append(term)
+
+                indices.append(self.terms[term])
+                data.append(count)
+
+            indptr.append(len(indices))
+            new_doc_ids.append(doc_id)
+
+        if not new_doc_ids:
+            return
+
+        shard = sparse.csr_matrix(
+            (np.array(data, dtype=np.int64), np.array(indices, dtype=np.int64), np.array(indptr, dtype=np.int64)),
+            shape=(len(new_doc_ids), len(self.terms))
+        )
+
+        shard_path = os.path.join(self.folder, 'shard_{:06d}.npz'.format(self.num_shards))
+        np.savez(
+            shard_path,
+            doc_ids=np.array(new_doc_ids, dtype=np.int64),
+            new_terms=np.array(new_terms, dtype=str),
+            data=shard.data,
+            indices=shard.indices,
+            indptr=shard.indptr,
+            shape=np.array(shard.shape)
+        )
+        self.num_shards = self.num_shards + 1
+
+        for doc_id in new_doc_ids:
+            self.rows[doc_id] = len(self.rows)
+
+        self.counts = self._stack([self.counts, shard])
+
+        logging.info('Stored the term counts of {} new documents ({} new terms) at {}'.format(
+            len(new_doc_ids), len(new_terms), shard_path
+        ))
+
+    def count_matrix(self, doc_ids):
+        """ The term counts of the doc_ids (rows in the given order, a doc_id can be repeated) over all the stored terms """
+        rows = np.array([self.rows[int(x)] for x in doc_ids], dtype=np.int64)
+
+        return self.counts[rows]
+
+    def fit_transform(self, train_doc_ids, test_doc_ids):
+        """ The TF-IDF matrices of a time chop, from the stored counts
+            The vocabulary and the IDF are fit on the train rows, as TfidfVectorizer.fit does on the train texts
+
+            return:
+                train CSR matrix, test CSR matrix,
+                and a TfidfVectorizer with the fitted vocabulary and IDF, which transforms preprocessed texts the same way
+        """
+        params = self.tfidf_params
+
+        train_counts = self.count_matrix(train_doc_ids)
+        test_counts = self.count_matrix(test_doc_ids)
+
+        if params['binary']:
+            train_counts.data = np.ones_like(train_counts.data)
+            test_counts.data = np.ones_like(test_counts.data)
+
+        columns = self._fit_vocabulary(train_counts)
+        vocabulary = {term: i for i, term in enumerate(columns)}
+        column_idx = np.array([self.terms[term] for term in columns], dtype=np.int64)
+
+        train_counts = train_counts[:, column_idx].astype(params['dtype'])
+        test_counts = test_counts[:, column_idx].astype(params['dtype'])
+
+        transformer = TfidfTransformer(
+            norm=params['norm'],
+            use_idf=params['use_idf'],
+            smooth_idf=params['smooth_idf'],
+            sublinear_tf=params['sublinear_tf']
+        )
+        train_tfidf = transformer.fit_transform(train_counts)
+        test_tfidf = transformer.transform(test_counts)
+
+        # With a fixed vocabulary, fit only sets the vocabulary. The IDF of the train rows is set after
+        fitted_params = dict(params)
+        fitted_params['vocabulary'] = vocabulary
+        tf = TfidfVectorizer(**fitted_params).fit([''])
+        if params['use_idf']:
+            tf.idf_ = transformer.idf_
+
+        return train_tfidf, test_tfidf, tf
+
+    def _fit_vocabulary(self, train_counts):
+        """ The terms kept by the document frequency limits of the vectorizer (min_df, max_df, max_features)
+            Follows CountVectorizer: terms sorted alphabetically, then limited
+        """
+        params = self.tfidf_params
+        n_docs = train_counts.shape[0]
+
+        # terms seen in the train rows, sorted
+        dfs = np.bincount(train_counts.indices, minlength=train_counts.shape[1])
+        seen = np.where(dfs > 0)[0]
+        terms_by_id = np.empty(len(self.terms), dtype=object)
+        for term, i in self.terms.items():
+            terms_by_id[i] = term
+
+        order = np.argsort(terms_by_id[seen].astype(str))
+        seen = seen[order]
+        dfs = dfs[seen]
+
+        max_df, min_df = params['max_df'], params['min_df']
+        max_doc_count = max_df if isinstance(max_df, (int, np.integer)) else max_df * n_docs
+        min_doc_count = min_df if isinstance(min_df, (int, np.integer)) else min_df * n_docs
+        if max_doc_count < min_doc_count:
+            raise ValueError('max_df corresponds to < documents than min_df')
+
+        mask = (dfs <= max_doc_count) & (dfs >= min_doc_count)
+
+        limit = params['max_features']
+        if limit is not None and mask.sum() > limit:
+            tfs = np.asarray(train_counts[:, seen].sum(axis=0)).ravel()
+            mask_inds = (-tfs[mask]).argsort()[:limit]
+            new_mask = np.zeros(len(dfs), dtype=bool)
+            new_mask[np.where(mask)[0][mask_inds]] = True
+            mask = new_mask
+
+        if not mask.any():
+            raise ValueError('After pruning, no terms remain. Try a lower min_df or a higher max_df.')
+
+        return [str(x) for x in terms_by_id[seen[mask]]]
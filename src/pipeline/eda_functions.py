@@ -6,6 +6,15 @@ import logging
 
 from wordcloud import WordCloud, STOPWORDS  
 
+from src.pipeline.preprocessed_text_store import PreprocessedTextStore
+from src.pipeline.es_text_fetcher import ESTextFetcher
+
+# Number of doc_ids in a terms query
+TERMS_QUERY_SIZE = 10000
+
+# The word clouds use the lower cased tokens of the bill text
+WORD_CLOUD_PREPROCESSING_STEPS = ['lowercase']
+
 
 def setup_figure(fig_size=(12,4)):
     """Setup the figure and Axes object"""
@@ -162,36 +171,38 @@ def get_repro_bill_texts(es, db_con):
     q = """ select doc_id from temp_eda.repro_labels_all;"""
 
     repro_docids = pd.read_sql(q, db_con)
-    repro_docids = [int(x) for x in repro_docids['doc_id'].tolist()]
+    repro_docids = sorted(set([int(x) for x in repro_docids['doc_id'].tolist()]))
 
-    bill_texts=pd.DataFrame()
+    fetcher = ESTextFetcher(es, index='bill_text', source_fields=['doc', 'doc_date', 'bill_id', 'doc_id'])
 
-    for doc_id in repro_docids:
-        d = dict()
-        d['doc_id'] = int(doc_id)
-        query = {'query': {'match': {'doc_id': doc_id}}}
-        res = es.search(index='bill_text', body=query, size=100)
+    # The documents are pulled with a sliced scroll over a terms query, in chunks of doc_ids
+    batches = list()
+    for i in range(0, len(repro_docids), TERMS_QUERY_SIZE):
+        query = {'query': {'terms': {'doc_id': repro_docids[i:i + TERMS_QUERY_SIZE]}}}
+        batches.extend(fetcher.iter_scroll(query))
 
-        d['doc'] = res['hits']['hits'][0]['_source']['doc']
-        d['doc_date'] = res['hits']['hits'][0]['_source']['doc_date']
-        d['bill_id'] = res['hits']['hits'][0]['_source']['bill_id']
-
-        bill_texts = bill_texts.append(d, ignore_index=True) 
+    columns = ['doc_id', 'doc', 'doc_date', 'bill_id']
+    bill_texts = pd.concat(batches, ignore_index=True)[columns] if batches else pd.DataFrame(columns=columns)
+    bill_texts = bill_texts.drop_duplicates('doc_id')
 
+    missing = set(repro_docids) - set(bill_texts['doc_id'].astype(int))
+    if missing:
+        logging.warning('{} of the {} repro documents are not in the bill_text index'.format(len(missing), len(repro_docids)))
 
     bill_texts['doc_id'] = bill_texts['doc_id'].astype('int').astype('str')
     bill_texts['bill_id'] = bill_texts['bill_id'].astype('int').astype('str')
 
-    return bill_texts
+    return bill_texts.reset_index(drop=True)
 
 
 def _preprocess_text_for_cloud(bill_texts):
-    """ preprocessing text for word could"""
+    """ preprocessing text for word could. The lower cased texts are read from the preprocessed text store"""
+    store = PreprocessedTextStore(preprocessing_steps=WORD_CLOUD_PREPROCESSING_STEPS, text_field='doc')
 
-    # Converting to lower case
-    preprocessed = bill_texts['doc'].str.lower()
+    texts = pd.Series(bill_texts['doc'].tolist(), index=bill_texts['doc_id'].astype(int))
+    preprocessed = store.preprocess(texts)
 
-    return preprocessed
+    return pd.Series(preprocessed.loc[texts.index].tolist(), index=bill_texts.index)
 
 
 def _generate_word_list_from_docs(docs_list):
@@ -232,10 +243,7 @@ def _temp_get_words_list(es, db_con, repro_texts=None):
     # repro_texts_last = repro_texts.groupby('bill_id', as_index=False).filter(lambda s: s['doc_date']==s['doc_date'].max())
 
     logging.info('Preprocessing ')
-    # repro_texts_last['preprocessed_text'] = _preprocess_text_for_cloud(repro_texts_last)
-    repro_texts['doc'] = repro_texts['doc'].str.lower()
-    
-    doc_list = repro_texts['doc'].tolist()
+    doc_list = _preprocess_text_for_cloud(repro_texts).tolist()
 
     logging.info('releasing repro')
     del repro_texts
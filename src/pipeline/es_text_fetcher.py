@@ -0,0 +1,196 @@
+import queue
+import logging
+import threading
+import pandas as pd
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Iterator
+
+import src.utils.project_constants as constants
+
+# Number of ids in a single mget request
+MGET_BATCH_SIZE = 100
+
+# Number of mget requests (or scroll slices) in flight at a time
+MAX_CONCURRENT_REQUESTS = 4
+
+# Number of fetched batches held for the consumer before the scroll slices wait
+SCROLL_QUEUE_SIZE = 8
+
+_SLICE_DONE = object()
+
+
+class ESTextFetcher:
+    def __init__(self, es, index=constants.BILL_TEXT_INDEX, source_fields: List=None, batch_size=MGET_BATCH_SIZE, max_concurrent=MAX_CONCURRENT_REQUESTS):
+        """
+            Streams documents from an elasticsearch index as pandas DataFrames.
+            Documents are fetched by id with concurrent mget requests, or by a query with a sliced scroll.
+            Only the source_fields are returned by elasticsearch.
+            Ids that are not found are reported in self.missing instead of raising
+
+            Args:
+                es: Elasticsearch connection. The client is shared by the request threads
+                index: The index to fetch from
+                source_fields: The _source fields to fetch. All the fields if None
+                batch_size: Number of documents per mget request, or per scroll page
+                max_concurrent: Number of requests in flight at a time
+        """
+        self.es = es
+        self.index = index
+        self.source_fields = source_fields
+        self.batch_size = batch_size
+        self.max_concurrent = max(max_concurrent, 1)
+        self.missing = list()
+
+    def _source_kwargs(self):
+        if self.source_fields is None:
+            return dict()
+
+        return {'_source_includes': self.source_fields}
+
+    def _to_frame(self, docs):
+        """ One row per document, with the _id and the source fields"""
+        records = list()
+        for doc in docs:
+            record = {'_id': doc['_id']}
+            record.update(doc.get('_source', dict()))
+            records.append(record)
+
+        columns = ['_id'] + (self.source_fields or list())
+
+        return pd.DataFrame(records, columns=columns if self.source_fields is not None else None)
+
+    def _mget(self, ids):
+        res = self.es.mget(index=self.index, body={'ids': ids}, **self._source_kwargs())
+
+        found, missing = list(), list()
+        for doc in res['docs']:
+            if doc.get('found') and ('_source' in doc):
+                found.append(doc)
+            else:
+                missing.append(doc['_id'])
+
+                if 'error' in doc:
+                    logging.warning('Could not fetch {} from {}: {}'.format(doc['_id'], self.index, doc['error']))
+
+        return self._to_frame(found), missing
+
+    def iter_mget(self, ids: List) -> Iterator[pd.DataFrame]:
+        """ The documents of the ids, in batches of the mget requests and in the order of the ids.
+            At most max_concurrent requests are in flight, and the missing ids are added to self.missing
+        """
+        ids = [str(x) for x in ids]
+        batches = [ids[i:i + self.batch_size] for i in range(0, len(ids), self.batch_size)]
+
+        logging.info('Fetching {} documents from {} in {} requests'.format(len(ids), self.index, len(batches)))
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrent, thread_name_prefix='es_fetch') as executor:
+            in_flight = deque()
+            batches = iter(batches)
+
+            for batch in batches:
+                in_flight.append(executor.submit(self._mget, batch))
+                if len(in_flight) == self.max_concurrent:
+                    break
+
+            while in_flight:
+                found, missing = in_flight.popleft().result()
+
+                next_batch = next(batches, None)
+                if next_batch is not None:
+                    in_flight.append(executor.submit(self._mget, next_batch))
+
+                if missing:
+                    logging.info('{} documents were not found in {}'.format(len(missing), self.index))
+                    self.missing.extend(missing)
+
+                yield found
+
+    def fetch(self, ids: List) -> pd.DataFrame:
+        """ The documents of the ids as a single DataFrame. The missing ids are in self.missing"""
+        batches = list(self.iter_mget(ids))
+
+        if not batches:
+            return self._to_frame([])
+
+        return pd.concat(batches, ignore_index=True)
+
+    def _put(self, results, item, stop):
+        """ Waits for room in the results queue, unless the consumer stopped"""
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+
+        return False
+
+    def _scroll_slice(self, query, slice_id, num_slices, scroll, results, stop):
+        """ Scroll through one slice of the query, putting the pages in the results queue"""
+        body = dict(query)
+        if num_slices > 1:
+            body['slice'] = {'id': slice_id, 'max': num_slices}
+
+        scroll_id = None
+        try:
+            res = self.es.search(index=self.index, body=body, scroll=scroll, size=self.batch_size, **self._source_kwargs())
+            scroll_id = res.get('_scroll_id')
+            hits = res['hits']['hits']
+
+            while hits:
+                if not self._put(results, self._to_frame(hits), stop):
+                    return
+
+                res = self.es.scroll(scroll_id=scroll_id, scroll=scroll)
+                scroll_id = res.get('_scroll_id')
+                hits = res['hits']['hits']
+
+            self._put(results, _SLICE_DONE, stop)
+        except Exception as error:
+            self._put(results, error, stop)
+        finally:
+            if scroll_id is not None:
+                try:
+                    self.es.clear_scroll(scroll_id=scroll_id)
+                except Exception as error:
+                    logging.warning('Could not clear the scroll of slice {}: {}'.format(slice_id, error))
+
+    def iter_scroll(self, query, num_slices=None, scroll='5m') -> Iterator[pd.DataFrame]:
+        """ The documents matching the query, in pages of batch_size.
+            The query is split in num_slices (max_concurrent by default) scroll slices that are read in parallel,
+            so the pages do not come in a particular order
+        """
+        num_slices = num_slices or self.max_concurrent
+        results = queue.Queue(maxsize=SCROLL_QUEUE_SIZE)
+        stop = threading.Event()
+
+        threads = [
+            threading.Thread(
+                target=self._scroll_slice,
+                args=(query, i, num_slices, scroll, results, stop),
+                name='es_scroll_{}'.format(i),
+                daemon=True
+            )
+            for i in range(num_slices)
+        ]
+        for t in threads:
+            t.start()
+
+        try:
+            done = 0
+            while done < num_slices:
+                item = results.get()
+
+                if item is _SLICE_DONE:
+                    done = done + 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            # The slices stop scrolling if the consumer stops early or a slice failed
+            stop.set()
+            for t in threads:
+                t.join()
@@ -4,20 +4,22 @@ import json
 import base64
 import tempfile
 import logging
-import pickle
 import pandas as pd
 import numpy as np
 import itertools
-import boto3
+
+from io import StringIO
+
+from collections import namedtuple
 
 import src.utils.project_constants as constants
-from src.utils.decoders import html_decoder, pdf_decoder
+from src.utils.decoders import get_decoder
 
-from urllib.request import urlopen
 from zipfile import ZipFile
 from datetime import date, timedelta
 
-from src.utils.general import get_legiscan_key, get_db_conn, get_elasticsearch_conn, get_s3_credentials
+from src.utils.general import get_legiscan_key, get_db_conn, get_elasticsearch_conn, get_boto3_session, pooled_db_conn, log_pool_metrics
+from src.etl.legiscan_interface import get_legiscan_client, LegiscanResponseCache
 
 API_KEY = get_legiscan_key('../../conf/local/credentials.yaml')
 CURRENT_YEAR = date.today().year
@@ -25,7 +27,27 @@ CURRENT_YEAR = date.today().year
 # TODAY = '2021-08-11'
 TODAY = date.today()
 
-API_CALL_COUNTER = 0
+# All the API calls of the weekly update go through this client. It also keeps the count of the calls made
+LEGISCAN_CLIENT = get_legiscan_client(API_KEY)
+
+# The responses of the API calls are cached on disk, and backed up on S3. 
+# A re-run on the same day is served from the local cache without touching the network
+_response_cache = None
+
+
+def get_response_cache():
+    """The response cache of the weekly update. It is created on first use, so importing this module does not index the cache or connect to S3"""
+    global _response_cache
+
+    if _response_cache is None:
+        _response_cache = LegiscanResponseCache(
+            cache_dir=constants.LEGISCAN_RESPONSE_CACHE,
+            s3_session=get_boto3_session('../../conf/local/credentials.yaml'),
+            s3_bucket=constants.S3_BUCKET,
+            s3_prefix=constants.S3_BUCKET_LEGISCAN_UPDATES + '/response_cache'
+        )
+
+    return _response_cache
 
 
 def _track_sponsor_changes(es, bill_id, new_sponsors, bill_progress, event_history):
@@ -184,35 +206,22 @@ def _update_bill_metadata(response):
 
 
 def _decode_bill_doc_content(base64_encoded_text, mime_id):
-    decoded_text = base64.b64decode(base64_encoded_text, validate=True)
-    
-    bill_text=None
-    if mime_id == 1:
-        bill_text = html_decoder(decoded_text)
-    elif mime_id == 2:
-        try:
-            bill_text = pdf_decoder(decoded_text)
-        except Exception as e:
-            logging.warning('Error encounterd {}'.format(e))
-            bill_text = ''
-    else:
-        logging.warning('A decoder is not defined for mime_id {}'.format(mime_id))
+    # Decoded bill texts are cached on disk, so a document fetched again is not decoded twice
+    bill_text = get_decoder().decode(base64_encoded_text, mime_id)
+
+    if bill_text is None:
         logging.warning('Returning the encoded text')
         bill_text = base64_encoded_text
 
     return bill_text
 
 
-def _get_text(doc_id):
+def _store_text(response):
     """
-    Retrieves a bill doc (a text version of a bill) from Legiscan through an API call
-    :param doc_id (int): ID of the document to be fetched
+    Decodes a bill doc (a text version of a bill) fetched from Legiscan and stores it in elasticsearch
+    :param response (Dict): The getBillText response
     :return:
     """
-    api_url = "http://api.legiscan.com/?key={}&op=getBillText&id={}".format(API_KEY, doc_id)
-    r = urlopen(api_url).read().decode()
-    response = json.loads(r)
-
     if response.get('text', None) is not None:
         # there are bills with date 0000-00-00
         bill_date = response['text']['date']
@@ -278,137 +287,180 @@ def _update_session_people_es(response, session_id):
     es.index(index=constants.SESSION_PEOPLE_INDEX, id=id, body=body, request_timeout=30)
 
 
-def _check_bill_hashes(bill_hashes):
+def _stage_rows(cursor, temp_table, columns, rows):
     """
-    Verify which hashes have changed
-    :param bill_hashes: List of bill hashes
-    :return:
+    Create a temp table that is dropped at the end of the transaction and COPY the rows into it
+    
+    Args:
+        cursor: psycopg2 cursor
+        temp_table (str): Name of the temp table
+        columns (List[Tuple[str, str]]): (name, postgres type) of the columns
+        rows (List[Dict]): The rows. Need a key for every column
     """
-    db_conn = get_db_conn("../../conf/local/credentials.yaml")
-    cursor = db_conn.cursor()
-
-    q = """
-        select 
-	        distinct on (bill_id) bill_id, session_id, bill_hash, update_date
-        from legiscan_update_metadata.bill_hashes 
-        where session_id='{}'
-        order by bill_id, update_date DESC
-    """.format(
-        str(bill_hashes[0]['session_id'])
-    )
+    col_names = [c[0] for c in columns]
 
-    try:
-        cursor.execute(q)
-        our_bill_hashes = cursor.fetchall()
-        db_conn.commit()
-    except (Exception, psycopg2.DatabaseError) as error:
-        logging.error(error)
-
-    our_bill_hashes_df = pd.DataFrame(our_bill_hashes, columns=['bill_id', 'session_id', 'bill_hash', 'update_date'])
-    updated_bill_hashes_df = pd.DataFrame(bill_hashes, columns=['bill_id', 'session_id', 'state_id', 'bill_hash', 'file_name'])
-
-    # check for updates
-    df = updated_bill_hashes_df.merge(our_bill_hashes_df, how="left", on=['bill_id'],
-                                      suffixes=["_updated", "_ours"])
+    cursor.execute('create temp table {} ({}) on commit drop'.format(
+        temp_table, ', '.join(['{} {}'.format(c, t) for c, t in columns])
+    ))
 
-    updated_bills = df[df.bill_hash_updated != df.bill_hash_ours]
+    csv_buffer = StringIO()
+    pd.DataFrame(rows, columns=col_names).to_csv(csv_buffer, index=False, header=False, sep='\t')
+    csv_buffer.seek(0)
 
-    return updated_bills.to_dict("records")
+    cursor.copy_from(csv_buffer, temp_table, sep='\t', columns=col_names)
 
 
-def _get_bill_hashes(bills_session):
+def _check_bill_hashes(bill_hashes):
     """
-    Retrieves the bill hashes of a specific session
-    :param bills_session: Bills in a session list
-    :return:
+    Verify which hashes have changed. 
+    The fetched hashes are staged in a temp table and compared with the latest hash we have for each bill in one join
+    :param bill_hashes: List of bill hashes
+    :return: The new bills and the bills with a different hash
     """
-    bills_hashes = []
-    for file_name, element in bills_session.items():
-        bill_json = json.loads(element)
-        bills_hashes.append(
-            {
-                'bill_id': str(bill_json['bill']['bill_id']),
-                'session_id': str(bill_json['bill']['session_id']),
-                'state_id': str(bill_json['bill']['state_id']),
-                'bill_hash': bill_json['bill']['change_hash'],
-                'file_name': file_name
-            }
+    if len(bill_hashes) == 0:
+        return []
+
+    columns = ['bill_id', 'session_id_updated', 'state_id', 'bill_hash_updated', 'file_name', 'session_id_ours', 'bill_hash_ours', 'update_date']
+
+    q = """
+        with ours as (
+            select 
+                distinct on (h.bill_id) h.bill_id, h.session_id, h.bill_hash, h.update_date
+            from legiscan_update_metadata.bill_hashes h join fetched_bill_hashes f using (bill_id)
+            order by h.bill_id, h.update_date desc
         )
+        select 
+            f.bill_id, f.session_id, f.state_id, f.bill_hash, f.file_name, 
+            o.session_id, o.bill_hash, o.update_date
+        from fetched_bill_hashes f left join ours o using (bill_id)
+        where o.bill_hash is distinct from f.bill_hash
+    """
 
-    return bills_hashes
+    updated_bills = []
+    with pooled_db_conn("../../conf/local/credentials.yaml") as db_conn:
+        cursor = db_conn.cursor()
 
+        try:
+            _stage_rows(
+                cursor, 
+                'fetched_bill_hashes', 
+                [('bill_id', 'varchar'), ('session_id', 'varchar'), ('state_id', 'varchar'), ('bill_hash', 'varchar'), ('file_name', 'varchar')],
+                bill_hashes
+            )
+            cursor.execute(q)
+            updated_bills = [dict(zip(columns, row)) for row in cursor.fetchall()]
+            db_conn.commit()
+        except (Exception, psycopg2.DatabaseError) as error:
+            logging.error(error)
+            db_conn.rollback()
+            # An empty list would read as "no bill changed", and the new session hash would be stored without updating the bills
+            raise error
 
-def _get_bills_from_dataset(zip_file_content):
-    """
-    Reads the zip file and filter the bills from the dataset
-    :param zip_file_content (base64 encoded zip): The zipped dataset
-    :return:
-    """
-    decoded_text = base64.b64decode(zip_file_content['dataset']['zip'])
-    fp = tempfile.TemporaryFile()
-    fp.write(decoded_text)
-    zip_ref = ZipFile(fp, 'r')
+    return updated_bills
 
-    # bills_session = []
-    bills_session = {}
 
-    for file_name in zip_ref.namelist():
-        temp = file_name.split('/')
-        fkey = temp[-2]
-        if fkey == 'bill':
-            bills_session[file_name] = zip_ref.read(file_name).decode('utf-8')
-            # bills_session.append(zip_ref.read(file_name).decode('utf-8'))
+# A file in a session dataset. The kind is the folder of the file in the zip archive (bill, people, text, vote)
+DatasetRecord = namedtuple('DatasetRecord', ['kind', 'file_name', 'content'])
 
-    return bills_session
+# Number of base64 characters decoded at a time when writing the dataset zip to disk
+BASE64_BLOCK_SIZE = 4 * 1024 * 1024
 
 
-def _get_people_from_dataset(zip_file_content):
-    """
-    Reads the zip file and filter people files from the dataset
-    args:
-        zip_file_content (base64 encoded zip): The zipped dataset 
+class LegiscanDataset:
     """
+    Single pass reader of a session dataset (the zipped json files returned by getDataset).
 
-    decoded_text = base64.b64decode(zip_file_content['dataset']['zip'])
-    fp = tempfile.TemporaryFile()
-    fp.write(decoded_text)
-    zip_ref = ZipFile(fp, 'r')
-
-    people_session = {}
-    for file_name in zip_ref.namelist():
-        temp = file_name.split('/')
-        fkey = temp[-2]
-        if fkey == 'people':
-            people_session[file_name] = zip_ref.read(file_name).decode('utf-8')
+    The base64 encoded zip is decoded once, block by block, into a temporary file and the zip members are read lazily, one at a time.
+    So, the memory use is bounded by the largest member rather than the whole archive.
+    When the dataset is opened, the bill hashes, the people hashes and the session_id are collected in one pass over the bill and people files.
+    The content of any file can be fetched again by its name (dataset[file_name]), e.g. for the bills that need to be updated
+    """
 
-    return people_session
+    def __init__(self, zip_file_content):
+        """
+        Args:
+            zip_file_content (Dict): The getDataset response. The zip is base64 encoded in zip_file_content['dataset']['zip']
+        """
+        self._fp = tempfile.TemporaryFile()
+        self._write_zip(zip_file_content['dataset']['zip'])
+        self._zip = ZipFile(self._fp, 'r')
+
+        self.bill_hashes = []
+        self.people = []
+        self.session_id = None
+
+        self._index_bills_and_people()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __getitem__(self, file_name):
+        """The content of a file in the dataset as a (json) string"""
+        return self._zip.read(file_name).decode('utf-8')
+
+    def close(self):
+        self._zip.close()
+        self._fp.close()
+
+    def _write_zip(self, encoded_zip):
+        """Decode the base64 zip into the temp file in blocks, carrying over the characters that don't make a complete 4 character group"""
+        carry = ''
+        for i in range(0, len(encoded_zip), BASE64_BLOCK_SIZE):
+            block = carry + ''.join(encoded_zip[i:(i + BASE64_BLOCK_SIZE)].split())
+            cut = len(block) - (len(block) % 4)
+            self._fp.write(base64.b64decode(block[:cut]))
+            carry = block[cut:]
+
+        if carry:
+            self._fp.write(base64.b64decode(carry))
+
+        self._fp.flush()
+
+    def _index_bills_and_people(self):
+        for record in self.iter_records(kinds=('bill', 'people')):
+            if record.kind == 'bill':
+                bill = record.content['bill']
+                self.bill_hashes.append({
+                    'bill_id': str(bill['bill_id']),
+                    'session_id': str(bill['session_id']),
+                    'state_id': str(bill['state_id']),
+                    'bill_hash': bill['change_hash'],
+                    'file_name': record.file_name
+                })
+
+                # This assumes that all bills have a session_id in their json and the session_id is the same
+                # We take the session_id of the first bill we encounter while traversing the zip content
+                if self.session_id is None:
+                    self.session_id = bill['session']['session_id']
+            else:
+                person = record.content['person']
+                self.people.append({
+                    'file_name': record.file_name,
+                    'people_id': person['people_id'],
+                    'person_hash': person['person_hash']
+                })
+
+    def iter_records(self, kinds=None):
+        """
+        Iterate over the files of the dataset, loading one file at a time
+        Args:
+            kinds (Tuple[str]): The kinds of files to read (bill, people, text, vote). If None, all files are read
+        """
+        for file_name in self._zip.namelist():
+            temp = file_name.split('/')
 
+            # Skipping directory entries
+            if (len(temp) < 2) or file_name.endswith('/'):
+                continue
 
-def _get_session_id_from_dataset(zip_file_content):
-    """
-    Reads the zip file and retrieves the Legiscan given session_id for the session being processed
-    args:
-        zip_file_content (base64 encoded zip): The zipped dataset 
-    """
-    decoded_text = base64.b64decode(zip_file_content['dataset']['zip'])
-    fp = tempfile.TemporaryFile()
-    fp.write(decoded_text)
-    zip_ref = ZipFile(fp, 'r')
+            kind = temp[-2]
+            if (kinds is not None) and (kind not in kinds):
+                continue
 
-    # This assumes that all bills have a session_id in their json and the session_id is the same
-    # We take the session_id of the first bill we encounter while traversing the zip content
-    session_id = None
-    
-    for file_name in zip_ref.namelist():
-        temp = file_name.split('/')
-        fkey = temp[-2]
-        if fkey=='bill':
-            content = zip_ref.read(file_name).decode('utf-8')
-            content = json.loads(content)
-            session_id = content['bill']['session']['session_id']
-            break
-    
-    return session_id
+            yield DatasetRecord(kind, file_name, json.loads(self[file_name]))
 
 
 def get_datasetlist_from_api():
@@ -416,44 +468,15 @@ def get_datasetlist_from_api():
     Get the datasetlist for the weekly updates from Legiscan
     :return: List of all active sessions
     """
-
-    api_url = "https://api.legiscan.com/?key={}&op=getDatasetList".format(API_KEY)
-
-    s3_creds = get_s3_credentials("../../conf/local/credentials.yaml")
-
-    session = boto3.Session(
-        aws_access_key_id = s3_creds['aws_access_key_id'],
-        aws_secret_access_key = s3_creds['aws_secret_access_key']
-    )
-    s3 = session.resource('s3')
-
-    key = constants.S3_BUCKET_LEGISCAN_UPDATES + '/datasetlist/' + str(TODAY) + '/datasetlist_' + str(TODAY) + ".pkl"
-
-    # check if we need to call API or retrieve data from S3
-    api_calls = 0
-    try:
-        obj = s3.Object(constants.S3_BUCKET, key).get()['Body'].read()
-        response = pickle.loads(obj)
-        logging.info('File in S3. No need for an API call')
-    except Exception as error:
-        # key doesn't exist, then call API
-        logging.warning(error)
-        logging.info('The dataset does not exist. Calling the API')
-        
-        # API_CALL_COUNTER = API_CALL_COUNTER + 1
-        # logging.info('API calls so far (in this run): {}'.format(API_CALL_COUNTER))
-        
-        r = urlopen(api_url).read().decode()
-        response = json.loads(r)
-        api_calls += 1
-
-        file_name = "datasetlist_" + str(TODAY) + ".pkl"
-
-        # store sessions in s3 bucket
-        pickle_data = pickle.dumps(response)
-
-        key = constants.S3_BUCKET_LEGISCAN_UPDATES + '/datasetlist/' + str(TODAY) + '/' + file_name
-        s3.Object(constants.S3_BUCKET, key).put(Body=pickle_data)
+    # The datasetlist is fetched once a day
+    response = get_response_cache().get('getDatasetList', TODAY)
+    
+    if response is None:
+        logging.info('The datasetlist of {} is not cached. Calling the API'.format(TODAY))
+        response = LEGISCAN_CLIENT.call('getDatasetList')
+        get_response_cache().put('getDatasetList', TODAY, response)
+    else:
+        logging.info('Datasetlist in the cache. No need for an API call')
 
     status = response['status']
 
@@ -478,109 +501,76 @@ def get_datasetlist_from_api():
     states_with_current_sessions = [x['state_id'] for x in current_sessions]
     logging.info('States with datasets in {}: {}'.format(CURRENT_YEAR, states_with_current_sessions))
 
-    return current_sessions, api_calls
+    return current_sessions
 
 
-def get_dataset_from_api(session_id, access_key):
+def get_dataset_from_api(session_id, access_key, session_hash):
     """
-    Fetches the dataset from legiscan through an API call and saves it on S3
+    Fetches the dataset from legiscan through an API call and caches it, unless the dataset with that hash is already cached
     :param session_id: Session id to look for on Legiscan API
     :param access_key: Access key associated to the session id
+    :param session_hash: The dataset_hash of the session in the datasetlist
     :return:
     """
+    # Looking up the local and S3 tiers before calling the API. The dataset is only parsed later, by review_dataset
+    if get_response_cache().fetch_to_local('getDataset', session_id, session_hash):
+        return
 
-    api_url = "https://api.legiscan.com/?key={}&op=getDataset&id={}&access_key={}"\
-        .format(API_KEY, session_id, access_key)
-
-    # check if we already have the pkl for the session data
-    s3_creds = get_s3_credentials("../../conf/local/credentials.yaml")
+    logging.warning('The dataset for the session {} is not cached. Fetching it through an API call'.format(session_id))
+    response = LEGISCAN_CLIENT.call('getDataset', id=session_id, access_key=access_key)
 
-    session = boto3.Session(
-        aws_access_key_id=s3_creds['aws_access_key_id'],
-        aws_secret_access_key=s3_creds['aws_secret_access_key']
-    )
-    s3 = session.resource('s3')
-
-    file_name = "session_info_" + str(session_id) + "_" + str(TODAY) + ".pkl"
-
-    key = constants.S3_BUCKET_LEGISCAN_UPDATES + '/dataset/' + str(TODAY) + '/' + file_name
-
-    api_calls = 0
-    try:
-        obj = s3.Object(constants.S3_BUCKET, key).get()['Body'].read()
-    except Exception as error:
-        # no pkl for that key
-        logging.warning(error)
-        logging.warning('The dataset for the session is not on the S3 bucket. Fetchiing it through an API call')
-        r = urlopen(api_url).read().decode()
-        api_calls += 1
-
-        response = json.loads(r)
-
-        # store in s3 bucket
-        pickle_data = pickle.dumps(response)
-        s3.Object(constants.S3_BUCKET, key).put(Body=pickle_data)
-
-    return api_calls
+    # Errors are not cached, so that they are retried on the next run
+    if response.get('status') == 'OK':
+        get_response_cache().put('getDataset', session_id, response, dataset_hash=session_hash)
 
 
 def review_dataset(current_session):
     """
-    Review the pkl files obtained from legiscan and organize them by type
+    Load the cached dataset of a session obtained from legiscan and open the dataset for reading
     args:
-        current_session (str): The file name of the pickle file
+        current_session (Dict): The session from check_session_updates. Needs the session_id and the session_hash_update
+    
+    return:
+        LegiscanDataset. None if the dataset could not be parsed
     """
-    s3_creds = get_s3_credentials("../../conf/local/credentials.yaml")
-
-    session = boto3.Session(
-        aws_access_key_id=s3_creds['aws_access_key_id'],
-        aws_secret_access_key=s3_creds['aws_secret_access_key']
-    )
+    response = get_response_cache().get('getDataset', current_session['session_id'], current_session['session_hash_update'])
 
-    file_name = current_session
-    s3_resource = session.resource('s3')
+    if response is None:
+        logging.error('The dataset of session {} was not fetched'.format(current_session['session_id']))
+        return None
 
-    obj = s3_resource.Object(constants.S3_BUCKET, file_name).get()['Body'].read()
-    response = pickle.loads(obj)
     status = response['status']
 
+    dataset = None
     if status == 'OK':
-        bills_session = _get_bills_from_dataset(response)
-        bill_hashes = _get_bill_hashes(bills_session)
-
-        people_session = _get_people_from_dataset(response)
-        session_id = _get_session_id_from_dataset(response)
+        dataset = LegiscanDataset(response)
     else:
         # logging.info("Error while retrieving the datasetlist from Legiscan", status)
-        logging.error("Error while retrieving the datasetlist from Legiscan", status)
-        logging.warning('Was not able to parse the dataset {}'.format(current_session))
+        logging.error("Error while retrieving the datasetlist from Legiscan {}".format(status))
+        logging.warning('Was not able to parse the dataset {}'.format(current_session['session_id']))
 
-    return bill_hashes, bills_session, people_session, session_id
+    return dataset
 
 
-def check_bill_updates(current_session):
+def check_bill_updates(dataset):
     """
     Check which bills for each session had changed
-    :param current_session: Sessions that change on last week
-    :return:
+    :param dataset (LegiscanDataset): The dataset of a session that changed last week
+    :return: The bills that changed, and the dataset to read their contents from
     """
     #get_dataset_from_api(current_session['session_id'], current_session['access_key'])
-    bill_hashes, bills_session, _ , _= review_dataset(current_session)
-    bills_updated = _check_bill_hashes(bill_hashes)
+    bills_updated = _check_bill_hashes(dataset.bill_hashes)
 
-    return bills_updated, bills_session
+    return bills_updated, dataset
 
 
-def check_people_updates(current_session):
+def check_people_updates(dataset):
     """
     Check for new people in the session
     args:
-        current_session (str): The file name of the session being processed
+        dataset (LegiscanDataset): The dataset of the session being processed
     """
-    _, _ , people_session, session_id = review_dataset(current_session)
-
-    db_conn = get_db_conn("../../conf/local/credentials.yaml")
-    cursor = db_conn.cursor()
+    session_id = dataset.session_id
 
     q = """
     select 
@@ -591,27 +581,22 @@ def check_people_updates(current_session):
         where session_id={} 
     """.format(session_id)
 
-    try:
-        cursor.execute(q)
-        people_in_db = cursor.fetchall()
-        people_in_db = pd.DataFrame(people_in_db, columns=['people_id', 'person_hash'])
-    except (Exception, psycopg2.DatabaseError) as error:
-        logging.error(error)
-        people_in_db = pd.DataFrame(columns=['people_id', 'person_hash'])
+    with pooled_db_conn("../../conf/local/credentials.yaml") as db_conn:
+        cursor = db_conn.cursor()
+
+        try:
+            cursor.execute(q)
+            people_in_db = cursor.fetchall()
+            people_in_db = pd.DataFrame(people_in_db, columns=['people_id', 'person_hash'])
+        except (Exception, psycopg2.DatabaseError) as error:
+            logging.error(error)
+            people_in_db = pd.DataFrame(columns=['people_id', 'person_hash'])
 
     
     logging.debug('number of people in the db for the session: {}'.format(people_in_db.shape[0]))
     logging.debug(people_in_db.head(2))
 
-    people_in_legiscan = pd.DataFrame()
-    for fn, content in people_session.items():
-        content = json.loads(content)
-        d = dict()
-        d['file_name'] = fn
-        d['people_id'] = content['person']['people_id']
-        d['person_hash'] = content['person']['person_hash']
-
-        people_in_legiscan = people_in_legiscan.append(d, ignore_index=True)
+    people_in_legiscan = pd.DataFrame(dataset.people, columns=['file_name', 'people_id', 'person_hash'])
     
     logging.debug('number of people in the dataset for the session: {}'.format(people_in_legiscan.shape[0]))
     logging.debug(people_in_legiscan.head(2))
@@ -626,7 +611,7 @@ def check_people_updates(current_session):
     else:
         updated_people = people_in_legiscan
         
-    return updated_people.to_dict("records"), people_session, session_id 
+    return updated_people.to_dict("records"), dataset, session_id 
 
 
 def check_session_updates(current_sessions):
@@ -635,20 +620,20 @@ def check_session_updates(current_sessions):
     :param current_sessions: Sessions that are in session this year
     :return:
     """
-    db_conn = get_db_conn('../../conf/local/credentials.yaml')
-    cursor = db_conn.cursor()
-
     # get sessions that we have
     q = "select session_id, state_id, session_hash from legiscan_update_metadata.session_hashes;"
 
-    try:
-        logging.info('writing dataset entry to the database')
-        # cursor.execute(q, current_sessions)
-        cursor.execute(q)
-        our_hashes = cursor.fetchall()
-        # db_conn.commit()
-    except (Exception, psycopg2.DatabaseError) as error:
-        logging.error(error)
+    with pooled_db_conn('../../conf/local/credentials.yaml') as db_conn:
+        cursor = db_conn.cursor()
+
+        try:
+            logging.info('writing dataset entry to the database')
+            # cursor.execute(q, current_sessions)
+            cursor.execute(q)
+            our_hashes = cursor.fetchall()
+            # db_conn.commit()
+        except (Exception, psycopg2.DatabaseError) as error:
+            logging.error(error)
 
     update_hashes_df = pd.DataFrame(current_sessions, columns=['state_id', 'session_id', 'session_hash', 'year_end', 'year_start',
                                                               'access_key'])
@@ -669,36 +654,39 @@ def check_session_updates(current_sessions):
     return updates.to_dict('records')
 
 
-def check_bill_text_updates(bill_id, bill_texts):
+def check_bill_text_updates(bill_texts):
     """
-    Check for new bill text versions 
+    Check for new bill text versions of a set of bills with one join against the bill_docs we have
     args:
-        bill_id (int): ID of the bill
-        bill_texts (List[Dict]): The 'texts' field from the bill json returned from Legican getBill
+        bill_texts (List[Dict]): The bill_id and doc_id of the text versions listed in the bill jsons (the 'texts' field of getBill)
+    
+    return:
+        The doc_ids that exist in Legiscan but not in our DB
     """
-
-    db_conn = get_db_conn("../../conf/local/credentials.yaml")
-    cursor = db_conn.cursor()
+    if len(bill_texts) == 0:
+        return set()
 
     q = """
         select 
-            doc_id
-        from clean.bill_docs
-        where bill_id = {}
-    """.format(bill_id)
-
-    try:
-        cursor.execute(q)
-        docs_in_db = cursor.fetchall()
-        docs_in_db = set([x[0] for x in docs_in_db])
-    except (Exception, psycopg2.DatabaseError) as error:
-        logging.error(error)
-        docs_in_db = set([])
+            distinct f.doc_id
+        from fetched_bill_docs f left join clean.bill_docs d on d.bill_id = f.bill_id and d.doc_id = f.doc_id
+        where d.doc_id is null
+    """
 
-    docs_in_legiscan = set([x['doc_id'] for x in bill_texts])
+    with pooled_db_conn("../../conf/local/credentials.yaml") as db_conn:
+        cursor = db_conn.cursor()
 
-    # Bills that exist in Legiscan but not in our DB
-    diff = docs_in_legiscan.difference(docs_in_db)
+        try:
+            _stage_rows(cursor, 'fetched_bill_docs', [('bill_id', 'integer'), ('doc_id', 'integer')], bill_texts)
+            cursor.execute(q)
+            diff = set([x[0] for x in cursor.fetchall()])
+            db_conn.commit()
+        except (Exception, psycopg2.DatabaseError) as error:
+            logging.error(error)
+            db_conn.rollback()
+            # Without the docs in the DB, all the docs are considered new. 
+            # This fetches more texts than needed, but no new text is missed
+            diff = set([x['doc_id'] for x in bill_texts])
 
     return diff  
 
@@ -707,10 +695,10 @@ def update_bills_on_es(bills_updated, bill_contents):
     """
     Store the new docs updated on ES
     :param bills_updated: List of bill ids that have changed
-    :return:
+    :return: The number of new bill docs fetched
     """
 
-    api_calls = 0
+    bill_texts = list()
     for element in bills_updated:
         fname = element['file_name']
         contents = bill_contents[fname]
@@ -719,27 +707,36 @@ def update_bills_on_es(bills_updated, bill_contents):
         logging.info('Updating metadata of bill ID {}'.format(response['bill']['bill_id']))
         _update_bill_metadata(response=response)
 
-        # Checking whether there are new bill versions
-        logging.info('Metadata updated on elasticsearch. Now on to bill texts')
         bill_id = response['bill']['bill_id']
-        bill_texts = response['bill']['texts']
-        new_bill_docs = check_bill_text_updates(bill_id, bill_texts)
-        # logging.info('There are {} new bill docs. But skipping for now to save API calls'.format(len(new_bill_docs)))
-       
-        # each new doc needs an api call
-        api_calls += len(new_bill_docs)
-        
-        logging.info('new bill_docs: {}'.format(new_bill_docs))
-
-        if len(new_bill_docs) > 0:
-            for doc_id in new_bill_docs:
-                _get_text(doc_id)
-
-            logging.info('Fetched {} new bill docs and stored in Elasticsearch'.format(len(new_bill_docs)))
-        else:
-            logging.info('No new bill docs since last update')
+        bill_texts.extend([{'bill_id': bill_id, 'doc_id': x['doc_id']} for x in response['bill']['texts']])
+
+    # Checking whether there are new bill versions
+    logging.info('Metadata updated on elasticsearch. Now on to bill texts')
+    new_docs = sorted(check_bill_text_updates(bill_texts))
+    logging.info('new bill_docs: {}'.format(new_docs))
+
+    # each new doc needs an api call
+    # The texts of all the updated bills are fetched concurrently, and decoded and stored as they arrive
+    if len(new_docs) > 0:
+        # Bill docs don't change once published, so any doc that was fetched before is served from the cache
+        docs_to_fetch = list()
+        for doc_id in new_docs:
+            response = get_response_cache().get('getBillText', doc_id)
+            if response is None:
+                docs_to_fetch.append(doc_id)
+            else:
+                _store_text(response)
+
+        for doc_id, response in LEGISCAN_CLIENT.iter_many('getBillText', docs_to_fetch):
+            if response.get('status') == 'OK':
+                get_response_cache().put('getBillText', doc_id, response)
+            _store_text(response)
+
+        logging.info('Fetched {} new bill docs and stored in Elasticsearch'.format(len(new_docs)))
+    else:
+        logging.info('No new bill docs since last update')
 
-    return api_calls
+    return len(new_docs)
 
 
 def update_people_on_es(people_updated, people_contents, session_id):
@@ -1323,147 +1320,79 @@ def update_db_from_es(bills_updated=None, people_updated=None):
 
 def update_session_hash_in_db(session_updated):
     """
-    Update the hashes of sessions that had changed
+    Update the hash of a session that had changed, or insert it if the session is new
     :param session_updated:
     :return:
     """
-    db_conn = get_db_conn('../../conf/local/credentials.yaml')
-    cursor = db_conn.cursor()
-
-    # check if the session already exists
-
     q = """
-        select 
-            session_id,
-            state_id
-        from
-            legiscan_update_metadata.session_hashes
-        where session_id = '{}' 
-        and state_id = '{}'
-    """.format(session_updated['session_id'], session_updated['state_id'])
+        insert into legiscan_update_metadata.session_hashes (session_id, state_id, session_hash, update_date) 
+        values (%(session_id)s, %(state_id)s, %(session_hash)s, %(update_date)s)
+        on conflict (session_id, state_id) do update 
+        set session_hash = excluded.session_hash, update_date = excluded.update_date;
 
-    try:
-        logging.info("session_hashes select")
-        cursor.execute(q)
-        existing_session = cursor.fetchall()
-        db_conn.commit()
-    except (Exception, psycopg2.DatabaseError) as error:
-            logging.error(error)
+        insert into legiscan_update_metadata.session_hashes_history (session_id, state_id, session_hash, update_date) 
+        values (%(session_id)s, %(state_id)s, %(session_hash)s, %(update_date)s);
+    """
 
-    # insert or update
-    if len(existing_session) > 0:
-        # udpate existing session
-        q = """
-             update legiscan_update_metadata.session_hashes set session_hash = '{}', update_date = '{}' where session_id = '{}' 
-             and state_id = '{}' 
-        """.format(session_updated['session_hash_update'], TODAY, session_updated['session_id'],
-                   session_updated['state_id'])
-    else:
-        q = """
-            insert into legiscan_update_metadata.session_hashes (session_id, state_id, session_hash, update_date) 
-            values ('{}', '{}', '{}', '{}')
-        """.format(session_updated['session_id'], session_updated['state_id'], session_updated['session_hash_update'],
-                   TODAY)
+    with pooled_db_conn('../../conf/local/credentials.yaml') as db_conn:
+        cursor = db_conn.cursor()
 
-    try:
-        logging.info('updating session_hashes table')
-        cursor.execute(q)
-        db_conn.commit()
-    except (Exception, psycopg2.DatabaseError) as error:
-        logging.error(error)
+        try:
+            logging.info('updating session_hashes table')
+            cursor.execute(q, {
+                'session_id': str(session_updated['session_id']),
+                'state_id': str(session_updated['state_id']),
+                'session_hash': session_updated['session_hash_update'],
+                'update_date': TODAY
+            })
+            db_conn.commit()
+        except (Exception, psycopg2.DatabaseError) as error:
+            logging.error(error)
+            # Not raising. Keeping the old session hash only means that the session is checked again in the next run
+            db_conn.rollback()
 
 
 def update_bill_hashes_in_db(bills_updated):
     """
-    Update the hashes of bills changed on our db
-    :param bills_updated:
+    Update the hashes of bills changed on our db. 
+    The hashes are staged in a temp table and upserted in one statement, in a single transaction. 
+    They are also added to bill_hashes_history, which keeps the previous hashes
+    :param bills_updated: The bills returned by _check_bill_hashes
     :return:
     """
-    # flatten list of lists
-    # bills_to_update = list(itertools.chain(*bills_updated))
+    if len(bills_updated) == 0:
+        return
 
-    db_conn = get_db_conn('../../conf/local/credentials.yaml')
-    cursor = db_conn.cursor()
+    rows = [
+        {'bill_id': x['bill_id'], 'session_id': x['session_id_updated'], 'bill_hash': x['bill_hash_updated']} 
+        for x in bills_updated
+    ]
 
-    # check if we need to insert or update
     q = """
-        select 
-            bill_id,
-            session_id
-        from 
-            legiscan_update_metadata.bill_hashes
-    """
-
-    try:
-        logging.info("session_hashes select")
-        cursor.execute(q)
-        existing_bills = cursor.fetchall()
-        db_conn.commit()
-    except (Exception, psycopg2.DatabaseError) as error:
-        logging.error(error)
+        insert into legiscan_update_metadata.bill_hashes (bill_id, session_id, bill_hash, update_date)
+        select bill_id, session_id, bill_hash, %s
+        from updated_bill_hashes
+        on conflict (bill_id, session_id) do update 
+        set bill_hash = excluded.bill_hash, update_date = excluded.update_date;
 
-    # check which sessions need to be inserted vs updated
-    existing_bills_df = pd.DataFrame(existing_bills, columns=["bill_id", "session_id"])
-    bills_updated_df = pd.DataFrame(bills_updated)
-
-    # bills that require update
-    bills_to_update = bills_updated_df.merge(existing_bills_df, how="inner")
-    if bills_to_update.shape[0] > 0:
-        for element in bills_updated:
-            q = """
-            update legiscan_update_metadata.bill_hashes set bill_hash = '{}', update_date = '{}' where bill_id = '{}' 
-            and session_id = '{}' """.format(element['bill_hash_updated'], TODAY,
-                                             element['bill_id'], element['session_id_ours'])
-
-            try:
-                logging.info('updating bill_hashes table from ES')
-                cursor.execute(q)
-                db_conn.commit()
-            except (Exception, psycopg2.DatabaseError) as error:
-                logging.error(error)
-
-    # sessions that need to be inserted
-    bills_to_insert = bills_updated_df.merge(existing_bills_df, how="left")
-    if bills_to_insert.shape[0] > 0:
-        for element in bills_to_insert.to_dict('records'):
-            q = """
-                insert into legiscan_update_metadata.bill_hashes (bill_id, session_id, bill_hash, update_date) 
-                values ('{}', '{}', '{}', '{}')
-            """.format(element['bill_id'], element['session_id_updated'], element['bill_hash_updated'], TODAY)
-
-            try:
-                logging.info('inserting new bill hashes in bill_hashes table')
-                cursor.execute(q)
-                db_conn.commit()
-            except (Exception, psycopg2.DatabaseError) as error:
-                logging.error(error)
-
-
-def retrieve_session_file_name_pkl(session_updated):
-    """
-    Retrieves
-    :param i: Index of the session to retrieve
-    :return:
+        insert into legiscan_update_metadata.bill_hashes_history (bill_id, session_id, bill_hash, update_date)
+        select bill_id, session_id, bill_hash, %s
+        from updated_bill_hashes;
     """
-    s3_creds = get_s3_credentials("../../conf/local/credentials.yaml")
-
-    session = boto3.Session(
-        aws_access_key_id=s3_creds['aws_access_key_id'],
-        aws_secret_access_key=s3_creds['aws_secret_access_key']
-    )
-    s3 = session.client('s3')
-
-    key = constants.S3_BUCKET_LEGISCAN_UPDATES + '/dataset/' + str(TODAY)
-    objects = s3.list_objects_v2(Bucket=constants.S3_BUCKET, Prefix=key)['Contents']
 
-    # get the pkl files for each state
-    session_id = session_updated['session_id']
-    for element in objects:
-        if session_id in element['Key']:
-            file_name = element['Key']
-            break
+    with pooled_db_conn('../../conf/local/credentials.yaml') as db_conn:
+        cursor = db_conn.cursor()
 
-    return file_name
+        try:
+            logging.info('upserting {} bill hashes in bill_hashes table'.format(len(rows)))
+            _stage_rows(cursor, 'updated_bill_hashes', [('bill_id', 'varchar'), ('session_id', 'varchar'), ('bill_hash', 'varchar')], rows)
+            cursor.execute(q, (TODAY, TODAY))
+            db_conn.commit()
+        except (Exception, psycopg2.DatabaseError) as error:
+            logging.error(error)
+            db_conn.rollback()
+            # The session hash is updated after the bill hashes. Stopping here keeps the session to be checked again in the next run
+            raise error
 
 
 def update_data_from_legiscan():
@@ -1471,11 +1400,8 @@ def update_data_from_legiscan():
     Main function that coordinates the checkup and update of bills into ES and DB
     :return:
     """
-    number_of_api_calls = 0
-
     logging.info("Fetching the datasetlist")
-    current_sessions, api_calls = get_datasetlist_from_api()
-    number_of_api_calls += api_calls
+    current_sessions = get_datasetlist_from_api()
 
     logging.info("Identifying sessions that were updated")
     sessions_updated = check_session_updates(current_sessions)
@@ -1484,18 +1410,21 @@ def update_data_from_legiscan():
     # first get all the session_info from legiscan and stored them on S3, then extract and update all data related
     for i in range(len(sessions_updated)):
         current_session = sessions_updated[i]
-        api_calls = get_dataset_from_api(current_session['session_id'], current_session['access_key'])
-        number_of_api_calls += api_calls
+        get_dataset_from_api(current_session['session_id'], current_session['access_key'], current_session['session_hash_update'])
 
-    logging.info('Session datasets fetched from legiscan. API calls used so far : {}'.format(number_of_api_calls))
+    logging.info('Session datasets fetched from legiscan. API calls used so far : {}'.format(LEGISCAN_CLIENT.api_calls))
     
-    # get data from pkls
+    # get data from the cached datasets
     for session_updated in sessions_updated:
-        session_file_name = retrieve_session_file_name_pkl(session_updated)
         logging.info("updating bills from session {}".format(session_updated))
+
+        # The dataset is decoded once and shared by the bill and people checks
+        dataset = review_dataset(session_updated)
+        if dataset is None:
+            continue
         
-        bills_updated, bill_contents = check_bill_updates(session_file_name)
-        people_updated, people_contents, session_id = check_people_updates(session_file_name)
+        bills_updated, bill_contents = check_bill_updates(dataset)
+        people_updated, people_contents, session_id = check_people_updates(dataset)
         
         logging.info("updating session {}".format(session_id))
         logging.info("{} bills to update ".format(len(bills_updated)))
@@ -1504,9 +1433,8 @@ def update_data_from_legiscan():
         updated_data = False
         if len(bills_updated) > 0:
             logging.info("inserting updated bills in es")
-            api_calls = update_bills_on_es(bills_updated, bill_contents)
-            number_of_api_calls += api_calls
-            logging.debug('api calls so far: {}'.format(number_of_api_calls))
+            update_bills_on_es(bills_updated, bill_contents)
+            logging.debug('api calls so far: {}'.format(LEGISCAN_CLIENT.api_calls))
 
             updated_data = True
 
@@ -1532,9 +1460,15 @@ def update_data_from_legiscan():
             # update_db_from_es(bills_updated)
             pass
 
-        logging.info("session {} is done. Used up {} API calls".format(session_id, number_of_api_calls))
+        dataset.close()
+        logging.info("session {} is done. Used up {} API calls".format(session_id, LEGISCAN_CLIENT.api_calls))
 
-    logging.info("successfully updated the data. Used {} API calls".format(number_of_api_calls))
+    logging.info("successfully updated the data. Used {} API calls ({} duplicate requests coalesced)".format(
+        LEGISCAN_CLIENT.api_calls, LEGISCAN_CLIENT.coalesced_calls
+    ))
+    get_response_cache().log_metrics()
+    get_decoder().log_metrics()
+    log_pool_metrics()
 
         
 if __name__ == '__main__':
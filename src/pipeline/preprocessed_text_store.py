@@ -0,0 +1,159 @@
+import os
+import json
+import sqlite3
+import hashlib
+import logging
+import pandas as pd
+
+from typing import List
+
+import src.utils.project_constants as constants
+
+from src.pipeline.text_preprocessing import (
+    iter_preprocessed_texts, fast_preprocess_texts, supports_fast_preprocessing, PREPROCESSING_CHUNK_SIZE
+)
+
+# SQLite limits the number of host parameters of a query
+_SQLITE_MAX_PARAMS = 900
+
+# Number of preprocessed texts written to the store at a time while preprocessing
+STORE_WRITE_BATCH_SIZE = 1000
+
+
+def steps_hash(preprocessing_steps: List, text_field='doc', fast=False):
+    """ md5 of the preprocessing steps (in order), the text field the raw text comes from, and whether the fast path is used """
+    key = [list(preprocessing_steps), text_field]
+    if fast:
+        key.append('fast')
+
+    s = json.dumps(key)
+
+    return hashlib.md5(s.encode()).hexdigest()
+
+
+class PreprocessedTextStore:
+    def __init__(self, preprocessing_steps: List, text_field='doc', db_path=constants.PREPROCESSED_TEXT_STORE, fast=False):
+        """
+            Persistent store of the preprocessed bill texts, keyed by doc_id and the hash of the preprocessing steps.
+            The text of a document is preprocessed once for a list of steps, and read from the store afterwards
+
+            Args:
+                preprocessing_steps: The preprocessing steps, in order (see text_preprocessing.TOKEN_STEPS)
+                text_field: The field of the bill_text index the raw text comes from ('doc', 'description', 'title')
+                db_path: The SQLite file of the store
+                fast: Whether to use the vectorized preprocessing (text_preprocessing.fast_preprocess_texts). 
+                    Only used with the step lists it supports. The texts are stored under a separate key
+        """
+        self.preprocessing_steps = list(preprocessing_steps)
+        self.fast = fast and supports_fast_preprocessing(self.preprocessing_steps)
+        self.steps_hash = steps_hash(self.preprocessing_steps, text_field, self.fast)
+
+        if fast and not self.fast:
+            logging.warning('The fast preprocessing does not support {}. Using the token pipeline'.format(self.preprocessing_steps))
+        self.db_path = db_path
+
+        folder = os.path.dirname(self.db_path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+
+        with self._connect() as conn:
+            conn.execute("""
+                create table if not exists preprocessed_text (
+                    doc_id integer,
+                    steps_hash text,
+                    preprocessed text,
+                    primary key (doc_id, steps_hash)
+                )
+            """)
+
+    def _connect(self):
+        # The store can be read by other processes while one process writes
+        conn = sqlite3.connect(self.db_path, timeout=60)
+        conn.execute('pragma journal_mode=wal')
+
+        return conn
+
+    def get(self, doc_ids) -> pd.Series:
+        """ The preprocessed texts of the doc_ids in the store. A series indexed by doc_id """
+        doc_ids = sorted(set([int(x) for x in doc_ids]))
+        results = list()
+
+        with self._connect() as conn:
+            for i in range(0, len(doc_ids), _SQLITE_MAX_PARAMS):
+                chunk = doc_ids[i:i + _SQLITE_MAX_PARAMS]
+                q = "select doc_id, preprocessed from preprocessed_text where steps_hash=? and doc_id in ({})".format(
+                    ', '.join(['?'] * len(chunk))
+                )
+                results.extend(conn.execute(q, [self.steps_hash] + chunk).fetchall())
+
+        return pd.Series(
+            [x[1] for x in results],
+            index=pd.Index([x[0] for x in results], name='doc_id'),
+            name='preprocessed',
+            dtype=object
+        )
+
+    def missing(self, doc_ids) -> List:
+        """ The doc_ids that are not in the store """
+        found = set(self.get(doc_ids).index)
+
+        return sorted(set([int(x) for x in doc_ids]) - found)
+
+    def put(self, preprocessed: pd.Series):
+        """ Store preprocessed texts. A series indexed by doc_id """
+        rows = [(int(doc_id), self.steps_hash, text) for doc_id, text in preprocessed.items()]
+
+        with self._connect() as conn:
+            conn.executemany(
+                "insert or replace into preprocessed_text (doc_id, steps_hash, preprocessed) values (?, ?, ?)",
+                rows
+            )
+
+        logging.info('Stored {} preprocessed texts at {}'.format(len(rows), self.db_path))
+
+    def preprocess(self, texts: pd.Series, n_jobs=-1, chunk_size=PREPROCESSING_CHUNK_SIZE) -> pd.Series:
+        """ The preprocessed texts of the raw texts (a series indexed by doc_id).
+            Only the texts that are not in the store are preprocessed. They are streamed from the preprocessing pool
+            and written to the store in batches, so an interrupted run keeps the texts it finished
+        """
+        texts = texts[~texts.index.duplicated()]
+        stored = self.get(texts.index)
+        new_texts = texts[~texts.index.isin(stored.index)]
+
+        logging.info('{} of {} texts are preprocessed already'.format(stored.shape[0], texts.shape[0]))
+
+        if new_texts.shape[0] == 0:
+            return stored.reindex(texts.index)
+
+        if self.fast:
+            preprocessed = self._iter_fast_preprocessed(new_texts)
+        else:
+            preprocessed = iter_preprocessed_texts(
+                new_texts, 
+                processing_steps=self.preprocessing_steps, 
+                n_jobs=n_jobs, 
+                chunk_size=chunk_size
+            )
+
+        batches = [stored]
+        batch_ids, batch = list(), list()
+        for doc_id, text in zip(new_texts.index, preprocessed):
+            batch_ids.append(doc_id)
+            batch.append(text)
+
+            if len(batch) == STORE_WRITE_BATCH_SIZE:
+                batches.append(pd.Series(batch, index=batch_ids, dtype=object))
+                self.put(batches[-1])
+                batch_ids, batch = list(), list()
+
+        if batch:
+            batches.append(pd.Series(batch, index=batch_ids, dtype=object))
+            self.put(batches[-1])
+
+        return pd.concat(batches).reindex(texts.index).rename('preprocessed')
+
+    def _iter_fast_preprocessed(self, texts: pd.Series):
+        """ The fast preprocessed texts, vectorized over batches of the store writes"""
+        for i in range(0, texts.shape[0], STORE_WRITE_BATCH_SIZE):
+            for text in fast_preprocess_texts(texts.iloc[i:i + STORE_WRITE_BATCH_SIZE], self.preprocessing_steps):
+                yield text
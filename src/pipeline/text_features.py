@@ -11,6 +11,7 @@ from psycopg2.extras import execute_batch, Json
 from src.pipeline.generate_timesplits import get_time_splits
 from src.utils.general import get_db_conn, get_elasticsearch_conn, get_issue_area_configuration, get_s3_credentials
 from src.pipeline.tf_id_features import tf_idf_features
+from src.pipeline.es_text_fetcher import ESTextFetcher
 
 
 def _get_ids(cohort):
@@ -95,25 +96,23 @@ def _retrieve_text_from_es(ids):
     """
     Retrieve content from specific documents
     :param ids: List of doc ids to retrieve text from
-    :return: List of tuples with id and text
+    :return: List with a list of the texts, in the order of the ids. Missing documents have an empty text
     """
     #index_ids = ['_'.join([str(element[0]), str(element[1])]) for element in ids]
-    index_ids = [element[0] for element in ids]
+    index_ids = [str(element[0]) for element in ids]
 
     es = get_elasticsearch_conn('../../conf/local/credentials.yaml')
-    texts = []
-
-    chunks = [index_ids[i:i + 100] for i in range(0, len(index_ids), 100)]
-    print(len(chunks))
-    for i, chunk in enumerate(chunks):
-        print(i)
-        body = {'ids': chunk}
-        res = es.mget(index=constants.BILL_META_INDEX, body=body, _source_includes=['description'])
-        docs = res['docs']
-        texts_chunk = [element['_source']['description'] for element in docs]
-        texts.append(texts_chunk)
-
-    return texts
+
+    fetcher = ESTextFetcher(es, index=constants.BILL_META_INDEX, source_fields=['description'])
+    docs = fetcher.fetch(index_ids)
+
+    if fetcher.missing:
+        logging.warning('{} of the {} documents are not in the {} index'.format(len(fetcher.missing), len(index_ids), constants.BILL_META_INDEX))
+
+    # keeping the rows aligned with the ids
+    texts = docs.drop_duplicates('_id').set_index('_id')['description'].reindex(index_ids).fillna('').tolist()
+
+    return [texts]
 
 
 def _save_ids(ids, as_of_date):
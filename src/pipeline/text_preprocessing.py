@@ -6,10 +6,20 @@ import pandas as pd
 import multiprocessing as mp
 
 from nltk.stem import LancasterStemmer, WordNetLemmatizer
-from nltk.tokenize import word_tokenize
+from nltk.tokenize import word_tokenize, _treebank_word_tokenizer
 from nltk.corpus import stopwords
 from bs4 import BeautifulSoup
-from typing import List
+from typing import List, Iterable, Iterator
+
+
+# A text without tags or character references is returned unchanged by the HTML parser
+_markup_pattern = re.compile(r'[<&]')
+_url_pattern = re.compile(r'(http|www)\S+')
+
+
+def has_markup(text):
+    """ Whether the text could contain HTML tags or character references"""
+    return _markup_pattern.search(text) is not None
 
 
 def strip_html_tags(text):
@@ -20,7 +30,7 @@ def strip_html_tags(text):
 
 def strip_urls(text):
     """Strips any URLs in the text (has to be prepended by http/www)"""
-    t = re.sub(r'(http|www)\S+', '', text)
+    t = _url_pattern.sub('', text)
     return t
 
 
@@ -28,100 +38,235 @@ def basic_denoising(text):
     """Runs some basic denoising steps on all texts"""
 
     text = text.lower()
-    text = strip_html_tags(text)
+    if has_markup(text):
+        text = strip_html_tags(text)
     text = strip_urls(text)
 
     return text
 
 
-def remove_numbers(text):
-    """strip numbers from the text"""
-    try:
-        words = word_tokenize(text)
-    except LookupError:
-        nltk.download('punkt')
-        words = word_tokenize(text)
+def fast_basic_denoising(texts: pd.Series) -> pd.Series:
+    """ basic_denoising on a series of texts. The HTML parser only runs on the texts with markup"""
+    texts = texts.str.lower()
 
-    pattern = r'[0-9]'
-    # words = ['' if w.isdigit() else w for w in words]
-    words = [re.sub(pattern, '', w) for w in words]
+    with_markup = texts.str.contains(_markup_pattern, regex=True)
+    if with_markup.any():
+        texts = texts.copy()
+        texts[with_markup] = texts[with_markup].apply(strip_html_tags)
 
-    return ' '.join(words)
+    return texts.str.replace(_url_pattern, '', regex=True)
 
 
-def remove_punctuation(text):
-    """replace punctuation with whitespace"""
-    translator = str.maketrans('', '', string.punctuation)
+def _tokenize(text):
+    """ word tokens of the text """
     try:
-        stripped = [w.translate(translator) for w in word_tokenize(text)]
+        return word_tokenize(text)
     except LookupError:
         nltk.download('punkt')
-        stripped = [w.translate(translator) for w in word_tokenize(text)]        
+        return word_tokenize(text)
 
-    return ' '.join(stripped)
 
+# NLTK resources are loaded once per process, not once per document
+_nltk_resources = dict()
 
-def stem_words(text):
-    """ combines the different forms of the words into one (verbs/adverbs/adjectives)"""
-    # text = text.split()
-    try:
-    	stemmer = LancasterStemmer()
-    except LookupError:
-        nltk.download('wordnet')
 
-    try:
-        words = word_tokenize(text)
-    except LookupError:
-        nltk.download('punkt')
-        words = word_tokenize(text)
-
-    stems = [stemmer.stem(w) for w in words]
+def _get_stop_words():
+    if 'stop_words' not in _nltk_resources:
+        try:
+            _nltk_resources['stop_words'] = set(stopwords.words('english'))
+        except LookupError:
+            nltk.download('stopwords')
+            _nltk_resources['stop_words'] = set(stopwords.words('english'))
 
-    return ' '.join(stems)
+    return _nltk_resources['stop_words']
 
 
-def lemmatize_words(text):
-    """ converts the word into its root form"""
-    try:
+def _get_lemmatizer():
+    if 'lemmatizer' not in _nltk_resources:
         lemmatizer = WordNetLemmatizer()
-        lemmatizer.lemmatize('test') # TODO: not an elegant solution
-    except LookupError:
-        nltk.download('wordnet')
-        lemmatizer = WordNetLemmatizer()
-    
-    try:
-        words = word_tokenize(text)
-    except LookupError:
-        nltk.download('punkt')
-        words = word_tokenize(text)
+        try:
+            lemmatizer.lemmatize('test') # the wordnet corpus is loaded lazily
+        except LookupError:
+            nltk.download('wordnet')
+        _nltk_resources['lemmatizer'] = lemmatizer
 
-    lemmas = [lemmatizer.lemmatize(w) for w in words] 
+    return _nltk_resources['lemmatizer']
 
-    return ' '.join(lemmas)
 
+def _get_stemmer():
+    if 'stemmer' not in _nltk_resources:
+        _nltk_resources['stemmer'] = LancasterStemmer()
 
-def remove_stop_words(text, custom_stop_words=None):
-    """Remove the generic stop wods like articles, prepositions from text"""
-    try:
-        stop_words = set(stopwords.words('english'))
-    except LookupError:
-        nltk.download('stopwords')
-        stop_words = set(stopwords.words('english'))
+    return _nltk_resources['stemmer']
 
-    # Removing stop words
-    try:
-        words = [w for w in word_tokenize(text) if w not in stop_words]
-    except LookupError:
-        nltk.download('punkt')
-        words = [w for w in word_tokenize(text) if w not in stop_words]
-    
 
-    # Removing custom stopwords
+# Token stream transforms of the preprocessing steps. Each one takes and returns a list of tokens
+_punctuation_translator = str.maketrans('', '', string.punctuation)
+_number_pattern = re.compile(r'[0-9]')
+
+
+def _lowercase_tokens(tokens):
+    return [w.lower() for w in tokens]
+
+
+def _remove_numbers_tokens(tokens):
+    return [_number_pattern.sub('', w) for w in tokens]
+
+
+def _remove_punctuation_tokens(tokens):
+    return [w.translate(_punctuation_translator) for w in tokens]
+
+
+def _remove_stop_words_tokens(tokens, custom_stop_words=None):
+    stop_words = _get_stop_words()
+    words = [w for w in tokens if w not in stop_words]
+
     if custom_stop_words is not None:
-        words = [w for w in word_tokenize(text) if w not in custom_stop_words]
+        words = [w for w in words if w not in custom_stop_words]
 
+    return words
 
-    return ' '.join(words)
+
+def _stem_tokens(tokens):
+    stemmer = _get_stemmer()
+    return [stemmer.stem(w) for w in tokens]
+
+
+def _lemmatize_tokens(tokens):
+    lemmatizer = _get_lemmatizer()
+    return [lemmatizer.lemmatize(w) for w in tokens]
+
+
+TOKEN_STEPS = {
+    'lowercase': _lowercase_tokens,
+    'remove_numbers': _remove_numbers_tokens,
+    'remove_punctuation': _remove_punctuation_tokens,
+    'remove_stop_words': _remove_stop_words_tokens,
+    'stem': _stem_tokens,
+    'lemmatize': _lemmatize_tokens,
+}
+
+
+def preprocess_text(text, processing_steps: List) -> str:
+    """ Run the preprocessing steps on a text. 
+        The text is tokenized once, and the steps are applied in order on the token stream. 
+        The tokens emptied by a step (e.g. a number or a punctuation mark) are dropped before the next step
+    """
+    tokens = _tokenize(text)
+
+    for step in processing_steps:
+        tokens = [w for w in TOKEN_STEPS[step](tokens) if w]
+
+    return ' '.join(tokens)
+
+
+# Fast preprocessing
+# The word_tokenize regexes are run on the whole series, and the character level steps (lowercase, numbers, punctuation) 
+# are vectorized string operations instead of a loop over the tokens of every document
+
+# Token level steps that are applied on the split texts
+_TOKEN_LEVEL_STEPS = ['remove_stop_words', 'stem', 'lemmatize']
+
+# word_tokenize splits the final period of every sentence. Without the sentence tokenizer, 
+# the periods followed by a white space are split instead (the extra '.' tokens are removed with the punctuation)
+_sentence_period_pattern = re.compile(r'([^\.])(\.)([\]\)}>"\']*)(?=\s)')
+
+
+def supports_fast_preprocessing(processing_steps: List):
+    """ The fast path gives the tokens of preprocess_text when the punctuation is removed before any token level step"""
+    if 'remove_punctuation' not in processing_steps:
+        return False
+
+    punctuation_idx = processing_steps.index('remove_punctuation')
+
+    return not any([x in _TOKEN_LEVEL_STEPS for x in processing_steps[:punctuation_idx]])
+
+
+def _fast_tokenize(texts: pd.Series) -> pd.Series:
+    """ The tokens of word_tokenize separated by white space. Follows the regexes of the NLTK word tokenizer """
+    tokenizer = _treebank_word_tokenizer
+
+    for regexp, substitution in tokenizer.STARTING_QUOTES:
+        texts = texts.str.replace(regexp, substitution, regex=True)
+
+    for regexp, substitution in tokenizer.PUNCTUATION:
+        texts = texts.str.replace(regexp, substitution, regex=True)
+
+    texts = texts.str.replace(_sentence_period_pattern, r'\1 \2\3 ', regex=True)
+
+    regexp, substitution = tokenizer.PARENS_BRACKETS
+    texts = texts.str.replace(regexp, substitution, regex=True)
+
+    regexp, substitution = tokenizer.DOUBLE_DASHES
+    texts = texts.str.replace(regexp, substitution, regex=True)
+
+    texts = ' ' + texts + ' '
+
+    for regexp, substitution in tokenizer.ENDING_QUOTES:
+        texts = texts.str.replace(regexp, substitution, regex=True)
+
+    for regexp in tokenizer.CONTRACTIONS2 + tokenizer.CONTRACTIONS3:
+        texts = texts.str.replace(regexp, r' \1 \2 ', regex=True)
+
+    return texts
+
+
+_VECTORIZED_STEPS = {
+    'lowercase': lambda texts: texts.str.lower(),
+    'remove_numbers': lambda texts: texts.str.replace(_number_pattern, '', regex=True),
+    'remove_punctuation': lambda texts: texts.str.translate(_punctuation_translator),
+}
+
+
+def fast_preprocess_texts(texts: pd.Series, processing_steps: List) -> pd.Series:
+    """ Run the preprocessing steps on a series of texts with vectorized string operations. 
+        Gives the output of preprocess_text for the step lists of supports_fast_preprocessing. 
+        Meant for the short fields (description, title), where the per document overhead dominates
+    
+    Returns:
+        The preprocessed texts named 'preprocessed', with the index of the input
+    """
+    if not supports_fast_preprocessing(processing_steps):
+        raise ValueError('The fast preprocessing needs remove_punctuation before the token level steps, got {}'.format(processing_steps))
+
+    if texts.shape[0] == 0:
+        return pd.Series([], index=texts.index, name='preprocessed', dtype=object)
+
+    texts = _fast_tokenize(texts.astype(str))
+
+    for step in processing_steps:
+        if step in _VECTORIZED_STEPS:
+            texts = _VECTORIZED_STEPS[step](texts)
+        else:
+            transform = TOKEN_STEPS[step]
+            texts = texts.str.split().apply(lambda tokens: ' '.join([w for w in transform(tokens) if w]))
+
+    return texts.str.split().str.join(' ').rename('preprocessed')
+
+
+def remove_numbers(text):
+    """strip numbers from the text"""
+    return ' '.join(_remove_numbers_tokens(_tokenize(text)))
+
+
+def remove_punctuation(text):
+    """replace punctuation with whitespace"""
+    return ' '.join(_remove_punctuation_tokens(_tokenize(text)))
+
+
+def stem_words(text):
+    """ combines the different forms of the words into one (verbs/adverbs/adjectives)"""
+    return ' '.join(_stem_tokens(_tokenize(text)))
+
+
+def lemmatize_words(text):
+    """ converts the word into its root form"""
+    return ' '.join(_lemmatize_tokens(_tokenize(text)))
+
+
+def remove_stop_words(text, custom_stop_words=None):
+    """Remove the generic stop wods like articles, prepositions from text"""
+    return ' '.join(_remove_stop_words_tokens(_tokenize(text), custom_stop_words))
 
 
 def remove_custom_stopwords(text, stopword_file):
@@ -132,97 +277,138 @@ def remove_custom_stopwords(text, stopword_file):
         content = f.read()
         stopwords = content.split('\n')
 
-    words = [w for w in word_tokenize(text) if w not in stopwords]
+    words = [w for w in _tokenize(text) if w not in stopwords]
 
     return ' '.join(words)
 
 
-def process_target(texts: pd.Series, processing_functions: List, preprocessed_list, stopword_file=None,) -> pd.Series:
-    """The target function for the process. Preprocesses the given subset of texts"""
+# Number of documents handed to a preprocessing worker at a time
+PREPROCESSING_CHUNK_SIZE = 64
 
-    process_name = mp.current_process().name
+# The preprocessing steps of the worker processes, set by the pool initializer
+_worker_processing_steps = None
 
-    logging.info('{}:Starting preprocessing {} documents'.format(process_name, texts.shape[0]))
-    
-    for i, proc_func in enumerate(processing_functions):
-        logging.info('{}: Performing {} on text'.format(process_name, proc_func))
 
-        if i == 0:
-            return_series = texts.apply(proc_func)
-        else:
-            return_series = return_series.apply(proc_func)
+def _validate_steps(processing_steps: List):
+    unknown_steps = [x for x in processing_steps if x not in TOKEN_STEPS]
+    if unknown_steps:
+        raise ValueError('Unknown preprocessing steps {}'.format(unknown_steps))
+
+
+def _load_nltk_resources(processing_steps: List):
+    """ Loads the tokenizer and the NLTK resources used by the steps, so that the first document doesn't pay for it"""
+    _tokenize('loading the tokenizer')
+
+    if 'remove_stop_words' in processing_steps:
+        _get_stop_words()
+
+    if 'lemmatize' in processing_steps:
+        _get_lemmatizer()
+
+    if 'stem' in processing_steps:
+        _get_stemmer()
+
+
+def _init_preprocessing_worker(processing_steps: List):
+    """Initializer of the preprocessing pool. Sets the steps of the worker and loads the NLTK resources once"""
+    global _worker_processing_steps
+    _worker_processing_steps = list(processing_steps)
+
+    _load_nltk_resources(_worker_processing_steps)
+
+    logging.info('{}:Ready to preprocess with {}'.format(mp.current_process().name, _worker_processing_steps))
+
+
+def _preprocess_worker_text(text):
+    return preprocess_text(text, _worker_processing_steps)
+
+
+class PreprocessingPool:
+    def __init__(self, processing_steps: List, n_jobs=-1, chunk_size=PREPROCESSING_CHUNK_SIZE):
+        """
+            A process pool that runs the preprocessing steps on streams of texts. 
+            The pool is started on the first use and reused until closed. The results come back in the order of the input
+
+            Args:
+                processing_steps: The steps to be run, in order. Should be keys of TOKEN_STEPS
+                n_jobs: Number of worker processes. -1 uses all the cores. With 1, the texts are preprocessed in this process
+                chunk_size: Number of texts sent to a worker at a time
+        """
+        _validate_steps(processing_steps)
 
-    preprocessed_list.append(return_series)
+        if (n_jobs > mp.cpu_count()) or n_jobs == -1:
+            n_jobs = mp.cpu_count()
+
+        self.processing_steps = list(processing_steps)
+        self.n_jobs = max(n_jobs, 1)
+        self.chunk_size = max(chunk_size, 1)
+        self._pool = None
+
+    def _get_pool(self):
+        if self._pool is None:
+            logging.info('Starting a preprocessing pool with {} processes'.format(self.n_jobs))
+            self._pool = mp.Pool(
+                processes=self.n_jobs, 
+                initializer=_init_preprocessing_worker, 
+                initargs=(self.processing_steps,)
+            )
+
+        return self._pool
+
+    def imap(self, texts: Iterable[str]) -> Iterator[str]:
+        """ Preprocessed texts, streamed in the order of the input """
+        if self.n_jobs == 1:
+            _load_nltk_resources(self.processing_steps)
+            return (preprocess_text(x, self.processing_steps) for x in texts)
+
+        return self._get_pool().imap(_preprocess_worker_text, texts, chunksize=self.chunk_size)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and self._pool is not None:
+            self._pool.terminate()
+        
+        self.close()
+
+
+def iter_preprocessed_texts(texts: Iterable[str], processing_steps: List, n_jobs=-1, chunk_size=PREPROCESSING_CHUNK_SIZE) -> Iterator[str]:
+    """ Streams the preprocessed texts in the order of the input, on a pool that lives as long as the iteration"""
+    with PreprocessingPool(processing_steps, n_jobs=n_jobs, chunk_size=chunk_size) as pool:
+        for preprocessed in pool.imap(texts):
+            yield preprocessed
 
 
 # TODO: Handle removing custom stop words
-def run_preprocessing_steps(texts: pd.Series, processing_steps: List, n_jobs=-1) -> pd.Series:
+def run_preprocessing_steps(texts, processing_steps: List, n_jobs=-1, chunk_size=PREPROCESSING_CHUNK_SIZE) -> pd.Series:
     """Run the preprocessing steps for the raw text in the given order and return the preprocessed text
     
     Args:
-        texts (pd.Series): The text to be preprocessed. A pandas series with ['entity_id', 'as_of_date'] as the index
-        steps (List[str]): The steps to be run. Should be steps included in the preprocessing dict
+        texts (pd.Series): The text to be preprocessed. A pandas series (e.g. with ['entity_id', 'as_of_date'] or doc_id as the index), or a list of texts
+        processing_steps (List[str]): The steps to be run. Should be steps included in TOKEN_STEPS
+        n_jobs (int): Number of processes
+        chunk_size (int): Number of texts sent to a worker at a time
+    
+    Returns:
+        The preprocessed texts named 'preprocessed', in the order and with the index of the input
     """
+    if not isinstance(texts, pd.Series):
+        texts = pd.Series(list(texts), dtype=object)
 
-    preprocess_dict = {
-        'remove_numbers': remove_numbers,
-        'remove_punctuation': remove_punctuation,
-        'remove_stop_words': remove_stop_words,
-        'stem': stem_words,
-        'lemmatize': lemmatize_words,
-    }
-
-    # The mapping functions for each preprocessing step
-    processing_functions = [preprocess_dict[x] for x in processing_steps]
+    if texts.shape[0] == 0:
+        return pd.Series([], index=texts.index, name='preprocessed', dtype=object)
 
-    if (n_jobs > mp.cpu_count()) or n_jobs==-1:
-        n_jobs = mp.cpu_count()
-    
-    num_docs = texts.shape[0]
-    logging.info('Starting multicore preprocessing of {} docs with {} processes'.format(num_docs, n_jobs))
-   
-    # Assigning jobs
-    chunk_size, mod = divmod(num_docs, n_jobs)
-    chunks_list = [chunk_size] * n_jobs
-
-    # Distributing the remainder
-    for i in range(mod):
-        chunks_list[i] = chunks_list[i] + 1 
-
-    logging.info('Job assignments : {}'.format(chunks_list))
-
-    # Multiprocessing
-    manager = mp.Manager()
-    results_list = manager.list()
-
-    idx_cursor = 0
-    jobs = []
-
-    for i, chunk_size in enumerate(chunks_list):
-        p = mp.Process(
-            name=f'p{i}',
-            target=process_target,
-            kwargs={
-                'texts': texts.iloc[idx_cursor:(idx_cursor+chunk_size)],
-                'processing_functions': processing_functions,
-                'preprocessed_list': results_list
-            }
-        )
-
-        jobs.append(p)
-        p.start()
-
-        idx_cursor = idx_cursor + chunk_size 
-    
-    for proc in jobs:
-        proc.join()
+    logging.info('Starting preprocessing of {} docs with {} processes'.format(texts.shape[0], n_jobs))
 
-    preprocessed_data = results_list[0].append(results_list[1:])
-    preprocessed_data.rename('preprocessed', inplace=True)
-    
-    print(preprocessed_data.head())
+    preprocessed = list(iter_preprocessed_texts(texts, processing_steps, n_jobs=n_jobs, chunk_size=chunk_size))
 
-    logging.info('preprocessed and returning {} docs'.format(preprocessed_data.shape[0]))
+    logging.info('preprocessed and returning {} docs'.format(len(preprocessed)))
 
-    return preprocessed_data
-        
+    return pd.Series(preprocessed, index=texts.index, name='preprocessed', dtype=object)
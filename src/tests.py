@@ -106,6 +106,31 @@ def test_bill_decoding():
 
     logging.debug(bill_docs)
 
+def test_decode_timeout_not_cached():
+    """A pdf that times out while being parsed is returned as an empty string, and is not written to the decoder cache"""
+    from src.utils import decoders
+
+    def _slow_pdf_viewer(base64_decoded):
+        time.sleep(5)
+
+    load_pdf_viewer = decoders._load_pdf_viewer
+    decoders._load_pdf_viewer = _slow_pdf_viewer
+
+    try:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            decoder = decoders.BillTextDecoder(n_jobs=1, cache_dir=cache_dir, timeout=1)
+            encoded = base64.b64encode(b'%PDF-1.4 not really a pdf').decode('utf-8')
+
+            bill_text = decoder.decode(encoded, mime_id=2)
+            cached_files = [f for _, _, files in os.walk(cache_dir) for f in files]
+
+            assert bill_text == ''
+            assert decoder.metrics['pdf']['timeouts'] == 1
+            assert len(cached_files) == 0
+    finally:
+        decoders._load_pdf_viewer = load_pdf_viewer
+
+
 def test_datasets():
     key = get_legiscan_key(fpath)
     # get_available_datasets(key)
@@ -504,6 +529,7 @@ if __name__ == '__main__':
     # test_dataset_decode()
     # test_dataset_upload()
     # test_datasets()
+    # test_decode_timeout_not_cached()
     # test_bill_decoding()
     # test_loader_script()
     # test_db_pop()
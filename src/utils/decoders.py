@@ -1,10 +1,26 @@
+import os
 import re
-import logging
 import sys
+import time
+import base64
+import signal
+import hashlib
+import logging
+import itertools
+import threading
+import multiprocessing as mp
 
-from pdfreader import PDFDocument, SimplePDFViewer
+from pdfreader import SimplePDFViewer
 from bs4 import BeautifulSoup
 
+from src.utils import project_constants as constants
+
+# Max seconds spent on decoding a single document before giving up on it
+DECODE_TIMEOUT_SECONDS = 300
+
+# When the pages of a long pdf are split across processes, each process renders this many pages
+PDF_PAGES_PER_TASK = 25
+
 def _extract_strings_per_page(p, viewer):
     """navigate into specific page p and render its content into a single string"""
     viewer.navigate(p)
@@ -15,23 +31,86 @@ def _extract_strings_per_page(p, viewer):
     return page_content
 
 
-def pdf_decoder(base64_decoded):
-    """Decodes a base64 representation of pdf file into string"""
+def _load_pdf_viewer(base64_decoded):
+    """Parse the pdf once and return a viewer. The page tree is not walked yet (see _fill_page_cache)"""
+    return SimplePDFViewer(base64_decoded)
+
+
+def _fill_page_cache(viewer, last_page=None):
+    """
+    Load the pages of the document up to last_page (all pages if None) into the viewer's page cache.
+    The viewer's navigate(n) walks the page tree from the first page to the n-th page, unless the page is in the viewer's page cache.
+    Walking the tree once and filling the cache keeps rendering linear in the number of pages (pdfreader==0.1.4). 
+    The walk stops at last_page
+    """
+    viewer._pages = dict(enumerate(itertools.islice(viewer.doc.pages(), last_page), 1))
+
+
+def _count_pdf_pages(viewer):
+    """The number of pages from the /Count of the page tree root, so that the pages are not walked. Walks the tree if the count is missing"""
+    count = viewer.doc.root.Pages.Count
+
+    if not isinstance(count, int):
+        _fill_page_cache(viewer)
+        count = len(viewer._pages)
+
+    return count
+
+
+def _extract_page_range(args):
+    """Render the pages first_page to last_page (inclusive) of a pdf into a single string. Used by the pool workers"""
+    base64_decoded, first_page, last_page = args
+
+    viewer = _load_pdf_viewer(base64_decoded)
+    _fill_page_cache(viewer, last_page)
+
+    # The page count of the parent comes from /Count, so the range is capped at the pages the document actually has
+    last_page = min(last_page, len(viewer._pages))
+    content = [_extract_strings_per_page(p, viewer) for p in range(first_page, last_page + 1)]
+
+    return " ".join(content)
+
+
+def pdf_decoder(base64_decoded, max_pages=None, pool=None, pages_per_task=PDF_PAGES_PER_TASK):
+    """
+    Decodes a base64 representation of pdf file into string
+    
+    Args:
+        base64_decoded (bytes): The content of the pdf file
+        max_pages (int): Only decode the first max_pages pages. If None, all pages are decoded
+        pool (multiprocessing.Pool): Optional. If given, the pages of long documents are split into ranges that are rendered across the pool 
+        pages_per_task (int): Number of pages in a range when splitting across the pool
+    """
     try:
-        pdf_doc = PDFDocument(base64_decoded)
-    except: 
+        viewer = _load_pdf_viewer(base64_decoded)
+
+        # Only the split across the pool needs the page count up front
+        num_pages = _count_pdf_pages(viewer) if pool is not None else None
+        if (num_pages is not None) and (max_pages is not None):
+            num_pages = min(num_pages, max_pages)
+
+        split = (num_pages is not None) and (num_pages > pages_per_task)
+        if not split:
+            _fill_page_cache(viewer, max_pages)
+    except DecodeTimeout:
+        # The timeout usually fires while parsing a pathological pdf. It is not a parsing error
+        raise
+    except Exception: 
         logging.error('encountered error {}'.format(sys.exc_info()[0]))
         logging.warning('Returning empty string for bill content')
 
         return ''
 
-    all_pages = len([p for p in pdf_doc.pages()])
-
-    viewer = SimplePDFViewer(base64_decoded)
-    content = []
-
-    for page in range(1, (all_pages + 1)):
-        content.append(_extract_strings_per_page(page, viewer))
+    if split:
+        # Each range is rendered by a worker, which only walks the page tree up to the last page of its range
+        ranges = [
+            (base64_decoded, first_page, min(first_page + pages_per_task - 1, num_pages)) 
+            for first_page in range(1, num_pages + 1, pages_per_task)
+        ]
+        # map returns the ranges in order 
+        content = pool.map(_extract_page_range, ranges)
+    else:
+        content = [_extract_strings_per_page(page, viewer) for page in range(1, len(viewer._pages) + 1)]
 
     bill_text = " ".join(content)
 
@@ -50,3 +129,266 @@ def html_decoder(base64_decoded):
     bill_text = re.sub(r'\n\s*\n', r'\n', bs.get_text().strip())
 
     return bill_text
+
+
+# Mime types of the bill texts we can decode, as given by legiscan's mime_id
+MIME_TYPES = {1: 'html', 2: 'pdf'}
+
+
+class DecodeTimeout(BaseException):
+    """Raised inside a decoding worker when a document takes longer than the allowed time.
+    Derives from BaseException so that the generic exception handlers of the decoders (and the pdf library) do not swallow it
+    """
+    pass
+
+
+def decode_bill_doc_content(base64_encoded_text, mime_id, max_pages=None, pool=None):
+    """ 
+    Decode the base64 encoded content of a bill text version (doc) using the decoder of its mime type
+    Returns None if a decoder is not defined for the mime type
+
+    Args:
+        base64_encoded_text (str): The doc field of a legiscan text
+        mime_id (int): The mime_id field of a legiscan text
+        max_pages (int): Page cap for pdf documents. If None, all pages are decoded
+        pool (multiprocessing.Pool): Optional. Pool used to split the pages of long pdf documents
+    """
+    decoded_text = base64.b64decode(base64_encoded_text, validate=True)
+
+    bill_text = None
+    if mime_id == 1:
+        bill_text = html_decoder(decoded_text)
+    elif mime_id == 2:
+        bill_text = pdf_decoder(decoded_text, max_pages=max_pages, pool=pool)
+    else:
+        logging.warning('A decoder is not defined for mime_id {}'.format(mime_id))
+
+    return bill_text
+
+
+def _raise_decode_timeout(signum, frame):
+    raise DecodeTimeout()
+
+
+def _timed_decode(args, pool=None):
+    """
+    Decode one document, enforcing the timeout with an alarm signal. 
+    The alarm can only be set from the main thread of a process. Otherwise, the document is decoded without a timeout
+    
+    Returns:
+        (decoded text, seconds taken, status). The status is one of ok, unsupported, timeout, error
+    """
+    base64_encoded_text, mime_id, timeout, max_pages = args
+
+    use_alarm = (timeout is not None) and (threading.current_thread() is threading.main_thread())
+    
+    start = time.time()
+    if use_alarm:
+        previous_handler = signal.signal(signal.SIGALRM, _raise_decode_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+
+    try:
+        bill_text = decode_bill_doc_content(base64_encoded_text, mime_id, max_pages=max_pages, pool=pool)
+        status = 'ok' if bill_text is not None else 'unsupported'
+    except DecodeTimeout:
+        logging.warning('Decoding a document of mime_id {} timed out after {} seconds'.format(mime_id, timeout))
+        bill_text = ''
+        status = 'timeout'
+    except Exception as e:
+        logging.warning('Error encountered while decoding a document of mime_id {}: {}'.format(mime_id, e))
+        bill_text = ''
+        status = 'error'
+    finally:
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous_handler)
+
+    return bill_text, time.time() - start, status
+
+
+class BillTextDecoder:
+    """
+    Decodes bill texts (base64 encoded html/pdf content from legiscan) to strings.
+
+    - Documents are decoded in a pool of processes, which is created on first use and reused until close() 
+    - Decoded texts are cached on disk, addressed by the hash of the encoded content, so the same document is never decoded twice
+    - A document that takes longer than the timeout is returned as an empty string instead of stalling the worker
+    - When a single document is decoded, the pages of a long pdf are split across the pool
+    - The number of documents, cache hits, timeouts, errors and decoding time are tracked by mime type 
+    """
+
+    def __init__(self, n_jobs=1, cache_dir=None, timeout=DECODE_TIMEOUT_SECONDS, max_pages=None):
+        """
+        Args:
+            n_jobs (int): Number of processes used to decode documents. If -1, all available cores are used
+            cache_dir (str): Folder of the on-disk cache. If None, decoded texts are not cached
+            timeout (int): Max seconds to decode a single document. If None, there's no timeout
+            max_pages (int): Only decode the first max_pages pages of pdf documents. If None, all pages are decoded
+        """
+        if (n_jobs > mp.cpu_count()) or n_jobs == -1:
+            n_jobs = mp.cpu_count()
+
+        self.n_jobs = n_jobs
+        self.cache_dir = cache_dir
+        self.timeout = timeout
+        self.max_pages = max_pages
+        self.metrics = dict()
+        self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Shut down the process pool"""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def _cache_path(self, base64_encoded_text, mime_id):
+        """The cache is content addressed. Files are spread across sub folders by the first two characters of the hash"""
+        content_hash = hashlib.sha256(base64_encoded_text.encode('utf-8')).hexdigest()
+
+        fname = '{}_{}.txt'.format(content_hash, mime_id)
+
+        # Texts decoded with a page cap are cached separately from the complete texts
+        if self.max_pages is not None:
+            fname = '{}_{}_p{}.txt'.format(content_hash, mime_id, self.max_pages)
+
+        return os.path.join(self.cache_dir, content_hash[:2], fname)
+
+    def _read_cache(self, base64_encoded_text, mime_id):
+        if self.cache_dir is None:
+            return None
+
+        fp = self._cache_path(base64_encoded_text, mime_id)
+        if not os.path.isfile(fp):
+            return None
+
+        with open(fp, encoding='utf-8') as f:
+            return f.read()
+
+    def _write_cache(self, base64_encoded_text, mime_id, bill_text):
+        if self.cache_dir is None:
+            return
+
+        fp = self._cache_path(base64_encoded_text, mime_id)
+        os.makedirs(os.path.dirname(fp), exist_ok=True)
+
+        # Writing to a temp file first so that concurrent readers never see a partial file
+        tmp_fp = '{}.{}.tmp'.format(fp, os.getpid())
+        with open(tmp_fp, 'w', encoding='utf-8') as f:
+            f.write(bill_text)
+        os.replace(tmp_fp, fp)
+
+    def _update_metrics(self, mime_id, status=None, seconds=0.0, cache_hit=False):
+        mime = MIME_TYPES.get(mime_id, str(mime_id))
+
+        if mime not in self.metrics:
+            self.metrics[mime] = {'docs': 0, 'cache_hits': 0, 'decoded': 0, 'seconds': 0.0, 'timeouts': 0, 'errors': 0}
+
+        m = self.metrics[mime]
+        m['docs'] = m['docs'] + 1
+
+        if cache_hit:
+            m['cache_hits'] = m['cache_hits'] + 1
+            return
+
+        m['decoded'] = m['decoded'] + 1
+        m['seconds'] = m['seconds'] + seconds
+
+        if status == 'timeout':
+            m['timeouts'] = m['timeouts'] + 1
+        elif status == 'error':
+            m['errors'] = m['errors'] + 1
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = mp.Pool(processes=self.n_jobs)
+
+        return self._pool
+
+    def decode(self, base64_encoded_text, mime_id):
+        """
+        Decode a single document in the calling process. Returns None if a decoder is not defined for the mime type
+        If n_jobs > 1, the pages of a long pdf are rendered across the pool
+        """
+        return self.decode_many([(base64_encoded_text, mime_id)], parallel=False)[0]
+
+    def decode_many(self, docs, parallel=True):
+        """
+        Decode a list of documents. 
+
+        Args:
+            docs (List[Tuple[str, int]]): (base64 encoded content, mime_id) of each document
+            parallel (bool): Whether to use the process pool. Has no effect if n_jobs=1
+
+        Returns:
+            List of decoded texts in the order of the input. 
+            None for documents with an unsupported mime type, and an empty string for documents that could not be decoded
+        """
+        results = [None] * len(docs)
+
+        # Documents to decode, keyed by the cache path (or the position when not caching) 
+        # Identical documents in the same call are only decoded once
+        pending = dict()
+        for i, (base64_encoded_text, mime_id) in enumerate(docs):
+            if base64_encoded_text is None:
+                continue
+
+            cached = self._read_cache(base64_encoded_text, mime_id)
+            if cached is not None:
+                results[i] = cached
+                self._update_metrics(mime_id, cache_hit=True)
+                continue
+
+            key = self._cache_path(base64_encoded_text, mime_id) if self.cache_dir is not None else i
+            if key not in pending:
+                pending[key] = {'doc': (base64_encoded_text, mime_id), 'positions': []}
+            pending[key]['positions'].append(i)
+
+        tasks = [(v['doc'][0], v['doc'][1], self.timeout, self.max_pages) for v in pending.values()]
+
+        if parallel and (self.n_jobs > 1) and (len(tasks) > 1):
+            decoded = self._get_pool().imap(_timed_decode, tasks, chunksize=1)
+        else:
+            # Documents are decoded one at a time in this process. The pool (if any) is used to split long pdfs
+            page_pool = self._get_pool() if self.n_jobs > 1 else None
+            decoded = (_timed_decode(t, pool=page_pool) for t in tasks)
+
+        for item, (bill_text, seconds, status) in zip(pending.values(), decoded):
+            base64_encoded_text, mime_id = item['doc']
+            self._update_metrics(mime_id, status=status, seconds=seconds)
+
+            # Timed out documents are not cached, so they get another chance in the next run 
+            if status == 'ok':
+                self._write_cache(base64_encoded_text, mime_id, bill_text)
+
+            for i in item['positions']:
+                results[i] = bill_text
+
+        return results
+
+    def log_metrics(self):
+        """Log the decoding metrics by mime type"""
+        for mime, m in self.metrics.items():
+            avg = m['seconds'] / m['decoded'] if m['decoded'] > 0 else 0.0
+            logging.info('{}: {} docs, {} cache hits, {} decoded in {:.1f} s ({:.3f} s/doc), {} timeouts, {} errors'.format(
+                mime, m['docs'], m['cache_hits'], m['decoded'], m['seconds'], avg, m['timeouts'], m['errors']
+            ))
+
+
+# One decoder per (n_jobs, cache folder), shared across the modules that decode bill texts
+_decoders = dict()
+
+
+def get_decoder(n_jobs=1, cache_dir=constants.DECODED_TEXT_CACHE):
+    """Get the shared bill text decoder. It is created on first use, so importing a module that decodes texts has no side effects"""
+    key = (n_jobs, cache_dir)
+    if key not in _decoders:
+        _decoders[key] = BillTextDecoder(n_jobs=n_jobs, cache_dir=cache_dir)
+
+    return _decoders[key]
@@ -1,18 +1,43 @@
 import os
+import copy
+import time
 import logging
+import threading
 import yaml
 import psycopg2
+import psycopg2.pool
 import sqlalchemy
 import boto3
 import pandas as pd
 import joblib
 
-from io import BytesIO, StringIO
+from io import BytesIO
+from contextlib import contextmanager
 from elasticsearch import Elasticsearch
 # from elastic_app_search import Client
 
 import src.utils.project_constants as constants 
 
+# Defaults of the psycopg2 connection pool
+DB_POOL_MIN_CONN = 1
+DB_POOL_MAX_CONN = 10
+
+# Number of rows of a dataframe rendered to CSV at a time when copying to postgres
+COPY_CHUNK_ROWS = 50000
+
+# The null marker of the CSV COPY. With the default marker, an unquoted empty string would be written as a null
+COPY_NULL = '\\N'
+
+# Parsed yaml files, keyed by (path, modification time) 
+_yaml_cache = dict()
+
+# Process wide registry of the db pools and clients, keyed by (kind, credentials file).
+# The registry belongs to the process that created it. A forked child (e.g. a multiprocessing worker) starts with an empty registry, 
+# so it never shares the sockets of its parent
+_resources = dict()
+_resources_pid = os.getpid()
+_resources_lock = threading.Lock()
+
 
 def get_legiscan_key(creds_file):
     """get the legiscan API key"""
@@ -42,22 +67,151 @@ def get_boto3_session(creds_file):
     return s3_session   
 
 def read_yaml_file(yaml_file):
-    """ load yaml cofigurations """
+    """ load yaml cofigurations. The parsed file is cached until the file is modified """
 
-    config = None
     try: 
-        with open(yaml_file, 'r') as f:
-            config = yaml.safe_load(f)
-    except:
+        key = (os.path.abspath(yaml_file), os.path.getmtime(yaml_file))
+    except OSError:
         raise FileNotFoundError('Couldnt load the file')
+
+    if key not in _yaml_cache:
+        try: 
+            with open(yaml_file, 'r') as f:
+                _yaml_cache[key] = yaml.safe_load(f)
+        except:
+            raise FileNotFoundError('Couldnt load the file')
     
-    return config
+    # The callers can modify the config they get
+    return copy.deepcopy(_yaml_cache[key])
+
+
+def _get_resource(kind, creds_file, factory):
+    """ Get a pool/client from the process wide registry, creating it with factory() on the first use in this process """
+    global _resources_pid
+
+    key = (kind, os.path.abspath(creds_file))
+
+    with _resources_lock:
+        if os.getpid() != _resources_pid:
+            # We are in a forked child. The inherited pools and clients hold the sockets of the parent, so we drop them without closing
+            _resources.clear()
+            _resources_pid = os.getpid()
+
+        if key not in _resources:
+            logging.debug('Creating {} for process {}'.format(kind, _resources_pid))
+            _resources[key] = factory()
+
+        return _resources[key]
+
+
+class _DBPool:
+    """ 
+    Thread safe psycopg2 connection pool that blocks when all connections are checked out (instead of raising PoolError).
+    Keeps track of the checkouts and how long they waited for a connection
+    """
+
+    def __init__(self, creds, minconn=DB_POOL_MIN_CONN, maxconn=DB_POOL_MAX_CONN):
+        self._pool = psycopg2.pool.ThreadedConnectionPool(
+            minconn,
+            maxconn,
+            user=creds['user'],
+            password=creds['pass'],
+            host=creds['host'],
+            port=creds['port'],
+            database=creds['db']
+        )
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+
+        self.checkouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def getconn(self):
+        start = time.monotonic()
+        self._slots.acquire()
+        waited = time.monotonic() - start
+
+        with self._lock:
+            self.checkouts = self.checkouts + 1
+            self.wait_seconds = self.wait_seconds + waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+        try:
+            return self._pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn):
+        # A connection goes back to the pool without an open (or failed) transaction
+        try:
+            if (not conn.closed) and (conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE):
+                conn.rollback()
+        except psycopg2.Error as error:
+            logging.warning('Could not reset the connection before returning it to the pool: {}'.format(error))
+            self._pool.putconn(conn, close=True)
+        else:
+            self._pool.putconn(conn, close=bool(conn.closed))
+        finally:
+            self._slots.release()
+
+    def metrics(self):
+        with self._lock:
+            return {
+                'checkouts': self.checkouts,
+                'wait_seconds': self.wait_seconds,
+                'max_wait_seconds': self.max_wait_seconds
+            }
+
+
+def get_db_pool(creds_file, minconn=DB_POOL_MIN_CONN, maxconn=DB_POOL_MAX_CONN):
+    """ Get the process wide psycopg2 connection pool for the credentials file """
+    return _get_resource(
+        'db_pool', 
+        creds_file, 
+        lambda: _DBPool(read_yaml_file(creds_file)['db'], minconn=minconn, maxconn=maxconn)
+    )
+
+
+@contextmanager
+def pooled_db_conn(creds_file):
+    """ Check out a psycopg2 connection from the process wide pool. It is returned to the pool at the end of the with block 
+        
+        usage:
+            with pooled_db_conn(creds_file) as db_conn:
+                cursor = db_conn.cursor()
+                ...
+    """
+    pool = get_db_pool(creds_file)
+    conn = pool.getconn()
+
+    try:
+        yield conn
+    finally:
+        pool.putconn(conn)
+
+
+def log_pool_metrics():
+    """ Log the checkouts and checkout wait times of the db pools of this process """
+    for (kind, creds_file), resource in list(_resources.items()):
+        if kind != 'db_pool':
+            continue
+        
+        m = resource.metrics()
+        avg_wait = m['wait_seconds'] / m['checkouts'] if m['checkouts'] > 0 else 0
+        logging.info('DB pool ({}): {} checkouts, {:.3f} s waiting in total, {:.3f} s on average, {:.3f} s max'.format(
+            creds_file, m['checkouts'], m['wait_seconds'], avg_wait, m['max_wait_seconds']
+        ))
 
 
 def get_db_conn(creds_file, conn_type='psycopg2'):
     """ Get an authenticated db connection, given a credentials file
         The db connection type defaults to psycopg2, but can be modified to return a sqlalchemy engine
         For triage, sqlalchemy engines are useful
+
+        A psycopg2 connection is a new connection owned by the caller. Use pooled_db_conn for short lived connections in loops
+        The sqlalchemy engine is a pool in itself. So, one engine is shared by the process
     """
     creds = read_yaml_file(creds_file)['db']
 
@@ -70,26 +224,34 @@ def get_db_conn(creds_file, conn_type='psycopg2'):
             database=creds['db']
         )
     else:
-        poolclass=sqlalchemy.pool.QueuePool
-        dburl = sqlalchemy.engine.url.URL(
-            "postgres",
-            host=creds["host"],
-            username=creds["user"],
-            database=creds["db"],
-            password=creds["pass"],
-            port=creds["port"],
-        )
-
-        connection = sqlalchemy.create_engine(dburl, poolclass=poolclass)
+        connection = _get_resource('sqlalchemy_engine', creds_file, lambda: _create_sqlalchemy_engine(creds))
 
     return connection
 
 
+def _create_sqlalchemy_engine(creds):
+    poolclass=sqlalchemy.pool.QueuePool
+    dburl = sqlalchemy.engine.url.URL(
+        "postgres",
+        host=creds["host"],
+        username=creds["user"],
+        database=creds["db"],
+        password=creds["pass"],
+        port=creds["port"],
+    )
+
+    return sqlalchemy.create_engine(dburl, poolclass=poolclass)
+
+
 def get_elasticsearch_conn(creds_file):
-    """ Get an elasticsearch object from the elasticsearch cluster"""
-    creds = read_yaml_file(creds_file)['es']
+    """ Get an elasticsearch object from the elasticsearch cluster. 
+        The client is thread safe and keeps its own connection pool, so one client is shared by the process
+    """
+    def _create_client():
+        creds = read_yaml_file(creds_file)['es']
+        return Elasticsearch([{'host': creds['host'], 'port': creds['port']}], timeout=30, max_retries=10, retry_on_timeout=True)
 
-    return Elasticsearch([{'host': creds['host'], 'port': creds['port']}], timeout=30, max_retries=10, retry_on_timeout=True)
+    return _get_resource('elasticsearch', creds_file, _create_client)
 
 
 # def get_elastic_app_search_client(creds_file):
@@ -153,35 +315,116 @@ def load_model_s3(s3_session, model_path):
     return mod_obj
 
 
-def copy_df_to_pg(engine, table_name, df, columns_to_write=None):
-    """ Write a dataframe to postgres table using the psycopg copy_from function
+class _CSVChunkReader:
+    """
+    File like reader of a dataframe as CSV, for cursor.copy_expert. 
+    The CSV is rendered chunk_rows rows at a time, so only one chunk of text is held in memory.
+    Missing values are rendered as COPY_NULL, so that empty strings stay empty strings
+    """
+    def __init__(self, df, chunk_rows=COPY_CHUNK_ROWS):
+        self.df = df
+        self.chunk_rows = chunk_rows
+        self._next_row = 0
+        self._buffer = ''
+        self._position = 0
+        self.rows_read = 0
+
+    def _fill(self, size):
+        while (size < 0 or len(self._buffer) - self._position < size) and self._next_row < self.df.shape[0]:
+            chunk = self.df.iloc[self._next_row:self._next_row + self.chunk_rows]
+            self._buffer = self._buffer[self._position:] + chunk.to_csv(index=False, header=False, na_rep=COPY_NULL)
+            self._position = 0
+            self._next_row = self._next_row + chunk.shape[0]
+            self.rows_read = self._next_row
+
+    def read(self, size=-1):
+        self._fill(size)
+
+        end = len(self._buffer) if size < 0 else self._position + size
+        data = self._buffer[self._position:end]
+        self._position = self._position + len(data)
+
+        return data
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+
+def copy_df_to_pg(engine, table_name, df, columns_to_write=None, replace_where=None, conflict_columns=None, chunk_rows=COPY_CHUNK_ROWS, commit=True):
+    """ Write a dataframe to postgres table with COPY (CSV), streaming the rows in chunks
 
         args:
             engine: Psycopg2 engine,
             table_name: The table to write
             df: The dataframe. Should have the appropriate column data types. For instance, pandas converts numeric columns to floats by default. 
-                Need to make sure that integer columns are integer. The column names should match the pg table
+                Need to make sure that integer columns are integer. The column names should match the pg table. Missing values (NaN, None) are written as null, and empty strings as empty strings
             columns_to_write: If selecting a subset of columns. default None (write all columns in df)
+            replace_where: Optional dictionary {column: value}. The rows of the table matching all the values are deleted before the copy,
+                in the same transaction. Makes re-running a write idempotent (e.g. the predictions of a model and a matrix)
+                A list value matches any of its elements (e.g. {'model_id': [1, 2]})
+            conflict_columns: Optional list of columns with a unique constraint in the table. 
+                The rows are copied to a staging table and upserted with insert ... on conflict (conflict_columns) do update
+            chunk_rows: Number of rows rendered to CSV at a time
+            commit: Whether to commit the transaction. Set to False when the write is part of a larger transaction
+        
+        return:
+            The number of rows written
     """
     
     if columns_to_write is None:
         columns_to_write = list(df.columns)
 
-    csv_buffer = StringIO()
-    df[columns_to_write].to_csv(csv_buffer, index=False, header=False, sep='\t')
-    csv_buffer.seek(0)
+    cols = ', '.join(columns_to_write)
+    reader = _CSVChunkReader(df[columns_to_write], chunk_rows=chunk_rows)
+    copy_options = "with (format csv, null '{}')".format(COPY_NULL)
 
     cursor = engine.cursor()
 
     try:
-        cursor.copy_from(
-            csv_buffer, 
-            table_name, 
-            sep='\t',
-            columns=columns_to_write
-        )
-        engine.commit()
+        if replace_where:
+            conditions, values = list(), list()
+            for k, v in replace_where.items():
+                if isinstance(v, (list, tuple)):
+                    conditions.append('{}=any(%s)'.format(k))
+                    values.append([x.item() if hasattr(x, 'item') else x for x in v])
+                else:
+                    conditions.append('{}=%s'.format(k))
+                    values.append(v.item() if hasattr(v, 'item') else v)
+
+            cursor.execute('delete from {} where {}'.format(table_name, ' and '.join(conditions)), values)
+            logging.info('Deleted {} rows of {} before writing'.format(cursor.rowcount, table_name))
+
+        if conflict_columns:
+            staging_table = '_stage_{}'.format(table_name.replace('.', '_'))
+            cursor.execute('create temporary table {} (like {} including defaults) on commit drop'.format(staging_table, table_name))
+            cursor.copy_expert('copy {} ({}) from stdin {}'.format(staging_table, cols, copy_options), reader)
+
+            update_columns = [x for x in columns_to_write if x not in conflict_columns]
+            on_conflict = 'do update set {}'.format(
+                ', '.join(['{0}=excluded.{0}'.format(x) for x in update_columns])
+            ) if update_columns else 'do nothing'
+
+            cursor.execute(
+                'insert into {table} ({cols}) select {cols} from {staging} on conflict ({keys}) {on_conflict}'.format(
+                    table=table_name, 
+                    cols=cols, 
+                    staging=staging_table, 
+                    keys=', '.join(conflict_columns), 
+                    on_conflict=on_conflict
+                )
+            )
+            cursor.execute('drop table {}'.format(staging_table))
+        else:
+            cursor.copy_expert('copy {} ({}) from stdin {}'.format(table_name, cols, copy_options), reader)
+
+        if commit:
+            engine.commit()
     except (Exception, psycopg2.DatabaseError) as error:
         logging.error(error)
+        # A caller that owns the transaction decides what to roll back
+        if commit:
+            engine.rollback()
         raise psycopg2.DatabaseError(error)
 
+    return reader.rows_read
+
@@ -1,8 +1,40 @@
+import os
 import pandas as pd 
 import numpy as np
 import matplotlib.pyplot as plt
 import json
 import itertools
+import logging
+
+from collections import namedtuple
+from io import BytesIO
+from scipy import sparse
+
+import src.utils.project_constants as constants
+from src.utils.general import format_s3_path
+
+# A BoW feature matrix loaded from the binary store
+#   matrix: scipy CSR matrix (rows x vocabulary)
+#   index: pd.MultiIndex of (entity_id, as_of_date) of the rows
+#   vocabulary: np.array of the words, ordered by column index
+#   labels: pd.DataFrame of the label columns indexed by index. None if the matrix was stored without labels
+SparseFeatureMatrix = namedtuple('SparseFeatureMatrix', ['matrix', 'index', 'vocabulary', 'labels'])
+
+# Estimators (class names) that raise on scipy sparse input. Only these are densified, in batches of rows
+DENSE_ONLY_ESTIMATORS = {
+    'GaussianNB',
+    'HistGradientBoostingClassifier',
+    'LinearDiscriminantAnalysis',
+    'QuadraticDiscriminantAnalysis',
+    'ScaledLogisticRegression',
+    'PercentileRankOneFeature'
+}
+
+# Rows densified at a time for the dense only estimators
+DENSE_BATCH_SIZE = 10000
+
+# Dense only estimators are fit on the full dense matrix up to this size. Larger matrices are fit in batches with partial_fit
+DENSE_FIT_MAX_BYTES = 2 * 1024 ** 3
 
 def get_triage_components_experiment(sql_engine, experiment_hash, model_group):
     """ get the model and matrix information for a experiment hash and a model group
@@ -143,9 +175,206 @@ def get_pr_k_curve_model(sql_engine, model_id, plot=True, save_target=None):
     return pr_k
 
 
-# TODO: Improve performance
+def save_sparse_feature_matrix(target, matrix, vocabulary, indexes, labels=None, s3_session=None):
+    """ Store a BoW feature matrix as a npz file. 
+        The CSR arrays (data, indices, indptr, shape) are stored as they are, with the row ids, the vocabulary and the labels as side arrays. 
+        So, the matrix is loaded straight into a CSR matrix without any parsing
+
+        Args:
+            target (str): The file path on disk, or the S3 path (s3://<bucket>/<key>) if the s3_session is given. Should end with .npz
+            matrix (sparse matrix): The sparse matrix that representes the BoW
+            vocabulary (Dict): vocabulary mapping to the columns indices of the sparse mat
+            indexes (pd.Index): The (entity_id, as_of_date) of the rows of the sparse matrix, in order
+            labels (pd.DataFrame): Optional. The label columns. The rows should be in the same order as the indexes
+            s3_session: boto3 session. If given, the matrix is stored on S3
+    """
+    csr = sparse.csr_matrix(matrix)
+
+    arrays = {
+        'data': csr.data,
+        'indices': csr.indices,
+        'indptr': csr.indptr,
+        'shape': np.array(csr.shape),
+        'entity_id': np.array([x[0] for x in indexes], dtype=np.int64),
+        'as_of_date': np.array([pd.Timestamp(x[1]).strftime('%Y-%m-%d') for x in indexes]),
+        # words ordered by their column index
+        'vocabulary': np.array(sorted(vocabulary, key=vocabulary.get))
+    }
+
+    if labels is not None:
+        arrays['label_names'] = np.array(list(labels.columns))
+        arrays['labels'] = labels.to_numpy()
+
+    if s3_session is not None:
+        buffer = BytesIO()
+        np.savez(buffer, **arrays)
+
+        fkey = format_s3_path(target)
+        logging.info('Storing the sparse matrix at {}'.format(fkey))
+        s3_session.resource('s3').Bucket(constants.S3_BUCKET).put_object(Key=fkey, Body=buffer.getvalue())
+    else:
+        logging.info('Storing the sparse matrix at {}'.format(target))
+        with open(target, 'wb') as f:
+            np.savez(f, **arrays)
+
+
+def load_sparse_feature_matrix(source, s3_session=None):
+    """ Load a BoW feature matrix stored with save_sparse_feature_matrix
+        
+        Args:
+            source (str): The file path on disk, or the S3 path (s3://<bucket>/<key>) if the s3_session is given
+            s3_session: boto3 session. If given, the matrix is read from S3
+        
+        return:
+            SparseFeatureMatrix
+    """
+    if s3_session is not None:
+        fkey = format_s3_path(source)
+        content = s3_session.resource('s3').Object(constants.S3_BUCKET, fkey).get()['Body'].read()
+        source = BytesIO(content)
+
+    with np.load(source, allow_pickle=False) as npz:
+        matrix = sparse.csr_matrix(
+            (npz['data'], npz['indices'], npz['indptr']), 
+            shape=tuple(npz['shape'])
+        )
+
+        index = pd.MultiIndex.from_arrays(
+            [npz['entity_id'], npz['as_of_date'].astype(object)], 
+            names=['entity_id', 'as_of_date']
+        )
+
+        vocabulary = npz['vocabulary']
+
+        labels = None
+        if 'labels' in npz.files:
+            labels = pd.DataFrame(npz['labels'], index=index, columns=list(npz['label_names']))
+
+    return SparseFeatureMatrix(matrix, index, vocabulary, labels)
+
+
+def save_memmapped_feature_matrix(folder, matrix):
+    """ Write the arrays of a SparseFeatureMatrix as .npy files in a folder, so that other processes can memory map them
+        instead of receiving a pickled copy (see load_memmapped_feature_matrix)
+
+        Args:
+            folder (str): The folder of the matrix. Created if it does not exist
+            matrix (SparseFeatureMatrix): The matrix with its labels
+    """
+    os.makedirs(folder, exist_ok=True)
+
+    arrays = {
+        'data': matrix.matrix.data,
+        'indices': matrix.matrix.indices,
+        'indptr': matrix.matrix.indptr,
+        'shape': np.array(matrix.matrix.shape),
+        'entity_id': np.asarray(matrix.index.get_level_values(0), dtype=np.int64),
+        'as_of_date': np.array([str(x)[:10] for x in matrix.index.get_level_values(1)]),
+        'vocabulary': np.asarray(matrix.vocabulary).astype(str)
+    }
+
+    if matrix.labels is not None:
+        arrays['label_names'] = np.array(list(matrix.labels.columns))
+        arrays['labels'] = matrix.labels.to_numpy()
+
+    for name, arr in arrays.items():
+        np.save(os.path.join(folder, '{}.npy'.format(name)), arr, allow_pickle=False)
+
+
+def load_memmapped_feature_matrix(folder):
+    """ Memory map a SparseFeatureMatrix written with save_memmapped_feature_matrix. 
+        The CSR arrays are not read into the process memory, the pages are shared through the OS page cache
+    """
+    def _load(name, mmap_mode='r'):
+        return np.load(os.path.join(folder, '{}.npy'.format(name)), mmap_mode=mmap_mode, allow_pickle=False)
+
+    matrix = sparse.csr_matrix(
+        (_load('data'), _load('indices'), _load('indptr')), 
+        shape=tuple(_load('shape', None)),
+        copy=False
+    )
+
+    index = pd.MultiIndex.from_arrays(
+        [_load('entity_id', None), _load('as_of_date', None).astype(object)], 
+        names=['entity_id', 'as_of_date']
+    )
+
+    labels = None
+    if os.path.isfile(os.path.join(folder, 'labels.npy')):
+        labels = pd.DataFrame(_load('labels', None), index=index, columns=list(_load('label_names', None)))
+
+    return SparseFeatureMatrix(matrix, index, _load('vocabulary'), labels)
+
+
+def requires_dense_input(model):
+    """ Whether the model can not be trained/scored on a scipy sparse matrix """
+    return type(model).__name__ in DENSE_ONLY_ESTIMATORS
+
+
+def _dense_batches(matrix, batch_size):
+    """ yields (start, end, dense array) for consecutive row batches of a sparse matrix """
+    for start in range(0, matrix.shape[0], batch_size):
+        end = min(start + batch_size, matrix.shape[0])
+        yield start, end, matrix[start:end].toarray()
+
+
+def fit_model(model, matrix, labels, batch_size=DENSE_BATCH_SIZE, max_dense_bytes=DENSE_FIT_MAX_BYTES):
+    """ Train a model on a CSR feature matrix
+        The matrix is passed as it is to the models that accept sparse input. 
+        The dense only models are fit on the full densified matrix when it fits in max_dense_bytes. 
+        Otherwise, they are trained with partial_fit over dense batches of rows when they support it, or the full matrix is densified anyway.
+
+        The batched fit is not identical to a full fit for GaussianNB: 
+        partial_fit takes the variance smoothing (epsilon_) from the last batch, instead of the whole matrix. 
+        So the variances of a model trained in batches can differ slightly from a model trained with fit on the same data
+
+        Args:
+            model: The model object (sklearn API)
+            matrix: scipy CSR matrix
+            labels: array of the labels, in the row order of the matrix
+            batch_size: Number of rows densified at a time
+            max_dense_bytes: The size of the largest dense matrix that is fit in one go
+    """
+    labels = np.asarray(labels)
+
+    if not requires_dense_input(model):
+        return model.fit(matrix, labels)
+
+    dense_bytes = matrix.shape[0] * matrix.shape[1] * np.dtype(np.float64).itemsize
+
+    if hasattr(model, 'partial_fit') and dense_bytes > max_dense_bytes:
+        logging.warning('The dense {} x {} matrix is larger than {} bytes. Training {} in batches with partial_fit'.format(
+            *matrix.shape, max_dense_bytes, type(model).__name__
+        ))
+        classes = np.unique(labels)
+        for start, end, batch in _dense_batches(matrix, batch_size):
+            model.partial_fit(batch, labels[start:end], classes=classes)
+
+        return model
+
+    logging.warning('{} needs dense input. Densifying the {} x {} matrix'.format(type(model).__name__, *matrix.shape))
+    return model.fit(matrix.toarray(), labels)
+
+
+def predict_scores(model, matrix, batch_size=DENSE_BATCH_SIZE):
+    """ The score of the "1" class for each row of a CSR feature matrix
+        The dense only models score dense batches of rows
+    """
+    if not requires_dense_input(model):
+        return model.predict_proba(matrix)[:, 1]
+
+    scores = np.empty(matrix.shape[0], dtype=np.float64)
+    for start, end, batch in _dense_batches(matrix, batch_size):
+        scores[start:end] = model.predict_proba(batch)[:, 1]
+
+    return scores
+
+
 def parse_sparse_bow_json(json_file):
-    """loading the sparse BoW feature matrix stored as a JSON into a dense dataframe
+    """ Legacy. The matrices are stored as npz now (see save_sparse_feature_matrix). 
+        This parser is O(rows x vocabulary), and is only kept to read the matrices stored as JSON before
+        
+        loading the sparse BoW feature matrix stored as a JSON into a dense dataframe
         The JSON should contain a dictionary of the form: 
             'matrix': {'row_idx, col_idx': value}
             'vocabulary': {'word': col_idx}
@@ -163,7 +392,7 @@ def parse_sparse_bow_json(json_file):
     }
 
     # Zeroes dataframe
-    df = pd.DataFrame(0, index=d['id_mapping'].keys(), columns=d['vocabulary'].keys())
+    df = pd.DataFrame(0.0, index=d['id_mapping'].keys(), columns=d['vocabulary'].keys())
 
     # Cartesian product of row, col indexes
     prod = itertools.product(d['id_mapping'].keys(), d['vocabulary'].keys())
@@ -2,6 +2,10 @@
 
 S3_BUCKET = 'aclu-leg-tracker'
 PROJECT_FOLDER = '/mnt/data/projects/aclu_leg_tracker/'
+DECODED_TEXT_CACHE = '/mnt/data/projects/aclu_leg_tracker/decoded_text_cache'
+LEGISCAN_RESPONSE_CACHE = '/mnt/data/projects/aclu_leg_tracker/legiscan_response_cache'
+DOC_TERM_COUNTS_CACHE = '/mnt/data/projects/aclu_leg_tracker/doc_term_counts_cache'
+PREPROCESSED_TEXT_STORE = '/mnt/data/projects/aclu_leg_tracker/preprocessed_text_store.sqlite'
 BILL_TEXT_INDEX = "bill_text"
 BILL_META_INDEX = "bill_meta"
 ISSUE_REPRODUCTIVE_RIGHTS = "reproductive_rights"
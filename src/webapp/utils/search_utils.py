@@ -122,46 +122,10 @@ def index_search(es, db_conn, index, keywords, from_i, size=10, filters={'last_i
 
     # filteirng only the active bills
     if filters['search_only_active']:
-        # query for fetching the list of active bills --> cohort query for the last as_of_date
-        q = '''
-            with all_active_bills as (
-                select 
-                    bill_id
-                from clean.bills a
-                    join clean.sessions b using (session_id)
-                        join pre_triage_features.ajusted_session_dates c using (session_id)
-                            left join clean.bill_progress d using (bill_id)
-                where 
-                    extract(year from date '{as_of_date}')::int in (b.year_start, b.year_end) 
-                    and 
-                    extract (year from introduced_date)::int in (b.year_start, b.year_end)
-                    and
-                    introduced_date < '{as_of_date}'
-                    and
-                    not b.special	 
-                    and 
-                    (adjourn_date > '{as_of_date}' or adjourn_date is null)
-                    and
-                    convene_date < '{as_of_date}'
-                    and 
-                    progress_date < '{as_of_date}'
-                group by bill_id
-                having
-                    max(case when event in (4, 5, 6) then progress_date end) is null
-            )
-            select
-                bill_id
-            from all_active_bills left join clean.bill_events using (bill_id)
-            where event_date < '{as_of_date}'
-            group by bill_id
-            having 
-                min(('{as_of_date}'::DATE - event_date::DATE)::int) < 60
-            
-        '''.format(
-            as_of_date=TODAY
-        )
+        # The active bills as of today, from the active_bills table (the cohort of the bill passage models)
+        q = "select bill_id from pre_triage_features.get_active_bills(%(as_of_date)s)"
 
-        bill_ids = pd.read_sql(q, db_conn)['bill_id'].tolist()
+        bill_ids = pd.read_sql(q, db_conn, params={'as_of_date': TODAY})['bill_id'].tolist()
 
         if not body['query']['bool'].get('filter'):
             body['query']['bool']['filter'] = [{"ids": {"values": bill_ids}}]